@@ -5,9 +5,41 @@ import types
 import traceback
 import sys
 import re
+import os
+import gc
+import zlib
+import hashlib
+import tempfile
+import cPickle
+from array import array
+import cStringIO
+import itertools
+import multiprocessing
+
+# Bump this whenever JSObject, JSEnvironment or the crawling changes, it keys
+# the cached libraries along with the parser version.
+CACHE_VERSION = 4
 
 transdel = ''.join(c for c in map(chr, range(256)) if not c.isalnum())
 
+# The access paths of the dotted names looked up so far, see accessPath.
+# They are dropped once there are maxAccessPaths of them, so that a long
+# session doesn't keep every name of every snippet it has seen.
+accessPaths = {}
+maxAccessPaths = 10000
+
+def accessPath(name):
+	"""
+	Return the parts of a dotted name as a tuple, split once per name and
+	then shared by every lookup of that name
+	"""
+	path = accessPaths.get(name)
+	if path is None:
+		if len(accessPaths) >= maxAccessPaths:
+			accessPaths.clear()
+		path = accessPaths[name] = tuple(name.split('.'))
+	return path
+
 class JSEnvironment:
 	def __init__(self, root, this):
 		"""
@@ -16,17 +48,45 @@ class JSEnvironment:
 		self.root = root
 		self.this = [this]
 		self.scopes = [{}]
+		self.declarations = 0		# counted by _crawlFunctions
+		self.contributions = None	# made by reloadLibrary, see _contributions
+		self.libraryDigest = None
+		self.resolved = {}
+		self.resolvedWrites = None
+		self.templates = {}			# see functionTemplate
+		self.expanded = {}			# see _expandFunction
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state['resolved'], state['resolvedWrites'], state['templates'], state['expanded']
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.resolved = {}
+		self.resolvedWrites = None
+		self.templates = {}
+		self.expanded = {}
+
+	def invalidate(self):
+		"""
+		Forget the names resolved by get, after the scopes or this change
+		Writes to any JSObject are noticed by get itself
+		"""
+		self.resolvedWrites = None
 
 	def pushThis(self, newthis):
 		"""
 		Change the current this object, saving the old one for a future pop
 		"""
 		self.this.append(newthis)
+		self.invalidate()
 
 	def popThis(self):
 		"""
 		Delete the current this object and revert to the previous
 		"""
+		self.invalidate()
 		return self.this.pop()
 
 	def getThis(self):
@@ -40,18 +100,21 @@ class JSEnvironment:
 		Change the current local scope, saving the old scope for a future pop
 		"""
 		self.scopes.append({})
+		self.invalidate()
 
 	def popScope(self):
 		"""
 		Delete the current scope and revert to the previous
 		"""
 		self.scopes.pop()
+		self.invalidate()
 
 	def createLocal(self, name):
 		"""
 		Define a variable in the current local scope
 		"""
 		self.scopes[-1][name] = None
+		self.invalidate()
 
 	def set(self, name, value):
 		"""
@@ -60,7 +123,8 @@ class JSEnvironment:
 
 		if the name has period separators, navigate the scopes to find it
 		"""
-		parts=name.split('.')
+		parts=accessPath(name)
+		self.invalidate()
 		if len(parts)>1:
 			if parts[0] == 'this':
 				curobject = self.this[-1]
@@ -86,8 +150,23 @@ class JSEnvironment:
 		If it is not in the local scope, return the variable of the global scope
 
 		if the name has period separators, navigate the scopes to find it
+		The results are kept until the environment or any JSObject changes,
+		including the names that are not found, such as the browser's
+		document.getElementById, so looking them up again is a dict lookup
+		"""
+		if self.resolvedWrites != JSObject.writes:
+			self.resolved = {}
+			self.resolvedWrites = JSObject.writes
+		resolved = self.resolved
+		if name in resolved:
+			return resolved[name]
+		value = resolved[name] = self.resolve(accessPath(name))
+		return value
+
+	def resolve(self, parts):
+		"""
+		Returns the value for the access path parts, without the cache of get
 		"""
-		parts=name.split('.')
 		if len(parts)>1:
 			if parts[0] == 'this':
 				curobject = self.this[-1]
@@ -106,6 +185,7 @@ class JSEnvironment:
 			if parts[-1] in curobject:
 				return curobject[parts[-1]]
 		else:
+			name = parts[0]
 			if name in self.scopes[-1]:
 				return self.scopes[-1][name]
 			else:
@@ -114,26 +194,47 @@ class JSEnvironment:
 					return self.root[name]
 
 class JSObject:
+	writes = 0		# counts the changes to every JSObject, for JSEnvironment.get
 	def __init__(self, function=None, parent=None, members=None):
 		"""
 		Create a new JSObject, ready to have members added
-		If you pass in a parent, like a javascript prototype, its members are duplicated
+		If you pass in a parent, like a javascript prototype, its members are
+		shared with the new object until either of them is changed, which
+		copies them first, so it is as if they were duplicated
 		You can also pass in some extra members to add at the start
 		"""
 		if parent == None:
 			self.members = members if members else {}
-		else:
+			self.shared = False
+		elif members:
 			self.members = dict.copy(parent.members)
-			if members:
-				self.members.update(members)
+			self.members.update(members)
+			self.shared = False
+		else:
+			self.members = parent.members
+			self.shared = parent.shared = True
 		self.function = function
 
 	def __setitem__(self, name, value):
 		"""
 		Add/update this member on this object
 		"""
+		JSObject.writes += 1
+		if self.shared:
+			self.members = dict.copy(self.members)
+			self.shared = False
 		self.members[name] = value
 
+	def __delitem__(self, name):
+		"""
+		Remove this member from this object, if it is there
+		"""
+		JSObject.writes += 1
+		if self.shared:
+			self.members = dict.copy(self.members)
+			self.shared = False
+		self.members.pop(name, None)
+
 	def __getitem__(self, name):
 		"""
 		Return this member
@@ -146,183 +247,416 @@ class JSObject:
 	def keys(self):
 		return self.members.keys()
 
+def _ignore(visitor, node, *args):
+	"""
+	The handler for the nodes that a walker passes over
+	"""
+	yield None
+
+def dispatchTable(handlers, default=_ignore):
+	"""
+	Build a handler table for Visitor.dispatch, a list indexed by type code
+	Handlers is a dict of the handlers by space separated type names, the
+	other types get the default handler
+	"""
+	table = [default] * len(jsparser.typeNames)
+	for names, handler in handlers.items():
+		for name in names.split():
+			table[jsparser.typeCodes[name]] = handler
+	return table
+
+class Visitor:
+	"""
+	Base for the walkers over parse trees, which pick what to do with a node
+	from a table of handlers indexed by its type code, built by dispatchTable
+
+	The handlers are plain functions of the class body, taking the walker
+	and the node. They are generators for jsparser.trampoline, like the walk
+	methods that call them, and yield their result, if any, last.
+	"""
+	def dispatch(self, handlers, node, *args):
+		return handlers[node.type_](self, node, *args)
+
+# The operators that _crawlIdentifier writes between their two operands
+binaryOperators = dict((jsparser.typeCodes[name], symbol) for name, symbol in {
+	'MOD':'%', 'PLUS':'+', 'MINUS':'-', 'MUL':'*', 'DIV':'/',
+	'URSH':'>>>', 'RSH':'>>', 'LSH':'<<', 'BITWISE_AND': '&', 'BITWISE_OR':'|', 'BITWISE_XOR':'^',
+	'AND':'&&', 'OR':'||',
+	'STRICT_EQ':'===', 'EQ':'==', 'STRICT_NE':'!==', 'NE':'!=', 'LE':'<=', 'LT':'<', 'GE':'>=', 'GT':'>'}.items())
+unaryOperators = dict((jsparser.typeCodes[name], symbol) for name, symbol in {
+	'UNARY_MINUS':'-', 'UNARY_PLUS':'+', 'NOT':'!', 'BITWISE_NOT':'~',
+	'TYPEOF':'typeof ', 'VOID':'void ', 'DELETE':'delete ', 'NEW':'new '}.items())
+
+def _accessName(object, valuename='value'):
+	"""
+	Return the dotted name of an expression like document.getElementById or
+	this.x, which is all that JSEnvironment.get can find, or None for any
+	other expression
+	"""
+	names = []
+	node = object
+	while node.type_ == jsparser.DOT and node[1].type_ == jsparser.IDENTIFIER:
+		names.append(getattr(node[1], valuename))
+		node = node[0]
+	if node.type_ == jsparser.IDENTIFIER:
+		names.append(getattr(node, valuename))
+	elif node.type_ == jsparser.THIS:
+		names.append('this')
+	else:
+		return None
+	names.reverse()
+	return '.'.join(names)
+
 def _crawlIdentifier(object, valuename):
-	if object.type=='THIS':
-		return 'this'
-	if object.type=='IDENTIFIER':
-		return getattr(object, valuename)
-	if object.type=='NUMBER':
-		return str(getattr(object, valuename))
-	if object.type=='STRING':
-		return '"' + getattr(object, valuename) + '"'
-	if object.type=='DOT':
-		return _crawlIdentifier(object[0], valuename) + "." + _crawlIdentifier(object[1], valuename)
-	if object.type=='INDEX':
-		return _crawlIdentifier(object[0], valuename) + "[" + _crawlIdentifier(object[1], valuename) + "]"
-	if object.type=='GROUP':
-		return '(' + _crawlIdentifier(object[0], valuename) + ")"
-	if object.type=='INCREMENT':
-		var = _crawlIdentifier(object[0], valuename)
-		return '++' + var if object.start < object[0].start else var + '++'
-	if object.type=='DECREMENT':
-		var = _crawlIdentifier(object[0], valuename)
-		return '--' + var if object.start < object[0].start else var + '--'
-	if object.type=='BITWISE_NOT':
-		return '~' + _crawlIdentifier(object[0], valuename)
-	if object.type=='HOOK':
-		return _crawlIdentifier(object[0], valuename) + "?" + _crawlIdentifier(object[1], valuename) + ":" + _crawlIdentifier(object[2], valuename)
-	if object.type=='CALL':
-		return _crawlIdentifier(object[0], valuename) + '(' + ', '.join([_crawlIdentifier(x, valuename) for x in object[1]]) + ')'
-	if object.type=='OBJECT_INIT':
-		return '{' + ','.join([_crawlIdentifier(x, valuename) for x in object]) + '}'
-	if object.type=='PROPERTY_INIT':
-		return _crawlIdentifier(object[0], valuename) + ':' + _crawlIdentifier(object[1], valuename)
-	du={'MOD':'%', 'PLUS':'+', 'MINUS':'-', 'MUL':'*', 'DIV':'/', \
-	    'URSH':'>>>', 'RSH':'>>', 'LSH':'<<', 'BITWISE_AND': '&', 'BITWISE_OR':'|', 'BITWISE_XOR':'^', \
-	    'AND':'&&', 'OR':'||', \
-	    'STRICT_EQ':'===', 'EQ':'==', 'STRICT_NE':'!==', 'NE':'!=', 'LE':'<=', 'LT':'<', 'GE':'>=', 'GT':'>'}
-	if object.type in du.keys():
-		return _crawlIdentifier(object[0], valuename) + du[object.type] + _crawlIdentifier(object[1], valuename)
-	#import pdb; pdb.set_trace()
-	print("Unknown identifier type: " + object.type)
+	# dotted names are most of what comes through here, so build those in a
+	# loop and leave the rest to the writer
+	name = _accessName(object, valuename)
+	if name is None:
+		name = jsparser.trampoline(IdentifierWriter(valuename).walk(object))
+	return name
+
+class IdentifierWriter(Visitor):
+	"""
+	Builds the source of an identifier expression, as a generator for
+	jsparser.trampoline so that deeply nested expressions fit on the stack
+	"""
+	def __init__(self, valuename):
+		self.valuename = valuename
+
+	def walk(self, object):
+		return self.handlers[object.type_](self, object)
+
+	def writethis(self, object):
+		yield 'this'
+	def writeidentifier(self, object):
+		yield getattr(object, self.valuename)
+	def writenumber(self, object):
+		yield str(getattr(object, self.valuename))
+	def writestring(self, object):
+		yield '"' + getattr(object, self.valuename) + '"'
+	def writedot(self, object):
+		yield (yield self.walk(object[0])) + "." + (yield self.walk(object[1]))
+	def writeindex(self, object):
+		yield (yield self.walk(object[0])) + "[" + (yield self.walk(object[1])) + "]"
+	def writegroup(self, object):
+		yield '(' + (yield self.walk(object[0])) + ")"
+	def writeincrement(self, object):
+		var = yield self.walk(object[0])
+		yield '++' + var if object.start < object[0].start else var + '++'
+	def writedecrement(self, object):
+		var = yield self.walk(object[0])
+		yield '--' + var if object.start < object[0].start else var + '--'
+	def writeunary(self, object):
+		operator = unaryOperators[object.type_]
+		operand = yield self.walk(object[0])
+		if operand.startswith(operator[-1]) and operator in '+-':
+			# keep - -1 from turning into a decrement
+			operator += ' '
+		yield operator + operand
+	def writehook(self, object):
+		yield (yield self.walk(object[0])) + "?" + (yield self.walk(object[1])) + ":" + (yield self.walk(object[2]))
+	def writecall(self, object):
+		function = yield self.walk(object[0])
+		arguments = []
+		for x in object[1]:
+			arguments.append((yield self.walk(x)))
+		yield function + '(' + ', '.join(arguments) + ')'
+	def writeobject(self, object):
+		properties = []
+		for x in object:
+			properties.append((yield self.walk(x)))
+		yield '{' + ','.join(properties) + '}'
+	def writearray(self, object):
+		elements = []
+		for x in object:
+			elements.append('' if x is None else (yield self.walk(x)))
+		yield '[' + ', '.join(elements) + ']'
+	def writeproperty(self, object):
+		yield (yield self.walk(object[0])) + ':' + (yield self.walk(object[1]))
+	def writebinary(self, object):
+		yield (yield self.walk(object[0])) + binaryOperators[object.type_] + (yield self.walk(object[1]))
+	def writeunknown(self, object):
+		# functions, regexps, literals and the like are copied as written
+		yield object.sourceFile.text[object.start:object.end]
+
+	handlers = dispatchTable({
+		'THIS': writethis, 'IDENTIFIER': writeidentifier, 'NUMBER': writenumber,
+		'STRING': writestring, 'DOT': writedot, 'INDEX': writeindex, 'GROUP': writegroup,
+		'INCREMENT': writeincrement, 'DECREMENT': writedecrement,
+		'HOOK': writehook, 'CALL': writecall,
+		'OBJECT_INIT': writeobject, 'PROPERTY_INIT': writeproperty, 'ARRAY_INIT': writearray,
+		' '.join(jsparser.typeNames[code] for code in unaryOperators): writeunary,
+		' '.join(jsparser.typeNames[code] for code in binaryOperators): writebinary,
+	}, writeunknown)
+
+def _mayDeclare(function):
+	"""
+	Whether crawling the function as a constructor could find anything
+	Functions that were lazily parsed know this without parsing their body
+	"""
+	return getattr(function, 'bodyDeclares', True)
 
-def _crawlFunctions(env, code):
-	deferredcrawling=[]
-	#import pdb; pdb.set_trace()
+# The kinds of records that _crawlFunctions works through: the declarations
+# of var statements and function statements, of assignments, of properties
+# in object literals and of elements in array literals, which each handle
+# values a little differently, then the work left until the end of a crawl
+DECLARE_VAR, DECLARE_ASSIGN, DECLARE_PROPERTY, DECLARE_ELEMENT, \
+	CRAWL_CONSTRUCTOR, CREATE_INSTANCE = range(6)
+
+propertyKeys = frozenset([jsparser.IDENTIFIER, jsparser.STRING, jsparser.NUMBER])
+
+def _declarations(code):
+	"""
+	Generate the (kind, name, value) declaration records of the statements
+	of code, or of its properties if it is an object literal
+	"""
 	for node in code:
-		if node.type=='FUNCTION':
-			newthis = env.get(node.name) or JSObject(node)	# create the function object
-			env.set(node.name, newthis)
-			name=node.name+".prototype"
-			newthis = env.get(name) or JSObject()			# create a blank prototype
-			env.set(name, newthis)
-			def makedeferred(newthis, nodebody):
-				def deferred():
-					env.pushThis(newthis)
-					_crawlFunctions(env, nodebody)		# crawl the "constructor"
-					env.popThis()
-				return deferred
-			deferredcrawling.append(makedeferred(newthis, node.body))
-		elif node.type=='VAR':
-			name = node[0].value
-			if node[0].initializer.type=='FUNCTION':
-				newthis = env.get(name) or JSObject(node[0].initializer)	# create the function object
-				env.set(name, newthis)
-				name=name+".prototype"
-				newthis = env.get(name) or JSObject()			# create a blank prototype
-				env.set(name, newthis)
-				def makedeferred(newthis, nodebody):
-					def deferred():
-						env.pushThis(newthis)
-						_crawlFunctions(env, nodebody)		# crawl the "constructor"
-						env.popThis()
-					return deferred
-				deferredcrawling.append(makedeferred(newthis, node[0].initializer.body))
-			elif node[0].initializer.type=='OBJECT_INIT':	# var x = {}
-				newthis = env.get(name) or JSObject()
-				env.set(node[0].name, newthis)
-				env.pushThis(newthis)
-				_crawlFunctions(env, node[0].initializer)
-				env.popThis()
-			elif node[0].initializer.type=='ARRAY_INIT':		# var x = []
-				newthis = env.get(name) or JSObject()
-				env.set(name, newthis)
-				env.pushThis(newthis)
-				for index in range(0, len(node[0].initializer)):
-					newthis = JSObject(node[0].initializer[index])	# create the function object
-					name='this.'+str(index)
-					env.set(name, newthis)
-					name=name+".prototype"
-					newthis = JSObject()			# create a blank prototype
-					env.set(name, newthis)
-					env.pushThis(newthis)
-					_crawlFunctions(env, node[0].initializer[index])		# crawl the "constructor"
-					env.popThis()
-				env.popThis()
+		type_ = node.type_
+		if type_ == jsparser.FUNCTION:
+			yield DECLARE_VAR, node.name, node
+		elif type_ == jsparser.VAR:
+			value = getattr(node[0], 'initializer', None)
+			if value is not None:
+				yield DECLARE_VAR, node[0].value, value
+		elif type_ == jsparser.SEMICOLON:
+			expression = node.expression
+			if expression and expression.type_ == jsparser.ASSIGN:
+				yield DECLARE_ASSIGN, _crawlIdentifier(expression[0], 'value'), expression[1]
+		elif type_ == jsparser.PROPERTY_INIT and node[0].type_ in propertyKeys:
+			yield DECLARE_PROPERTY, 'this.' + str(node[0].value), node[1]
+
+def _crawlFunctions(env, code):
+	"""
+	Crawl the statements of code, a library or the body of a function, for
+	the functions and objects they declare, adding them to env
+
+	Rather than recursing into literals and constructors, this works
+	through a stack of frames, one for each body or literal being crawled,
+	holding its declaration records, the records it defers and whether it
+	pushed a this object. The bodies of functions, crawled as constructors
+	with their prototype as this, and instances made with new are deferred
+	until the rest of the frame is done, as they may use anything declared
+	after them. The number of declarations is added to env.declarations.
+	"""
+	return _crawlRecords(env, _declarations(code))
+
+def _crawlRecords(env, records):
+	"""
+	Crawl the declaration records of a library, see _crawlFunctions
+	"""
+	# The crawl makes lots of objects but no garbage, so the cyclic garbage
+	# collector would only slow it down going over them again and again,
+	# along with the freshly parsed tree: in loadLibrary, pausing it takes
+	# the crawl of generateLibrary(32000) from 0.60s to 0.26s and of 64000
+	# functions from 1.42s to 0.78s, while small libraries gain nothing.
+	# Callers that turned the collector off themselves keep it off.
+	enabled = gc.isenabled()
+	gc.disable()
+	try:
+		_crawlDeclarations(env, records)
+	finally:
+		if enabled:
+			gc.enable()
+	return env
+
+def _crawlDeclarations(env, records):
+	frames = [[records, [], False]]
+	declarations = 0
+	while frames:
+		frame = frames[-1]
+		record = next(frame[0], None)
+		if record is None:
+			if frame[1]:				# then crawl the deferred records
+				frame[0] = iter(frame[1])
+				frame[1] = []
 			else:
-				if node[0].initializer.type=='IDENTIFIER':
-					fromname = _crawlIdentifier(node[0].initializer, 'value')
-					env.set(name, env.get(fromname))
-		elif node.type=='SEMICOLON' and node.expression and node.expression.type=='ASSIGN':
-			name = _crawlIdentifier(node.expression[0], 'value')
-			if node.expression[1].type == 'FUNCTION':		# x = function() {}
-				newthis = env.get(name) or JSObject(node.expression[1])	# create the function object
-				env.set(name, newthis)
-				name=name+".prototype"
-				newthis = env.get(name) or JSObject()			# create a blank prototype
-				env.set(name, newthis)
-				def makedeferred(newthis, nodebody):
-					def deferred():
-						env.pushThis(newthis)
-						_crawlFunctions(env, nodebody)		# crawl the "constructor"
-						env.popThis()
-					return deferred
-				deferredcrawling.append(makedeferred(newthis, node.expression[1].body))
-			elif node.expression[1].type == 'IDENTIFIER':		# x = x;
-				fromname = _crawlIdentifier(node.expression[1], 'value')
-				env.set(name, env.get(fromname))
-			elif node.expression[1].type=='OBJECT_INIT':		# x = {}
-				newthis = env.get(name) or JSObject()
-				env.set(name, newthis)
-				env.pushThis(newthis)
-				_crawlFunctions(env, node.expression[1])
-				env.popThis()
-			elif node.expression[1].type=='ARRAY_INIT':		# x = {}
-				newthis = env.get(name) or JSObject()
-				env.set(name, newthis)
-				env.pushThis(newthis)
-				for index in range(0, len(node.expression[1])):
-					newthis = JSObject(node.expression[1][index])	# create the function object
-					name='this.'+str(index)
-					env.set(name, newthis)
-					name=name+".prototype"
-					newthis = JSObject()			# create a blank prototype
-					env.set(name, newthis)
-					env.pushThis(newthis)
-					_crawlFunctions(env, node.expression[1][index])		# crawl the "constructor"
+				frames.pop()
+				if frame[2]:
 					env.popThis()
-				env.popThis()
-			elif node.expression[1].type in ['NEW', 'NEW_WITH_ARGS']:			# x = new a
-				fromname = _crawlIdentifier(node.expression[1][0], 'value') + ".prototype"
-				def makedeferredinit(name, fromname):
-					def deferred():
-						env.set(name, JSObject(None, env.get(fromname)))
-					return deferred
-				deferredcrawling.append(makedeferredinit(name, fromname))
-				
-		elif node.type=='PROPERTY_INIT' and (node[0].type=='IDENTIFIER' or node[0].type=='STRING' or node[0].type=='NUMBER'):
-			if node[1].type=='FUNCTION':		# { x : function() }
-				env.set("this."+str(node[0].value), JSObject(node[1]))
-			elif node[1].type=='IDENTIFIER':	# { x : y }
-				temp = env.get(_crawlIdentifier(node[1], 'value'))
-				if temp:
-					env.set("this."+str(node[0].value), temp)
-			elif node[1].type=='OBJECT_INIT':		# { x : {} }
-				name = "this." + node[0].value
-				newthis = env.get(name) or JSObject()
-				env.set(name, newthis)
-				env.pushThis(newthis)
-				_crawlFunctions(env, node[1])
-				env.popThis()
-			elif node[1].type=='ARRAY_INIT':		# { x : [] }
-				name = "this." + node[0].value
-				newthis = env.get(name) or JSObject()
+			continue
+		kind, name, value = record
+		if kind == CRAWL_CONSTRUCTOR:	# name is the prototype, value the body
+			env.pushThis(name)
+			frames.append([_declarations(value), [], True])
+			continue
+		elif kind == CREATE_INSTANCE:	# value is the name of the prototype
+			env.set(name, JSObject(None, env.get(value)))
+			continue
+		declarations += 1
+		if kind == DECLARE_ELEMENT:		# [ function() ]
+			env.set(name, JSObject(value))	# create the function object
+			newthis = JSObject()			# create a blank prototype
+			env.set(name + ".prototype", newthis)
+			env.pushThis(newthis)
+			frames.append([_declarations(value), [], True])		# crawl the "constructor"
+			continue
+		type_ = value.type_
+		if type_ == jsparser.FUNCTION:
+			if kind == DECLARE_PROPERTY:	# { x : function() }
+				env.set(name, JSObject(value))
+				continue
+			newthis = env.get(name) or JSObject(value)	# create the function object
+			env.set(name, newthis)
+			name=name+".prototype"
+			newthis = env.get(name) or JSObject()			# create a blank prototype
+			env.set(name, newthis)
+			if _mayDeclare(value):
+				frame[1].append((CRAWL_CONSTRUCTOR, newthis, value.body))
+		elif type_ == jsparser.IDENTIFIER:		# x = y
+			newthis = env.get(_crawlIdentifier(value, 'value'))
+			if newthis or kind != DECLARE_PROPERTY:
 				env.set(name, newthis)
-				env.pushThis(newthis)
-				for index in range(0, len(node[1])):
-					newthis = JSObject(node[1][index])	# create the function object
-					name='this.'+str(index)
-					env.set(name, newthis)
-					name=name+".prototype"
-					newthis = JSObject()			# create a blank prototype
-					env.set(name, newthis)
-					env.pushThis(newthis)
-					_crawlFunctions(env, node[1][index])		# crawl the "constructor"
-					env.popThis()
-				env.popThis()
-	for deferred in deferredcrawling:
-		deferred()
-	return env
+		elif type_ == jsparser.OBJECT_INIT:		# x = {}
+			newthis = env.get(name) or JSObject()
+			env.set(name, newthis)
+			env.pushThis(newthis)
+			frames.append([_declarations(value), [], True])
+		elif type_ == jsparser.ARRAY_INIT:		# x = []
+			newthis = env.get(name) or JSObject()
+			env.set(name, newthis)
+			env.pushThis(newthis)
+			elements = ((DECLARE_ELEMENT, 'this.' + str(index), element) for index, element in enumerate(value))
+			frames.append([elements, [], True])
+		elif (type_ == jsparser.NEW or type_ == jsparser.NEW_WITH_ARGS) and kind == DECLARE_ASSIGN:	# x = new a
+			fromname = _crawlIdentifier(value[0], 'value') + ".prototype"
+			frame[1].append((CREATE_INSTANCE, name, fromname))
+	env.declarations += declarations
+
+def _rootName(name):
+	"""
+	Return the global variable that a dotted name starts from, which is
+	what the declarations of a library are grouped by for _crawlDemanded
+	"""
+	parts = name.split('.')
+	while len(parts) > 1 and parts[0] in ('window', 'this'):
+		del parts[0]
+	return parts[0].split('[')[0]
+
+def _writtenRoots(record):
+	"""
+	Return the global variables that crawling a declaration record could
+	write to: the one it declares, and the ones declared by the bodies
+	crawled as constructors, which are crawled with the global scope
+	"""
+	kind, name, value = record
+	roots = set([_rootName(name)])
+	if value.type_ == jsparser.FUNCTION and kind != DECLARE_PROPERTY:
+		roots.add(_rootName(name + '.prototype'))	# this = function() {}
+	pending = [record]
+	while pending:
+		kind, name, value = pending.pop()
+		if value.type_ == jsparser.FUNCTION and kind != DECLARE_PROPERTY and _mayDeclare(value):
+			for record in _declarations(value.body):
+				if not record[1].startswith('this.'):	# not the prototype
+					roots.add(_rootName(record[1]))
+				pending.append(record)
+	return roots
+
+def _references(node):
+	"""
+	Return the names of the identifiers in the value of a declaration,
+	including the bodies of the functions in it, which are parsed if they
+	were lazily parsed, as they may be crawled or inlined
+	"""
+	names = set()
+	pending = [node]
+	while pending:
+		for child in jsparser.walk([pending.pop()]):
+			if child.type_ == jsparser.IDENTIFIER:
+				names.add(child.value)
+			elif type(child) is jsparser.LazyFunction and not child.isParsed():
+				pending.append(child.body)
+	return names
+
+def _crawlDemanded(env, code, names):
+	"""
+	Crawl only the declarations of code that the given global names can
+	reach, adding them to env like _crawlFunctions
+
+	The declarations are grouped by the global variables they write to,
+	see _writtenRoots. The groups of the names are crawled, then the groups
+	of the identifiers that their values and function bodies use, and so
+	on, so the functions, their prototypes, the objects they are members
+	of and the functions they call are all there, in the order they have
+	in the library. Lazily parsed functions are only parsed when they are
+	reached or when they could declare something.
+	"""
+	records = list(_declarations(code))
+	groups = {}
+	for number, record in enumerate(records):
+		for root in _writtenRoots(record):
+			groups.setdefault(root, []).append(number)
+	wanted = set()
+	pending = list(names)
+	while pending:
+		for number in groups.pop(pending.pop(), ()):
+			if number not in wanted:
+				wanted.add(number)
+				pending.append(_rootName(records[number][1]))
+				pending.extend(_references(records[number][2]))
+	return _crawlRecords(env, (records[number] for number in sorted(wanted)))
+
+def _snippetReferences(script, inputtext):
+	"""
+	Return the global names that a snippet parsed with index=True could use
+	from the library: its identifiers and the /*:type*/ of its parameters
+	"""
+	names = set(script.nodeIndex.byName)
+	for typename in re.findall(r'\/\*\s*:\s*([a-zA-Z_$][a-zA-Z0-9_$.]*)\s*\*\/', inputtext):
+		names.add(_rootName(typename))
+	return names
+
+def _readRoots(node):
+	"""
+	Return the global variables that crawling a statement could read: the
+	identifiers in it that are not property names, other than those of
+	window and this
+	"""
+	names = set()
+	properties = set()
+	for child in jsparser.walk([node]):
+		type_ = child.type_
+		if type_ == jsparser.IDENTIFIER:
+			if id(child) not in properties:
+				names.add(child.value)
+		elif type_ == jsparser.DOT:
+			if child[0].type_ != jsparser.THIS and child[0].value != 'window':
+				properties.add(id(child[1]))
+		elif type_ == jsparser.PROPERTY_INIT:
+			properties.add(id(child[0]))
+	names.discard('window')
+	return names
+
+def _statementDigest(library, number):
+	"""
+	Return the sha1 of the source of a statement of a library, from its
+	first token up to the next statement, see jsparser.parse statementStarts
+	"""
+	starts = library.statementStarts
+	end = starts[number + 1] if number + 1 < len(starts) else len(library.sourceFile.text)
+	return hashlib.sha1(library.sourceFile.text[starts[number]:end].rstrip()).digest()
+
+def _contributions(statements, digests):
+	"""
+	Return a (digest, writes, reads) tuple for each of the statements of a
+	library: the digest of its source, and the global variables that
+	crawling it could write and read, or nothing if it declares nothing
+	The digest of the library is the sha1 of the digests of its statements
+	"""
+	contributions = []
+	for statement, digest in itertools.izip(statements, digests):
+		writes = set()
+		for record in _declarations([statement]):
+			writes.update(_writtenRoots(record))
+		if writes:
+			reads = frozenset(_readRoots(statement))
+		else:
+			reads = frozenset()
+		contributions.append((digest, frozenset(writes), reads))
+	return contributions
+
+def _libraryDigest(contributions):
+	return hashlib.sha1(''.join(digest for digest, writes, reads in contributions)).hexdigest()
 
 def _crawlCalls(namespace, code):
 	CHILD_ATTRS = ['thenPart', 'elsePart', 'expression', 'body', 'initializer']
@@ -344,6 +678,98 @@ def _crawlCalls(namespace, code):
 				ret.extend(_crawlCalls(namespace, child))
 	return ret
 
+class TextSpans:
+	"""
+	Output text kept as spans of the strings it is cut from, so that the
+	library and input text are only copied once, when the output is written
+	The spans are kept in parallel lists of texts, starts and ends, literal
+	text spans all of itself
+	"""
+	def __init__(self):
+		self.texts = []
+		self.starts = array('l')
+		self.ends = array('l')
+		self.length = 0
+		self.marked = None
+
+	def append(self, text, start=0, end=None):
+		"""
+		Add the text from start to end, which defaults to the end of the text
+		"""
+		if end is None:
+			end = len(text)
+		if start < end:
+			if self.texts and self.texts[-1] is text and self.ends[-1] == start \
+			   and len(self.texts) != self.marked:
+				self.ends[-1] = end		# carries on from the last span
+			else:
+				self.texts.append(text)
+				self.starts.append(start)
+				self.ends.append(end)
+			self.length += end - start
+
+	def extend(self, other):
+		"""
+		Add the spans of another TextSpans
+		"""
+		self.texts.extend(other.texts)
+		self.starts.extend(other.starts)
+		self.ends.extend(other.ends)
+		self.length += other.length
+
+	def mark(self):
+		"""
+		Return the position at the end of the text, for a later insert
+		"""
+		self.marked = len(self.texts)
+		return self.marked
+
+	def insert(self, index, other):
+		"""
+		Insert the spans of another TextSpans at a position returned by mark
+		Only the spans after the mark are moved, which for the Crawler are
+		the output of the statement the preamble goes in front of
+		"""
+		self.texts[index:index] = other.texts
+		self.starts[index:index] = other.starts
+		self.ends[index:index] = other.ends
+		self.length += other.length
+
+	def __len__(self):
+		return self.length
+
+	def write(self, output):
+		"""
+		Write the text to a file, without copying the long spans into strings
+		Short spans are cheaper to slice than to wrap in a buffer, so they are
+		joined and written a few thousand at a time
+		"""
+		write = output.write
+		pieces = []
+		for text, start, end in itertools.izip(self.texts, self.starts, self.ends):
+			if end - start < 256:
+				pieces.append(text[start:end])
+				if len(pieces) >= 4096:
+					write(''.join(pieces))
+					del pieces[:]
+			else:
+				if pieces:
+					write(''.join(pieces))
+					del pieces[:]
+				if start or end != len(text):
+					text = buffer(text, start, end - start)
+				write(text)
+		if pieces:
+			write(''.join(pieces))
+
+	def getvalue(self):
+		"""
+		Return the text as a single string
+		"""
+		output = cStringIO.StringIO()
+		self.write(output)
+		return output.getvalue()
+
 def inlineFunction(librarytext, function, arguments, retval):
 	params=function.params
 	replacements={}
@@ -355,7 +781,8 @@ def replaceIdentifiers(librarytext, body, replacements, retval, forceretval):
 	"""
 	Given a jsparse'd body object and a map of replacements,
 	replace any identifiers that are found in the replacements map
-	and return the body as a flat string
+	and return a walker whose .output holds the body as TextSpans of
+	librarytext, .getOutput() flattens it to a string
 	If it is a function, special code happens for the return
 	Note: Only supports a single return as the last line of the function, if any return at all
 
@@ -364,574 +791,1368 @@ def replaceIdentifiers(librarytext, body, replacements, retval, forceretval):
 		The retval passed to the replaceIdentifiers function can be None, in which case any return lines are deleted
 			This is used for calls that don't use the return
 	If it is a function that does not return stuff, .needsRetVal == False
+
+	To inline the same body more than once, compile it into a Template
 	"""
 	#print("Inlining function with args "+str(replacements))
-	class Replacer():
-		CHILD_ATTRS = ['thenPart', 'elsePart', 'expression', 'body', 'initializer']
-		def __init__(self):
-			self.output=[]
-			if len(body):
-				firstline=body[0]
-			else:
-				firstline=body
-			self.inputoffset=firstline.start
-			self.librarytext=librarytext
-			self.retval=retval
-
-			if (forceretval or firstline.type!='RETURN') and retval != None:
-				self.needsRetVal=True
-				self.output.append('var %s = undefined;\n'%retval)
-			else:
-				self.needsRetVal=False
-			#print("Looking at code "+str(body))
-			if len(body):
-				self.walkbranch(body, True)
+	return Replacer(librarytext, body, replacements, retval, forceretval)
+
+class Template:
+	"""
+	A body compiled for inlining with any values of some replacements:
+	the text between the places where their values and the return
+	variable go, so that expanding it is a single join
+	It is made by walking the body once, with a Replacer that notes those
+	places instead of writing the values
+	"""
+	def __init__(self, librarytext, body, names, retval, forceretval):
+		slots = []
+		walker = Replacer(librarytext, body, dict((name, name) for name in names), retval, forceretval, slots)
+		self.needsRetVal = walker.needsRetVal
+		output = walker.output
+		spans = itertools.izip(output.texts, output.starts, output.ends)
+		self.parts = []
+		self.slots = []		# the index in parts and name of each slot
+		last = 0
+		for index, name in slots + [(len(output.texts), None)]:
+			self.parts.append(''.join(text[start:end] for text, start, end in itertools.islice(spans, index - last)))
+			self.slots.append((len(self.parts), name))
+			self.parts.append(None)
+			last = index
+		del self.slots[-1], self.parts[-1]
+		self.literalNames = None
+
+	def names(self):
+		"""
+		Return the names in the text of the template outside of its slots,
+		along with words that only look like names, in strings and the like
+		"""
+		if self.literalNames is None:
+			text = ''.join(part for part in self.parts if part is not None)
+			self.literalNames = frozenset(re.findall(r'[a-zA-Z_$][a-zA-Z0-9_$]*', text))
+		return self.literalNames
+
+	def expand(self, replacements, retval):
+		"""
+		Return the body with the values of the replacements and the return
+		variable, which are the same names the template was compiled for
+		"""
+		parts = self.parts[:]
+		for index, name in self.slots:
+			if name is None:
+				parts[index] = retval
 			else:
-				self.walkstatement(body)
-			#print("Replaced params: "+self.librarytext[oldoffset:self.inputoffset])
+				parts[index] = str(replacements[name])
+		return ''.join(parts)
 
-		def walkbranch(self, branch, top):
-			for statement in branch:
-				self.walkstatement(statement)
-			if self.inputoffset < branch.end:
-				if top:
-					end = branch[len(branch)-1].end		# point to the end of the last statement of the block, to trim off the semicolon and any whitespace
-				else:
-					end = branch.end					# point to the end of the block
-				#print("appending "+self.librarytext[self.inputoffset:branch.end])
-				self.output.append(self.librarytext[self.inputoffset:end])
-				self.inputoffset=end
-
-		def walkstatement(self, statement):
-			#print("Looking at statement "+str(statement))
-			quitnow=False
-			if statement.type == "RETURN":
-				self.output.append(self.librarytext[self.inputoffset:statement.start])
-				if not isinstance(statement.value, jsparser.Node):
-					self.inputoffset = statement.end
-					return		# not actually returning any value
-				self.inputoffset=statement.value.start
-				if self.needsRetVal and retval != None:
-					self.output.append("%s = "%retval)
-					self.walkexpression(statement.value)
-					self.output.append(self.librarytext[self.inputoffset:statement.end])
-					self.inputoffset = statement.end
-					self.output.append(";\n")
-				else:
-					self.walkexpression(statement.value)
-				quitnow = True
-			elif statement.type == 'CALL':
-				self.replaceIdentifier(statement[0])	# possibly replace the function name
-				self.walkexpression(statement[1])	# replace any replacements to the function
-				quitnow=True
-			elif statement.type == 'IF':
-				self.walkexpression(statement.condition)
-				if statement.thenPart:
-					if len(statement.thenPart):
-						self.walkbranch(statement.thenPart, False)
-					else:
-						self.walkstatement(statement.thenPart)
-				if statement.elsePart:
-					if len(statement.elsePart):
-						self.walkbranch(statement.elsePart, False)
-					else:
-						self.walkstatement(statement.elsePart)
-				quitnow=True
-			elif statement.type == 'FOR':
-				self.walkstatement(statement.setup)
-				self.walkexpression(statement.condition)
-				self.walkexpression(statement.update)
-				if len(statement.body):
-					if statement.body.type=='VAR':
-						self.walkstatement(statement.body)
+def functionTemplate(env, function, replacements, retval, forceretval):
+	"""
+	Return the Template of a library function's body for the names of
+	these replacements, compiled the first time it is wanted and then kept
+	in env.templates, which holds on to the function so its id isn't reused
+	"""
+	key = (id(function), frozenset(replacements), retval is not None, forceretval)
+	try:
+		return env.templates[key][1]
+	except KeyError:
+		template = Template(function.sourceFile.text, function.body, replacements, retval, forceretval)
+		env.templates[key] = (function, template)
+		return template
+
+class Replacer(Visitor):
+	"""
+	The walker behind replaceIdentifiers
+	"""
+	CHILD_ATTRS = ['thenPart', 'elsePart', 'expression', 'body', 'initializer']
+	def __init__(self, librarytext, body, replacements, retval, forceretval, slots=None):
+		self.output=TextSpans()
+		self.slots=slots
+		if len(body):
+			firstline=body[0]
+		else:
+			firstline=body
+		self.inputoffset=firstline.start
+		self.librarytext=librarytext
+		self.replacements=replacements
+		self.retval=retval
+
+		if (forceretval or firstline.type!='RETURN') and retval != None:
+			self.needsRetVal=True
+			self.output.append('var ')
+			self.slot(None, retval)
+			self.output.append(' = undefined;\n')
+		else:
+			self.needsRetVal=False
+		#print("Looking at code "+str(body))
+		if len(body):
+			jsparser.trampoline(self.walkbranch(body, True))
+		else:
+			jsparser.trampoline(self.walkstatement(body))
+		#print("Replaced params: "+self.librarytext[oldoffset:self.inputoffset])
+
+	# The walk methods are generators run by jsparser.trampoline, so
+	# that deeply nested bodies don't use up the stack
+	def walkbranch(self, branch, top):
+		for statement in branch:
+			yield self.walkstatement(statement)
+		if self.inputoffset < branch.end:
+			if top:
+				end = branch[len(branch)-1].end		# point to the end of the last statement of the block, to trim off the semicolon and any whitespace
+			else:
+				end = branch.end					# point to the end of the block
+			#print("appending "+self.librarytext[self.inputoffset:branch.end])
+			self.output.append(self.librarytext, self.inputoffset, end)
+			self.inputoffset=end
+
+	def walkstatement(self, statement):
+		#print("Looking at statement "+str(statement))
+		quitnow = yield self.dispatch(self.statementHandlers, statement)
+		if not quitnow:
+			for attr in Replacer.CHILD_ATTRS:
+				child = getattr(statement, attr, None)
+				if child and isinstance(child, jsparser.Node):
+					if hasattr(child, 'expression'):
+						yield self.walkexpression(child.expression)
+					elif len(child):
+						yield self.walkbranch(child, False)
 					else:
-						self.walkbranch(statement.body, False)
-				else:
-					self.walkstatement(statement.body)
-				quitnow=True
-			elif statement.type == 'SEMICOLON':
-				if statement.expression:	# not spurious semicolon
-					self.walkexpression(statement.expression)
-				quitnow=True
-			elif statement.type == 'VAR':
-				if hasattr(statement[0], 'initializer'):
-					self.walkexpression(statement[0].initializer)
-					statement.end=statement[0].initializer.end
-			elif statement.type == 'SWITCH':
-				if hasattr(statement, 'cases'):
-					for case in statement.cases:
-						self.walkbranch(case.statements, False)
-			if not quitnow:
-				for attr in Replacer.CHILD_ATTRS:
-					child = getattr(statement, attr, None)
-					if child and isinstance(child, jsparser.Node):
-						if hasattr(child, 'expression'):
-							self.walkexpression(child.expression)
-						elif len(child):
-							self.walkbranch(child, False)
-						else:
-							self.walkstatement(child)
-			if self.inputoffset < statement.end:
-				#print("Setting offset to "+str(statement.end))
-				self.output.append(self.librarytext[self.inputoffset:statement.end])
-				self.inputoffset=statement.end
-
-		def walkexpression(self, expression):
-			if expression.type == 'ASSIGN':
-				destination = _crawlIdentifier(expression[0], 'value')
-				if destination in replacements.keys():
-					del replacements[destination]
-			if len(expression):
-				for piece in expression:
-					self.walkexpressionpiece(piece)
+						yield self.walkstatement(child)
+		if self.inputoffset < statement.end:
+			#print("Setting offset to "+str(statement.end))
+			self.output.append(self.librarytext, self.inputoffset, statement.end)
+			self.inputoffset=statement.end
+
+	# The statement handlers yield True when they have walked the children
+	# of the statement themselves
+	def walkreturn(self, statement):
+		self.output.append(self.librarytext, self.inputoffset, statement.start)
+		if not isinstance(statement.value, jsparser.Node):
+			self.inputoffset = statement.end
+			yield True		# not actually returning any value
+		self.inputoffset=statement.value.start
+		if self.needsRetVal and self.retval != None:
+			self.slot(None, self.retval)
+			self.output.append(" = ")
+			yield self.walkexpression(statement.value)
+			self.output.append(self.librarytext, self.inputoffset, statement.end)
+			self.inputoffset = statement.end
+			self.output.append(";\n")
+		else:
+			yield self.walkexpression(statement.value)
+		yield True
+
+	def walkcallstatement(self, statement):
+		self.replaceIdentifier(statement[0])	# possibly replace the function name
+		yield self.walkexpression(statement[1])	# replace any replacements to the function
+		yield True
+
+	def walkif(self, statement):
+		yield self.walkexpression(statement.condition)
+		if statement.thenPart:
+			if len(statement.thenPart):
+				yield self.walkbranch(statement.thenPart, False)
 			else:
-				self.walkexpressionpiece(expression)
-		def walkexpressionpiece(self, piece):
-			#print("Looking at expression piece "+str(piece))
-			if piece.type=='IDENTIFIER' or piece.type=='THIS':
-				self.replaceIdentifier(piece)
-			elif piece.type=='CALL':
-				self.walkexpression(piece)
-			elif piece.type=='STRING':
-				pass
-			elif piece.type=='RETURN':
-				if isinstance(piece.value, jsparser.Node):
-					self.walkexpressionpiece(piece.value)
-			elif piece.type=='LIST':
-				if len(piece):
-					self.walkexpression(piece)
-			elif piece.type=='NUMBER':
-				pass
-			elif piece.type=='IF':
-				self.walkstatement(piece)
-			elif piece.type in ['TRUE', 'FALSE']:
-				pass
-			elif piece.type=='NULL':
-				pass
-			elif piece.type=='DOT':					# don't replace identifiers that are after a dot
-				self.walkexpressionpiece(piece[0])
-			elif piece.type=='ARRAY_INIT':
-				if len(piece):
-					self.walkexpression(piece)
-			elif piece.type=='OBJECT_INIT':
-				if len(piece):
-					self.walkexpression(piece)
-			elif piece.type=='PROPERTY_INIT':			# don't replace identifiers that are the keys of {}
-				self.walkexpressionpiece(piece[1])
-			elif len(piece):
-				self.walkexpression(piece)
-			elif hasattr(piece, 'expression'):
-				self.walkexpressionpiece(piece.expression)
+				yield self.walkstatement(statement.thenPart)
+		if statement.elsePart:
+			if len(statement.elsePart):
+				yield self.walkbranch(statement.elsePart, False)
 			else:
-				#import pdb; pdb.set_trace()
-				print("unknown type of piece: "+str(piece))
+				yield self.walkstatement(statement.elsePart)
+		yield True
+
+	def walkfor(self, statement):
+		yield self.walkstatement(statement.setup)
+		yield self.walkexpression(statement.condition)
+		yield self.walkexpression(statement.update)
+		if len(statement.body):
+			if statement.body.type=='VAR':
+				yield self.walkstatement(statement.body)
+			else:
+				yield self.walkbranch(statement.body, False)
+		else:
+			yield self.walkstatement(statement.body)
+		yield True
+
+	def walksemicolon(self, statement):
+		if statement.expression:	# not spurious semicolon
+			yield self.walkexpression(statement.expression)
+		yield True
+
+	def walkvar(self, statement):
+		if hasattr(statement[0], 'initializer'):
+			yield self.walkexpression(statement[0].initializer)
+			statement.end=statement[0].initializer.end
+		yield False
+
+	def walkswitch(self, statement):
+		if hasattr(statement, 'cases'):
+			for case in statement.cases:
+				yield self.walkbranch(case.statements, False)
+		yield False
+
+	statementHandlers = dispatchTable({
+		'RETURN': walkreturn, 'CALL': walkcallstatement, 'IF': walkif,
+		'FOR': walkfor, 'SEMICOLON': walksemicolon, 'VAR': walkvar,
+		'SWITCH': walkswitch,
+	})
+
+	def walkexpression(self, expression):
+		if expression.type_ == jsparser.ASSIGN:
+			destination = _crawlIdentifier(expression[0], 'value')
+			if destination in self.replacements:
+				del self.replacements[destination]
+		if len(expression):
+			for piece in expression:
+				yield self.dispatch(self.pieceHandlers, piece)
+		else:
+			yield self.dispatch(self.pieceHandlers, expression)
+
+	def walkidentifier(self, piece):
+		self.replaceIdentifier(piece)
+		yield None
+
+	def walkcall(self, piece):
+		yield self.walkexpression(piece)
+
+	def walkreturnpiece(self, piece):
+		if isinstance(piece.value, jsparser.Node):
+			yield self.dispatch(self.pieceHandlers, piece.value)
 
-		def replaceIdentifier(self, identifier):
-			if identifier.value in replacements.keys():
-				self.output.append(self.librarytext[self.inputoffset:identifier.start])
-				self.output.append(str(replacements[identifier.value]))
-				self.inputoffset = identifier.end
+	def walkifpiece(self, piece):
+		yield self.walkstatement(piece)
 
-		def getOutput(self):
-			return ''.join(self.output)
+	def walkdot(self, piece):				# don't replace identifiers that are after a dot
+		yield self.dispatch(self.pieceHandlers, piece[0])
 
-	walker = Replacer()
-	return walker
+	def walkproperty(self, piece):			# don't replace identifiers that are the keys of {}
+		yield self.dispatch(self.pieceHandlers, piece[1])
 
+	def walkpiece(self, piece):
+		if len(piece):
+			yield self.walkexpression(piece)
+		elif isinstance(getattr(piece, 'expression', None), jsparser.Node):
+			yield self.dispatch(self.pieceHandlers, piece.expression)
+
+	# Pieces of other types, and leaves like strings and numbers, are walked
+	# for any children by walkpiece
+	pieceHandlers = dispatchTable({
+		'IDENTIFIER THIS': walkidentifier, 'CALL': walkcall,
+		'RETURN': walkreturnpiece, 'IF': walkifpiece, 'DOT': walkdot,
+		'PROPERTY_INIT': walkproperty,
+	}, walkpiece)
+
+	def replaceIdentifier(self, identifier):
+		if identifier.value in self.replacements:
+			self.output.append(self.librarytext, self.inputoffset, identifier.start)
+			self.slot(identifier.value, self.replacements[identifier.value])
+			self.inputoffset = identifier.end
+
+	def slot(self, name, value):
+		"""
+		Add the value of a replacement, or of the return variable if the name
+		is None, or when compiling a Template note where it goes in slots
+		"""
+		if self.slots is None:
+			self.output.append(str(value))
+		else:
+			self.slots.append((self.output.mark(), name))
+
+	def getOutput(self):
+		return self.output.getvalue()
+
+
+class LibraryCache:
+	"""
+	A directory of parsed libraries along with their crawled environments,
+	so that warm starts don't have to parse and crawl the library again
+
+	Entries are keyed by a hash of the library text and the parser version.
+	Once the directory grows past maxsize bytes, the least recently used
+	entries are deleted.
+
+	Loading an entry unpickles it, which can run any code, so the directory
+	is created private to the user, and OSError is raised for one that
+	anybody else could write entries into.
+	"""
+	def __init__(self, directory, maxsize=64*1024*1024):
+		self.directory = directory
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		if not os.path.isdir(directory):
+			os.makedirs(directory, 0700)
+		info = os.lstat(directory)
+		if os.path.islink(directory) or info.st_uid != os.getuid() or info.st_mode & 022:
+			raise OSError('%s is not a private directory' % directory)
+
+	def path(self, librarytext):
+		"""
+		Return the filename of the cache entry for this library
+		"""
+		key = hashlib.sha1('%s %s\n' % (jsparser.__version__, CACHE_VERSION))
+		key.update(librarytext)
+		return os.path.join(self.directory, key.hexdigest() + '.cache')
+
+	def load(self, librarytext):
+		"""
+		Return the cached (library, env) for this library text, or None
+		"""
+		path = self.path(librarytext)
+		try:
+			entry = file(path, 'rb')
+			try:
+				library, env = cPickle.loads(zlib.decompress(entry.read()))
+			finally:
+				entry.close()
+			os.utime(path, None)	# mark it as recently used
+		except (IOError, OSError, EOFError, zlib.error, cPickle.UnpicklingError):
+			self.misses += 1
+			return None
+		self.hits += 1
+		return library, env
+
+	def save(self, librarytext, library, env):
+		"""
+		Save the parsed library and its environment, then evict old entries
+		Libraries that can not be cached, such as ones nested too deeply to
+		pickle, are skipped
+		"""
+		try:
+			data = zlib.compress(cPickle.dumps((library, env), cPickle.HIGHEST_PROTOCOL))
+		except RuntimeError:
+			return
+		try:
+			fd, temppath = tempfile.mkstemp('.tmp', '', self.directory)
+			try:
+				os.write(fd, data)
+			finally:
+				os.close(fd)
+			os.rename(temppath, self.path(librarytext))
+			self.evict()
+		except (IOError, OSError):
+			pass
+
+	def evict(self):
+		"""
+		Delete the least recently used entries until the cache fits maxsize
+		"""
+		entries = []
+		total = 0
+		for name in os.listdir(self.directory):
+			if not name.endswith('.cache'):
+				continue
+			path = os.path.join(self.directory, name)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue	# removed by another process
+			entries.append((stat.st_mtime, stat.st_size, path))
+			total += stat.st_size
+		entries.sort()
+		for mtime, size, path in entries:
+			if total <= self.maxsize:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total -= size
+
+def loadLibrary(librarytext, cache=None, oldlibrarytext=None):
+	"""
+	Parse the library and crawl it for its functions
+	Returns the parsed library and the environment of its functions
+	If a LibraryCache is given, it is used instead of parsing when possible
+	If the library is an edit of oldlibrarytext and that one is cached, only
+	the edited statements are parsed and crawled again, see reloadLibrary
+	"""
+	old = None
+	if cache:
+		loaded = cache.load(librarytext)
+		if loaded:
+			return loaded
+		if oldlibrarytext and oldlibrarytext != librarytext:
+			old = cache.load(oldlibrarytext)
 
-def inlineSingle(inputtext, librarytext):
 	window = JSObject()
 	window['window'] = window
 	env = JSEnvironment(window, window)	# window is root and this
 
-	library = jsparser.parse(librarytext)
+	if old:
+		library, env = reloadLibrary(old[0], old[1], librarytext)
+	else:
+		library = jsparser.parse(librarytext, lazy=True)
+		_crawlFunctions(env, library)
 
-	functions = _crawlFunctions(env, library)
+	if cache:
+		cache.save(librarytext, library, env)
+	return library, env
 
-	class Crawler():
-		CHILD_ATTRS = ['thenPart', 'elsePart', 'expression', 'body', 'initializer']
-		def __init__(self, inputtext, librarytext, library):
-			self.inputoffset = 0
-			self.output = []
-			self.inputtext = inputtext
-			script = jsparser.parse(inputtext)
-			self.librarytext = librarytext
-			self.library = library
-			self.crawlingSwitchDefault = False
+def reloadLibrary(library, env, librarytext):
+	"""
+	Update a library and environment made by loadLibrary, changing both in
+	place, to an edited version of the library text
+	Returns the library and environment
+
+	Only the statements in the edited region are parsed again, see
+	jsparser.reparse, and only the global variables that the edit could
+	change are crawled again: the ones that edited statements write or
+	read, then the ones that the statements writing or reading those write
+	or read, and so on. They are removed from the environment and all of
+	the statements that write or read them are crawled again, in order,
+	so everything is as if the whole library had been crawled. Statements
+	are compared by the digests of their source, see _contributions, and
+	env.libraryDigest is the digest of the whole library.
+	"""
+	if env.contributions is None:
+		digests = (_statementDigest(library, number) for number in range(len(library)))
+		env.contributions = _contributions(library, digests)
+		env.libraryDigest = _libraryDigest(env.contributions)
+	old = env.contributions
+	statements = list(library)
+	starts = list(library.statementStarts)
+	library = jsparser.reparse(library, librarytext, lazy=True)
+	count = len(library)
+
+	# The statements before and after the edited ones are unchanged: the
+	# ones that reparse kept, and the ones that it parsed again that are
+	# the same source, which are put back where they are now, as the
+	# environment has their functions
+	kept = []
+	def unchanged(number, newnumber):
+		if library[newnumber] is statements[number]:
+			return True
+		if _statementDigest(library, newnumber) != old[number][0]:
+			return False
+		jsparser.shift([statements[number]], library.statementStarts[newnumber] - starts[number])
+		library[newnumber] = statements[number]
+		kept.append(statements[number])
+		return True
+	prefix = 0
+	while prefix < min(len(old), count) and unchanged(prefix, prefix):
+		prefix += 1
+	suffix = 0
+	while suffix < min(len(old), count) - prefix and unchanged(len(old) - 1 - suffix, count - 1 - suffix):
+		suffix += 1
+	if kept:
+		# the declarations in the statements put back are their nodes too,
+		# which are where the parsed ones are now that they are shifted
+		nodes = dict(((node.start, node.type_), node) for node in jsparser.walk(kept))
+		library.funDecls = [nodes.get((node.start, node.type_), node) for node in library.funDecls]
+		library.varDecls = [nodes.get((node.start, node.type_), node) for node in library.varDecls]
+	if prefix + suffix == len(old) == count:
+		return library, env
+	env.templates.clear()		# the edited functions are new nodes
+	env.expanded.clear()
+	digests = (_statementDigest(library, number) for number in range(prefix, count - suffix))
+	edited = _contributions(library[prefix:count - suffix], digests)
+	new = old[:prefix] + edited + old[len(old) - suffix:]
+	env.contributions = new
+	env.libraryDigest = _libraryDigest(new)
+
+	writers = {}
+	readers = {}
+	for number, (digest, writes, reads) in enumerate(new):
+		for root in writes:
+			writers.setdefault(root, []).append(number)
+		for root in reads:
+			readers.setdefault(root, []).append(number)
+	pending = set()
+	for digest, writes, reads in old[prefix:len(old) - suffix]:
+		pending.update(writes)
+	for digest, writes, reads in edited:
+		pending.update(writes)
+		pending.update(root for root in reads if root in writers)
+	changed = set()
+	wanted = set()
+	while pending:
+		root = pending.pop()
+		if root in changed:
+			continue
+		changed.add(root)
+		for number in writers.get(root, []) + readers.get(root, []):
+			if number not in wanted:
+				wanted.add(number)
+				pending.update(new[number][1])
+				pending.update(root for root in new[number][2] if root in writers)
+
+	if 'window' in changed:		# the global object itself
+		for root in env.root.keys():
+			del env.root[root]
+		env.root['window'] = env.root
+		wanted = range(len(new))
+	else:
+		for root in changed:
+			del env.root[root]
+	_crawlRecords(env, (record for number in sorted(wanted) for record in _declarations([library[number]])))
+	return library, env
 
-			self.preput = ''
-
-			self.walkbranch(script)
-
-		def parsefunctiontypes(self, string):
-			"""
-			Given a string such as variable/*:type*/, othervar /* :mytype */,
-			return a dictionary like {variable:'type', othervar:'mytype'}
-			"""
-			ret = {}
-			params = string.split(',')
-			for param in params:
-				match = re.match(r'([a-zA-Z_$][a-zA-Z0-9_$]*)\s*\/\*\s*:\s*([a-zA-Z_$][a-zA-Z0-9_$.]*)\s*\*\/', param)
-				if match is None:
-					continue
-				groups = match.groups()
-				ret[groups[0]] = groups[1]
-			return ret
-
-		def walkbranch(self, branch):
-			#import pdb; pdb.set_trace()
-			if not getattr(branch, 'end', None):
-				branch.end = len(inputtext)
-			if len(branch):
-				for statement in branch:
-					self.walkstatement(statement)
-			else:
-				self.walkstatement(branch)
-			self.output.append(self.inputtext[self.inputoffset:branch.end])
-			self.inputoffset=branch.end
-
-		def walkstatement(self, statement):
-			#print("Looking at statement "+str(statement))
-			self.statementCalls = []
-			if statement.type == "VAR":	# create a new variable
-				child = getattr(statement[0], 'initializer', None)
-				if child:
-					name = _crawlIdentifier(statement[0], 'value')
-					self.callcount = 0
-					self.preput = ''
-					self.output.append(self.inputtext[self.inputoffset:statement.start])
-					self.inputoffset = statement.start
-					index = len(self.output)
-					self.walkexpression(child, name, True)
-					if len(self.preput)>0:
-						self.output.insert(index, self.preput)
-			elif statement.type == 'SEMICOLON':
-				child = getattr(statement, 'expression', None)
-				if child:
-					if statement.expression.type=='ASSIGN':
-						name = _crawlIdentifier(statement.expression[0], 'value')
-					else:
-						name = statement.value
-					self.callcount = 0
-					self.preput = ''
-					self.output.append(self.inputtext[self.inputoffset:statement.start])
-					self.inputoffset=statement.start
-					index = len(self.output)
-					self.walkexpression(child, name, True if statement.expression.type=='ASSIGN' else False)
-					if len(self.preput)>0:
-						self.output.insert(index, self.preput)
-				return
-			elif statement.type == 'CALL':
-				self.replacefunction(statement, statement[0].value)
-				return
-			elif statement.type == 'FOR':
-				worked = self.unloopFor(statement)
-				if not worked:
-					self.walkbranch(statement.body)
-				return
-			elif statement.type == 'SWITCH':
-				for case in statement.cases:
-					if statement.defaultIndex>=0 and case == statement.cases[statement.defaultIndex]:
-						self.crawlingSwitchDefault = True
-					self.walkbranch(case.statements)
-					self.crawlingSwitchDefault = False
-			#else:
-				#print("Unknown type of statement: "+str(statement))
+def loadDemanded(librarytext, script, inputtext):
+	"""
+	Parse the library and crawl only the declarations that the snippet
+	inputtext, parsed as script with index=True, could reach
+	Returns the parsed library and the environment of those functions
+	For small snippets of huge libraries, this skips most of the crawl and
+	the parsing of most function bodies, see _crawlDemanded
+	"""
+	window = JSObject()
+	window['window'] = window
+	env = JSEnvironment(window, window)	# window is root and this
+
+	library = jsparser.parse(librarytext, lazy=True)
+	_crawlDemanded(env, library, _snippetReferences(script, inputtext))
+	return library, env
+
+def _parseLibraryFile(filename):
+	"""
+	Parse a library file in a worker process, returning the pickled tree
+	Returns None if the file could not be parsed or pickled, the parent
+	then parses it again to raise the error, or to keep a tree that is
+	nested too deeply to pickle
+	"""
+	try:
+		tree = jsparser.parse(file(filename, 'r').read(), filename, lazy=True)
+		return cPickle.dumps(tree, cPickle.HIGHEST_PROTOCOL)
+	except Exception:
+		return None
+
+def parseLibraryFiles(filenames, processes=None):
+	"""
+	Parse library files in a pool of processes, one file at a time
+	Returns the trees in the order of the files
+	processes defaults to the number of CPUs, with a single process the
+	files are parsed in this one
+	"""
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	results = [None] * len(filenames)
+	if min(processes, len(filenames)) > 1:
+		# start on the biggest files, so that one isn't left running at the end
+		order = sorted(range(len(filenames)), key=lambda index: -os.path.getsize(filenames[index]))
+		pool = multiprocessing.Pool(min(processes, len(filenames)))
+		try:
+			pickled = pool.map(_parseLibraryFile, [filenames[index] for index in order], 1)
+		finally:
+			pool.close()
+			pool.join()
+		for index, result in zip(order, pickled):
+			results[index] = result
+	trees = []
+	for filename, result in zip(filenames, results):
+		if result is None:
+			trees.append(jsparser.parse(file(filename, 'r').read(), filename, lazy=True))
+		else:
+			trees.append(cPickle.loads(result))
+	return trees
+
+def loadLibraryFiles(filenames, processes=None):
+	"""
+	Parse the library files in a pool of processes, then crawl their
+	statements together, as if the files had been concatenated
+	Returns the list of parsed files and the environment of their functions
+	"""
+	trees = parseLibraryFiles(filenames, processes)
+	window = JSObject()
+	window['window'] = window
+	env = JSEnvironment(window, window)	# window is root and this
+	_crawlFunctions(env, [statement for tree in trees for statement in tree])
+	return trees, env
+
+def inlineSingle(inputtext, librarytext, cache=None, oldlibrarytext=None, output=None, demand=False):
+	"""
+	Inline the calls in inputtext to the functions of the library
+	Returns the inlined text, or if an output file is given writes it there
+	without building the whole text as a string
+	If demand is set and there is no cache, only the declarations of the
+	library that the snippet could reach are crawled, see loadDemanded
+	"""
+	if demand and not cache:
+		script = jsparser.parse(inputtext, index=True)
+		library, env = loadDemanded(librarytext, script, inputtext)
+		return _inline(inputtext, library, env, output, script)
+	library, env = loadLibrary(librarytext, cache, oldlibrarytext)
+	return _inline(inputtext, library, env, output)
+
+def inlineAll(inputtext, librarytext, cache=None, oldlibrarytext=None, output=None, passes=16, maxsize=None, expand=False):
+	"""
+	Inline the calls in inputtext to the functions of the library, then
+	the calls in the inlined code, and so on, until nothing more changes or
+	after the given number of passes, or once the text is longer than
+	maxsize characters, see _inlineAll
+	If expand is set, the library functions are inlined with the calls in
+	their bodies already inlined, bottom up, see _expandFunction, which
+	leaves fewer calls for the later passes
+	The output is returned or written as by inlineSingle
+	"""
+	library, env = loadLibrary(librarytext, cache, oldlibrarytext)
+	return _inlineAll(inputtext, library, env, output, passes, maxsize, expand)
+
+def inlineFiles(inputtext, filenames, processes=None, output=None):
+	"""
+	Inline the calls in inputtext to the functions of the library files
+	The files are parsed in a pool of processes, see parseLibraryFiles
+	The output is returned or written as by inlineSingle
+	"""
+	library, env = loadLibraryFiles(filenames, processes)
+	return _inline(inputtext, library, env, output)
+
+class Inliner:
+	"""
+	A library parsed and crawled once, for inlining any number of snippets
+	against it, where inlineSingle would load the library for each one
+
+	The library is loaded from its text, using a LibraryCache if given, or
+	from files like inlineFiles. The environment keeps the names it has
+	resolved between snippets, see JSEnvironment.get.
+	"""
+	def __init__(self, librarytext=None, filenames=None, cache=None, processes=None):
+		if filenames is not None:
+			self.library, self.env = loadLibraryFiles(filenames, processes)
+		else:
+			self.library, self.env = loadLibrary(librarytext, cache)
+
+	def inline(self, inputtext, output=None):
+		"""
+		Inline the calls in inputtext to the functions of the library
+		The output is returned or written as by inlineSingle
+		"""
+		return self.run(_inline, inputtext, self.library, self.env, output)
+
+	def inlineAll(self, inputtext, output=None, passes=16, maxsize=None, expand=False):
+		"""
+		Inline the calls in inputtext until nothing more changes, as inlineAll
+		The expanded library functions are kept for the next snippets
+		"""
+		return self.run(_inlineAll, inputtext, self.library, self.env, output, passes, maxsize, expand)
+
+	def run(self, inline, *args):
+		"""
+		Run an inline function on the library, then leave the environment
+		as it was
+		"""
+		# Snippets only push scopes and this objects while they are walked,
+		# but one that fails part way must not leave them for the next one
+		this = len(self.env.this)
+		scopes = len(self.env.scopes)
+		try:
+			return inline(*args)
+		finally:
+			if len(self.env.this) != this or len(self.env.scopes) != scopes:
+				del self.env.this[this:]
+				del self.env.scopes[scopes:]
+				self.env.invalidate()
+
+	def inlineMany(self, inputtexts):
+		"""
+		Inline each of the snippets, returning the list of inlined texts
+		"""
+		return [self.inline(inputtext) for inputtext in inputtexts]
+
+class Crawler(Visitor):
+	"""
+	The walker behind _inline, which copies the snippet inputtext to its
+	output with the calls to the functions in env inlined
+	"""
+	CHILD_ATTRS = ['thenPart', 'elsePart', 'expression', 'body', 'initializer']
+	function = None		# the library function being expanded, see FunctionCrawler
+	def __init__(self, inputtext, library, env, script=None, statements=None, expand=False):
+		self.env = env
+		self.expand = expand		# inline the expanded bodies, see _expandFunction
+		self.inputoffset = 0
+		self.output = TextSpans()
+		self.inputtext = inputtext
+		if script is None:
+			script = jsparser.parse(inputtext, index=True)
+		self.script = script
+		self.statements = statements
+		self.library = library
+		self.crawlingSwitchDefault = False
+		self.changes = 0		# the calls and loops replaced so far
+		self.changed = []		# the top level statements that changed, see walktop
+
+		self.preput = TextSpans()
+
+		jsparser.trampoline(self.walkbranch(script))
+
+	def parsefunctiontypes(self, string):
+		"""
+		Given a string such as variable/*:type*/, othervar /* :mytype */,
+		return a dictionary like {variable:'type', othervar:'mytype'}
+		"""
+		ret = {}
+		params = string.split(',')
+		for param in params:
+			match = re.match(r'([a-zA-Z_$][a-zA-Z0-9_$]*)\s*\/\*\s*:\s*([a-zA-Z_$][a-zA-Z0-9_$.]*)\s*\*\/', param)
+			if match is None:
+				continue
+			groups = match.groups()
+			ret[groups[0]] = groups[1]
+		return ret
+
+	# The walk methods are generators run by jsparser.trampoline, so
+	# that deeply nested snippets don't use up the stack
+	def walkbranch(self, branch):
+		#import pdb; pdb.set_trace()
+		if not getattr(branch, 'end', None):
+			branch.end = len(self.inputtext)
+		if branch is self.script:
+			for number, statement in enumerate(branch):
+				if self.mayChange(number):
+					yield self.walktop(number, statement)
+		elif len(branch):
+			for statement in branch:
+				yield self.walkstatement(statement)
+		else:
+			yield self.walkstatement(branch)
+		self.output.append(self.inputtext, self.inputoffset, branch.end)
+		self.inputoffset=branch.end
+
+	def mayChange(self, number):
+		"""
+		Whether the top level statement with this number has any calls
+		or loops that could be inlined, the statements without are
+		copied as they are, as are the ones not in self.statements.
+		Without a nodeIndex every statement could.
+		"""
+		if self.statements is not None and number not in self.statements:
+			return False
+		starts = self.script.statementStarts
+		start = starts[number]
+		end = starts[number + 1] if number + 1 < len(starts) else len(self.inputtext)
+		index = self.script.nodeIndex
+		if index is None:
+			return True
+		return index.contains('CALL', start, end) or index.contains('FOR', start, end)
+
+	def walktop(self, number, statement):
+		"""
+		Walk a top level statement, adding its number and the offsets where
+		its output starts and ends to self.changed if anything in it was
+		replaced
+		"""
+		# The input text up to the statement and after the last replacement
+		# in it is copied as it is
+		starts = self.script.statementStarts
+		start = len(self.output) + starts[number] - self.inputoffset
+		changes = self.changes
+		yield self.walkstatement(statement)
+		if self.changes != changes:
+			end = starts[number + 1] if number + 1 < len(starts) else len(self.inputtext)
+			self.changed.append((number, start, len(self.output) + end - self.inputoffset))
+
+	def walkstatement(self, statement):
+		#print("Looking at statement "+str(statement))
+		self.statementCalls = []
+		done = yield self.dispatch(self.statementHandlers, statement)
+		if not done:
 			for attr in Crawler.CHILD_ATTRS:
 				child = getattr(statement, attr, None)
 				if child and isinstance(child, jsparser.Node):
-					self.walkbranch(child)
-
-		def walkexpression(self, expression, name, usesReturn):
-			#import pdb; pdb.set_trace()
-			if expression.type=='CALL':
+					yield self.walkbranch(child)
+
+	# The statement handlers yield True when nothing is left to walk in the
+	# children of the statement
+	def walkvar(self, statement):	# create a new variable
+		child = getattr(statement[0], 'initializer', None)
+		if child:
+			name = _crawlIdentifier(statement[0], 'value')
+			self.callcount = 0
+			self.preput = TextSpans()
+			self.output.append(self.inputtext, self.inputoffset, statement.start)
+			self.inputoffset = statement.start
+			index = self.output.mark()
+			yield self.walkexpression(child, name, True)
+			if len(self.preput)>0:
+				self.output.insert(index, self.preput)
+		yield False
+
+	def walksemicolon(self, statement):
+		child = getattr(statement, 'expression', None)
+		if child:
+			if statement.expression.type=='ASSIGN':
+				name = _crawlIdentifier(statement.expression[0], 'value')
+			else:
+				name = statement.value
+			self.callcount = 0
+			self.preput = TextSpans()
+			self.output.append(self.inputtext, self.inputoffset, statement.start)
+			self.inputoffset=statement.start
+			index = self.output.mark()
+			yield self.walkexpression(child, name, True if statement.expression.type=='ASSIGN' else False)
+			if len(self.preput)>0:
+				self.output.insert(index, self.preput)
+		yield True
+
+	def walkcall(self, statement):
+		self.replacefunction(statement, statement[0].value)
+		yield True
+
+	def walkfor(self, statement):
+		worked = self.unloopFor(statement)
+		if not worked:
+			yield self.walkbranch(statement.body)
+		yield True
+
+	def walkswitch(self, statement):
+		for case in statement.cases:
+			if statement.defaultIndex>=0 and case == statement.cases[statement.defaultIndex]:
+				self.crawlingSwitchDefault = True
+			yield self.walkbranch(case.statements)
+			self.crawlingSwitchDefault = False
+		yield False
+
+	# The other statements only have their children walked
+	statementHandlers = dispatchTable({
+		'VAR': walkvar, 'SEMICOLON': walksemicolon, 'CALL': walkcall,
+		'FOR': walkfor, 'SWITCH': walkswitch,
+	})
+
+	def walkexpression(self, expression, name, usesReturn):
+		#import pdb; pdb.set_trace()
+		if expression.type=='CALL':
+			retname = 'ret' + name.translate(None, transdel) + str(self.callcount)
+			if not usesReturn:
+				retname = None
+			self.replacecall(expression, retname, usesReturn)
+			self.callcount+=1
+			return
+		elif expression.type=='ASSIGN' and expression[1].type=='FUNCTION':	# defining a new function and assigning it to a variable
+			# set up the environment inside the function
+			parent = '.'.join(name.split('.')[0:-1])
+			parentobj = self.env.get(parent)
+			self.env.pushThis(parentobj)
+			self.env.pushScope()
+
+			# handle any defined variables
+			signature = self.inputtext[self.inputtext.find('(',expression[1].start)+1 : self.inputtext.find(')',expression[1].start)]
+			params = self.parsefunctiontypes(signature)
+			for param in params.keys():
+				fromname = params[param] + ".prototype"
+				self.env.createLocal(param)
+				self.env.set(param, JSObject(None, self.env.get(fromname)))
+			# walk the function
+			yield self.walkbranch(expression[1].body)
+			self.env.popScope()
+			self.env.popThis()
+			return
+		for piece in expression:		# for each part of a line
+			if piece.type=='CALL':
 				retname = 'ret' + name.translate(None, transdel) + str(self.callcount)
 				if not usesReturn:
 					retname = None
-				self.replacecall(expression, retname, usesReturn)
+				self.replacecall(piece, retname, usesReturn)
 				self.callcount+=1
-				return
-			elif expression.type=='ASSIGN' and expression[1].type=='FUNCTION':	# defining a new function and assigning it to a variable
-				# set up the environment inside the function
-				parent = '.'.join(name.split('.')[0:-1])
-				parentobj = env.get(parent)
-				env.pushThis(parentobj)
-				env.pushScope()
-
-				# handle any defined variables
-				signature = self.inputtext[self.inputtext.find('(',expression[1].start)+1 : self.inputtext.find(')',expression[1].start)]
-				params = self.parsefunctiontypes(signature)
-				for param in params.keys():
-					fromname = params[param] + ".prototype"
-					env.createLocal(param)
-					env.set(param, JSObject(None, env.get(fromname)))
-				# walk the function
-				self.walkbranch(expression[1].body)
-				env.popScope()
-				env.popThis()
-				return
-			for piece in expression:		# for each part of a line
-				if piece.type=='CALL':
-					retname = 'ret' + name.translate(None, transdel) + str(self.callcount)
-					if not usesReturn:
-						retname = None
-					self.replacecall(piece, retname, usesReturn)
-					self.callcount+=1
-				elif len(piece):
-					self.walkexpression(piece, name, usesReturn)
-
-		def replacecall(self, call, retname, usesReturn):
-			#import pdb; pdb.set_trace()
-			if call[0].type=='INDEX' or \
-			  (call[0].type=='DOT' and call[0][0].type=='INDEX'):
-				self.replacecallswitch(call, retname, usesReturn)
-				return
-
-			if call[0].type=='DOT' and call[0][-1].value=='call':
-				funname = _crawlIdentifier(call[0], 'value')
-				function = env.get(funname[:-5])
-			else:
-				funname = _crawlIdentifier(call[0], 'value')
-				function = env.get(funname)
-			if function == None or function.getFunction() == None:
-				return
-			replacements={}
-			arguments = ['"'+node.value+'"' if node.type=='STRING' else _crawlIdentifier(node, 'value') for node in call[1]]
-			if call[0].type=='DOT' and call[0][-1].value=='call':
-				replacements['this'] = arguments.pop(0)
+			elif len(piece):
+				yield self.walkexpression(piece, name, usesReturn)
+
+	def template(self, function, replacements, retval, forceretval):
+		"""
+		Return the Template to inline a call to a library function with, of
+		its expanded body if self.expand is set, see _expandFunction
+		Returns None if the call is not to be inlined
+		"""
+		if self.expand:
+			function = _expandFunction(self.env, function)
+		return functionTemplate(self.env, function, replacements, retval, forceretval)
+
+	def replacecall(self, call, retname, usesReturn):
+		#import pdb; pdb.set_trace()
+		if call[0].type=='INDEX' or \
+		  (call[0].type=='DOT' and call[0][0].type=='INDEX'):
+			self.replacecallswitch(call, retname, usesReturn)
+			return
+
+		funname = _accessName(call[0])
+		if funname is None:
+			return		# calls on the results of calls and the like are never in the library
+		if call[0].type=='DOT' and call[0][-1].value=='call':
+			function = self.env.get(funname[:-5])
+		else:
+			function = self.env.get(funname)
+		if function == None or function.getFunction() == None:
+			return
+		replacements={}
+		arguments = ['"'+node.value+'"' if node.type=='STRING' else _crawlIdentifier(node, 'value') for node in call[1]]
+		if call[0].type=='DOT' and call[0][-1].value=='call':
+			replacements['this'] = arguments.pop(0)
+		else:
+			if len(funname.split('.'))>1:
+				replacements['this'] = '.'.join(funname.split('.')[0:-1])
+		funparams = function.getFunction().params
+		for i in range(0, len(funparams)):
+			if i < len(arguments):
+				replacements[funparams[i]] = arguments[i]
 			else:
-				if len(funname.split('.'))>1:
-					replacements['this'] = '.'.join(funname.split('.')[0:-1])
-			funparams = function.getFunction().params
-			for i in range(0, len(funparams)):
-				if i < len(arguments):
-					replacements[funparams[i]] = arguments[i]
-				else:
-					replacements[funparams[i]] = 'undefined'
-			functionout = replaceIdentifiers(self.librarytext, function.getFunction().body, replacements, retname, False)
-			if functionout.needsRetVal:
-				self.preput+=functionout.getOutput()
-				self.output.append(self.inputtext[self.inputoffset:call.start])
-				self.output.append(functionout.retval)
-				self.inputoffset = call.end
+				replacements[funparams[i]] = 'undefined'
+		# the library may be several files, so use the text the function came from
+		template = self.template(function.getFunction(), replacements, retname, False)
+		if template is None:
+			return
+		self.changes += 1
+		functionout = template.expand(replacements, retname)
+		if template.needsRetVal:
+			self.preput.append(functionout)
+			self.output.append(self.inputtext, self.inputoffset, call.start)
+			self.output.append(retname)
+			self.inputoffset = call.end
+		else:
+			self.output.append(self.inputtext, self.inputoffset, call.start)
+			if usesReturn:
+				self.output.append("(")
+				self.output.append(functionout)
+				self.output.append(")")
 			else:
-				if usesReturn:
-					self.output.append(self.inputtext[self.inputoffset:call.start]+"(")
-					self.output.append(functionout.getOutput()+")")
+				self.output.append(functionout)
+			self.inputoffset = call.end
+
+	def replacecallswitch(self, call, retname, usesReturn):
+		#import pdb; pdb.set_trace()
+		curlayout = {}
+		level = call[0]
+		while True:
+			if level.type=='INDEX':				# ^object^[selector]
+				curlayout['objectname'] = _crawlIdentifier(level[0], 'value')
+				curlayout['keyvar'] = _crawlIdentifier(level[1], 'value')
+				if level[0].type=='DOT':		# ^object^.something[selector]
+					level=level[0]
+				elif level[0].type=='INDEX':
+					curlayout = {'deeper': curlayout}
+					level=level[0]
 				else:
-					self.output.append(self.inputtext[self.inputoffset:call.start])
-					self.output.append(functionout.getOutput())
-				self.inputoffset = call.end
-
-		def replacecallswitch(self, call, retname, usesReturn):
-			#import pdb; pdb.set_trace()
-			curlayout = {}
-			level = call[0]
-			while True:
-				if level.type=='INDEX':				# ^object^[selector]
-					curlayout['objectname'] = _crawlIdentifier(level[0], 'value')
-					curlayout['keyvar'] = _crawlIdentifier(level[1], 'value')
-					if level[0].type=='DOT':		# ^object^.something[selector]
-						level=level[0]
-					elif level[0].type=='INDEX':
-						curlayout = {'deeper': curlayout}
-						level=level[0]
-					else:
-						break
-				elif level.type=='DOT':
-					if level[0].type=='INDEX':
-						curlayout = {'deeper': curlayout,
-						             'after': _crawlIdentifier(level[1], 'value')}
-						level=level[0]
-					else:
-						break
+					break
+			elif level.type=='DOT':
+				if level[0].type=='INDEX':
+					curlayout = {'deeper': curlayout,
+					             'after': _crawlIdentifier(level[1], 'value')}
+					level=level[0]
 				else:
 					break
-
-			origcall = self.inputtext[call.start:call.end]
-			if self.crawlingSwitchDefault:
-				return
-
-			needsRetVal = [False]
-			switchoutput=[]
-
-			def generateswitch(layout):
-				object = env.get(layout['objectname'])
-				if object == None:
-					raise NotImplementedError()
-
-				if not len(object.keys()):
-					raise NotImplementedError()
-
-				origarguments = []
-				switchoutput.append("switch (%s) {\n"%layout['keyvar'])
-				for key in object.keys():
-					switchoutput.append('	case "%s":\n'%key)
-					try:
-						if str(int(key)) == key:
-							switchoutput.append('	case %s:\n'%key)
-					except:
-						pass
-					if object[key].getFunction()!=None:
-
-						replacements={}
-						function=object[key].getFunction()
-						origarguments = [_crawlIdentifier(node, 'value') for node in call[1]]
-						arguments=origarguments[:]
-
-						if call[0].type=='DOT' and call[0][0].type=='INDEX' and call[0][1].value=='call':
-							replacements['this'] = arguments.pop(0)
-						else:
-							replacements['this'] = layout['objectname']
-
-						for i in range(0, len(arguments)):
-							replacements[function.params[i]] = arguments[i]
-						functionout = replaceIdentifiers(self.librarytext, function.body, replacements, retname, True)
-						needsRetVal[0] = needsRetVal[0] or functionout.needsRetVal
-						switchoutput.append(functionout.getOutput())
-						# If the function doesn't have a retval, add ending bits
-						if not needsRetVal[0]:
-							switchoutput.append(';\n')
-					elif 'deeper' in layout and layout['deeper']:
-						layout['deeper']['objectname']=layout['objectname'] + '.' + key
-						if 'after' in layout and layout['after']:
-							layout['deeper']['objectname'] += '.' + layout['after']
-						generateswitch(layout['deeper'])
-					switchoutput.append('\tbreak;\n')
-				switchoutput.append("	default:\n	%s;\n}"%origcall)
-			try:
-				generateswitch(curlayout)
-			except NotImplementedError:		# could not handle it
-				return
-
-
-			if needsRetVal[0]:
-				self.preput+=''.join(switchoutput)+"\n"
-				self.output.append(self.inputtext[self.inputoffset:call.start])
-				self.output.append(retname)
-				self.inputoffset = call.end
 			else:
-				if not usesReturn:
-					self.output.append(self.inputtext[self.inputoffset:call.start])
-					self.output.append(''.join(switchoutput))
-				else:
-					# Should never happen
-					print("Impossible")
-				self.inputoffset = call.end
+				break
+
+		origcall = self.inputtext[call.start:call.end]
+		if self.crawlingSwitchDefault:
+			return
+
+		needsRetVal = [False]
+		switchoutput=TextSpans()
+
+		def generateswitch(layout):
+			object = self.env.get(layout['objectname'])
+			if object == None:
+				raise NotImplementedError()
+
+			if not len(object.keys()):
+				raise NotImplementedError()
+
+			origarguments = []
+			switchoutput.append("switch (%s) {\n"%layout['keyvar'])
+			for key in object.keys():
+				switchoutput.append('	case "%s":\n'%key)
+				try:
+					if str(int(key)) == key:
+						switchoutput.append('	case %s:\n'%key)
+				except:
+					pass
+				if object[key].getFunction()!=None:
+
+					replacements={}
+					function=object[key].getFunction()
+					origarguments = [_crawlIdentifier(node, 'value') for node in call[1]]
+					arguments=origarguments[:]
+
+					if call[0].type=='DOT' and call[0][0].type=='INDEX' and call[0][1].value=='call':
+						replacements['this'] = arguments.pop(0)
+					else:
+						replacements['this'] = layout['objectname']
+
+					for i in range(0, len(arguments)):
+						replacements[function.params[i]] = arguments[i]
+					template = self.template(function, replacements, retname, True)
+					if template is None:
+						raise NotImplementedError()
+					needsRetVal[0] = needsRetVal[0] or template.needsRetVal
+					switchoutput.append(template.expand(replacements, retname))
+					# If the function doesn't have a retval, add ending bits
+					if not needsRetVal[0]:
+						switchoutput.append(';\n')
+				elif 'deeper' in layout and layout['deeper']:
+					layout['deeper']['objectname']=layout['objectname'] + '.' + key
+					if 'after' in layout and layout['after']:
+						layout['deeper']['objectname'] += '.' + layout['after']
+					generateswitch(layout['deeper'])
+				switchoutput.append('\tbreak;\n')
+			switchoutput.append("	default:\n	%s;\n}"%origcall)
+		try:
+			generateswitch(curlayout)
+		except NotImplementedError:		# could not handle it
+			return
+		self.changes += 1
+
+		if needsRetVal[0]:
+			self.preput.extend(switchoutput)
+			self.preput.append("\n")
+			self.output.append(self.inputtext, self.inputoffset, call.start)
+			self.output.append(retname)
+			self.inputoffset = call.end
+		else:
+			if not usesReturn:
+				self.output.append(self.inputtext, self.inputoffset, call.start)
+				self.output.extend(switchoutput)
+			else:
+				# Should never happen
+				print("Impossible")
+			self.inputoffset = call.end
 
-				# Ignore any semicolons after non-return switches
+			# Ignore any semicolons after non-return switches
+			self.inputoffset+=1
+			if self.inputoffset<len(self.inputtext) and (self.inputtext[self.inputoffset]==';' or self.inputtext[self.inputoffset]==' '):
 				self.inputoffset+=1
-				if self.inputoffset<len(self.inputtext) and (self.inputtext[self.inputoffset]==';' or self.inputtext[self.inputoffset]==' '):
-					self.inputoffset+=1
-
-		def unloopFor(self, loop):
-			variable=None	# variable to replace
-			start=None		# starting value
-			cur=None		# current value
-			step=None		# how much to add/subtract on each loop
-			stop=None		# function saying whether to stop
-			maxiterations = 60		# how many times we will allow to unroll
-
-			# parse the initialization
-			setup = loop.setup
-			if setup.type=='VAR':
-				if setup[0].type=='IDENTIFIER' and \
-				   setup[0].initializer.type=='NUMBER':
-					variable = setup[0].value
-					start = setup[0].initializer.value
-
-			# parse the update
-			update = loop.update
-			if update.type=='INCREMENT':	# i++
-				step=1
-			elif update.type=='DECREMENT':	# i--
-				step=-1
-			elif update.type=='ASSIGN':		# more complex update
-				# i+=1
-				if update[0].type=='IDENTIFIER' and \
-				   update[0].value==variable and \
-				   update[1].type=='NUMBER':
-					if update.value=='+':
-						step=0+update[1].value
-					elif update.value=='-':
-						step=0-update[1].value
-				# i=x+x
-				if update[0].type=='IDENTIFIER' and \
-				   update[0].value==variable and \
-				   update[1].type=='PLUS':
-					# i=i+1
-					if update[1][0].value==variable and \
-					   update[1][1].type=='NUMBER':
-						step=0+update[1][1].value
-					# i=1+i
-					if update[1][1].value==variable and \
-					   update[1][0].type=='NUMBER':
-						step=0+update[1][0].value
-				# i=x-x
-				if update[0].type=='IDENTIFIER' and \
-				   update[0].value==variable and \
-				   update[1].type=='MINUS':
-					# i=i-1
-					if update[1][0].value==variable and \
-					   update[1][1].type=='NUMBER':
-						step=0-update[1][1].value
-
-			# parse the ending criteria
-			condition = loop.condition
-			if condition.type in ['LT', 'LE', 'GT', 'GE'] and condition[0].type=='IDENTIFIER' and condition[0].value==variable:
-				if condition.type=='LT' and step>0:
-					stop=lambda i: i >= condition[1].value
-				elif condition.type=='LE' and step>0:
-					stop=lambda i: i > condition[1].value
-				elif condition.type=='GT' and step<0:
-					stop=lambda i: i <= condition[1].value
-				elif condition.type=='GE' and step<0:
-					stop=lambda i: i < condition[1].value
-
-			# check that we parsed everything validly
-			if start is None or step is None or stop is None:
-				# could not parse something
-				return False
-
-			# how many iterations in the loop
-			iterations = 0
-			cur = start
-			while iterations < maxiterations and \
-			      not stop(cur):
-				iterations+=1
-				cur += step
-			if iterations >= maxiterations:
-				# too many loop unwinds
-				return False
-
-			# Do the unwinding
-			iterations = 0
-			cur = start
-			self.output.append(self.inputtext[self.inputoffset:loop.start])
-			self.inputoffset = loop.body.end
-			while not stop(cur):
-				bodyout = replaceIdentifiers(self.inputtext, loop.body, {variable:cur}, None, False)
-				self.output.append(bodyout.getOutput())
-				cur += step
-				if len(loop.body):
-					self.output.append(self.inputtext[loop.body[len(loop.body)-1].end:loop.end-1])
-				if not stop(cur):
-					self.output.append('\n')
-			return True
 
-		def getOutput(self):
-			return ''.join(self.output)
+	def unloopFor(self, loop):
+		variable=None	# variable to replace
+		start=None		# starting value
+		cur=None		# current value
+		step=None		# how much to add/subtract on each loop
+		stop=None		# function saying whether to stop
+		maxiterations = 60		# how many times we will allow to unroll
+
+		# parse the initialization
+		setup = loop.setup
+		if setup.type=='VAR':
+			if setup[0].type=='IDENTIFIER' and \
+			   setup[0].initializer.type=='NUMBER':
+				variable = setup[0].value
+				start = setup[0].initializer.value
+
+		# parse the update
+		update = loop.update
+		if update.type=='INCREMENT':	# i++
+			step=1
+		elif update.type=='DECREMENT':	# i--
+			step=-1
+		elif update.type=='ASSIGN':		# more complex update
+			# i+=1
+			if update[0].type=='IDENTIFIER' and \
+			   update[0].value==variable and \
+			   update[1].type=='NUMBER':
+				if update.value=='+':
+					step=0+update[1].value
+				elif update.value=='-':
+					step=0-update[1].value
+			# i=x+x
+			if update[0].type=='IDENTIFIER' and \
+			   update[0].value==variable and \
+			   update[1].type=='PLUS':
+				# i=i+1
+				if update[1][0].value==variable and \
+				   update[1][1].type=='NUMBER':
+					step=0+update[1][1].value
+				# i=1+i
+				if update[1][1].value==variable and \
+				   update[1][0].type=='NUMBER':
+					step=0+update[1][0].value
+			# i=x-x
+			if update[0].type=='IDENTIFIER' and \
+			   update[0].value==variable and \
+			   update[1].type=='MINUS':
+				# i=i-1
+				if update[1][0].value==variable and \
+				   update[1][1].type=='NUMBER':
+					step=0-update[1][1].value
+
+		# parse the ending criteria
+		condition = loop.condition
+		if condition.type in ['LT', 'LE', 'GT', 'GE'] and condition[0].type=='IDENTIFIER' and condition[0].value==variable:
+			if condition.type=='LT' and step>0:
+				stop=lambda i: i >= condition[1].value
+			elif condition.type=='LE' and step>0:
+				stop=lambda i: i > condition[1].value
+			elif condition.type=='GT' and step<0:
+				stop=lambda i: i <= condition[1].value
+			elif condition.type=='GE' and step<0:
+				stop=lambda i: i < condition[1].value
+
+		# check that we parsed everything validly
+		if start is None or step is None or stop is None:
+			# could not parse something
+			return False
+
+		# how many iterations in the loop
+		iterations = 0
+		cur = start
+		while iterations < maxiterations and \
+		      not stop(cur):
+			iterations+=1
+			cur += step
+		if iterations >= maxiterations:
+			# too many loop unwinds
+			return False
+
+		# Do the unwinding
+		self.changes += 1
+		iterations = 0
+		cur = start
+		self.output.append(self.inputtext, self.inputoffset, loop.start)
+		self.inputoffset = loop.body.end
+		template = Template(self.inputtext, loop.body, [variable], None, False)
+		while not stop(cur):
+			self.output.append(template.expand({variable:cur}, None))
+			cur += step
+			if len(loop.body):
+				self.output.append(self.inputtext, loop.body[len(loop.body)-1].end, loop.end-1)
+			if not stop(cur):
+				self.output.append('\n')
+		return True
+
+	def getOutput(self):
+		return self.output.getvalue()
+
+class FunctionCrawler(Crawler):
+	"""
+	The walker behind _expandFunction, which copies the body of a library
+	function with the calls in it inlined, from its opening brace to its
+	closing one
+	"""
+	def __init__(self, function, env):
+		self.function = function
+		self.names = frozenset(list(function.params) + ['this'])
+		Crawler.__init__(self, function.sourceFile.text, None, env, function.body, None, True)
+
+	def walkbranch(self, branch):
+		if branch is self.script:
+			self.inputoffset = branch.start
+			for statement in branch:
+				yield self.walkstatement(statement)
+			self.output.append(self.inputtext, self.inputoffset, branch.end)
+			self.inputoffset = branch.end
+		else:
+			yield Crawler.walkbranch(self, branch)
+
+	def walkreturn(self, statement):
+		# the calls in the returned value are inlined as in walkvar, with
+		# return variables named after the function, so that they are
+		# not the ones of the functions it is inlined into
+		if isinstance(statement.value, jsparser.Node):
+			name = getattr(self.function, 'name', None) or 'function'
+			self.callcount = 0
+			self.preput = TextSpans()
+			self.output.append(self.inputtext, self.inputoffset, statement.start)
+			self.inputoffset = statement.start
+			index = self.output.mark()
+			yield self.walkexpression(statement.value, name, True)
+			if len(self.preput)>0:
+				self.output.insert(index, self.preput)
+		yield True
+
+	statementHandlers = list(Crawler.statementHandlers)
+	statementHandlers[jsparser.typeCodes['RETURN']] = walkreturn
+
+	def template(self, function, replacements, retval, forceretval):
+		"""
+		Inline the functions that are already expanded with their expanded
+		bodies, and the others, which call back to this function, as they
+		are, but not if the text that would add has the return variable or
+		any of the names that inlining this function then replaces
+		"""
+		expanded = self.env.expanded.get(id(function))
+		if expanded is not None:
+			function = expanded[1]
+		template = functionTemplate(self.env, function, replacements, retval, forceretval)
+		names = template.names()
+		if retval in self.names or retval in names or not self.names.isdisjoint(names):
+			return None
+		return template
+
+def _enterFunction(env, function):
+	"""
+	Push a scope and this for walking the body of a library function on its
+	own: its parameters and variables are locals without values, and this
+	has none, so nothing is found through them, as that depends on the call
+	Returns False for functions with functions inside, which aren't walked
+	"""
+	body = function.body
+	if any(node.type_ == jsparser.FUNCTION for node in jsparser.walk([body])):
+		return False
+	env.pushThis(None)
+	env.pushScope()
+	for name in function.params:
+		env.createLocal(name)
+	for node in jsparser.walk([body]):
+		if node.type_ == jsparser.VAR:
+			for declaration in node:
+				env.createLocal(declaration.value)
+	return True
+
+def _leaveFunction(env):
+	env.popScope()
+	env.popThis()
+
+def _callees(env, function):
+	"""
+	Return the library functions that the calls in the body of a library
+	function are to, walked on its own, see _enterFunction
+	"""
+	if not _enterFunction(env, function):
+		return []
+	try:
+		callees = []
+		for node in jsparser.walk([function.body]):
+			if node.type_ != jsparser.CALL:
+				continue
+			name = _accessName(node[0])
+			if name is None:
+				continue
+			if node[0].type=='DOT' and node[0][-1].value=='call':
+				name = name[:-5]
+			value = env.get(name)
+			if value is not None and value.getFunction() is not None:
+				callees.append(value.getFunction())
+		return callees
+	finally:
+		_leaveFunction(env)
+
+def _expandFunction(env, function):
+	"""
+	Return a FUNCTION node like a library function, but with the calls in
+	its body to other library functions inlined, bottom up
+	The call graph from the function is walked from a stack, and the
+	functions in it are expanded in reverse topological order, so that each
+	one is expanded once and then inlined with its callees already in it.
+	A call back to a function that is still being expanded inlines it as
+	it is. The expanded functions are kept in env.expanded along with the
+	function, so its id isn't reused, see FunctionCrawler for what is left
+	as it is.
+	"""
+	cached = env.expanded.get(id(function))
+	if cached is not None:
+		return cached[1]
+	seen = set([id(function)])
+	order = []
+	stack = [(function, iter(_callees(env, function)))]
+	while stack:
+		caller, callees = stack[-1]
+		for callee in callees:
+			if id(callee) not in seen and id(callee) not in env.expanded:
+				seen.add(id(callee))
+				stack.append((callee, iter(_callees(env, callee))))
+				break
+		else:
+			stack.pop()
+			order.append(caller)
+	for caller in order:
+		env.expanded[id(caller)] = (caller, _expandBody(env, caller))
+	return env.expanded[id(function)][1]
 
-	crawler = Crawler(inputtext, librarytext, library)
+def _expandBody(env, function):
+	"""
+	Inline the calls in the body of a library function, see _expandFunction
+	Returns the function as it is if nothing was inlined or the result
+	doesn't parse
+	"""
+	if not _enterFunction(env, function):
+		return function
+	try:
+		crawler = FunctionCrawler(function, env)
+	finally:
+		_leaveFunction(env)
+	if not crawler.changes:
+		return function
+	source = '(function (%s) %s);' % (', '.join(function.params), crawler.getOutput())
+	try:
+		return jsparser.parse(source)[0].expression[0]
+	except jsparser.ParseError:
+		return function
+
+def _inline(inputtext, library, env, output=None, script=None):
+	crawler = Crawler(inputtext, library, env, script)
+	if output:
+		crawler.output.write(output)
+		return None
 	return crawler.getOutput()
 
+def _inlineAll(inputtext, library, env, output=None, passes=16, maxsize=None, expand=False):
+	"""
+	Inline the snippet again and again, see inlineAll
+
+	Each pass only walks the top level statements in the output of the
+	statements that the last pass changed, see Crawler.walktop. The others
+	were copied as they were by the last pass, so they would be again. The
+	snippet is parsed once, then only the text each pass wrote is parsed,
+	see _reparseChanged.
+	"""
+	script = jsparser.parse(inputtext, index=True)
+	statements = None
+	for number in range(passes):
+		if number:
+			statements = _reparseChanged(script, inputtext, changed)
+		crawler = Crawler(inputtext, library, env, script, statements, expand)
+		text = crawler.getOutput()
+		if text == inputtext:
+			break
+		changed = crawler.changed
+		inputtext = text
+		if maxsize is not None and len(inputtext) > maxsize:
+			break
+	if output:
+		output.write(inputtext)
+		return None
+	return inputtext
+
+def _reparseChanged(script, inputtext, changed):
+	"""
+	Update the script of a pass of _inlineAll to the output of that pass,
+	given the numbers of the top level statements that changed and where
+	their output is, see Crawler.walktop
+	Returns the numbers of the statements in the output of those, the only
+	ones the next pass walks
+
+	Only that output is parsed, see jsparser.parseStatements. The other
+	statements are never walked again, so their nodes are dropped, leaving
+	None in the script, and their offsets in script.statementStarts are
+	shifted to where they are in the output. If the output of a statement
+	doesn't end where the next statement starts, the whole output is parsed.
+	"""
+	file = jsparser.SourceFile(inputtext)
+	starts = script.statementStarts
+	newStatements = []
+	newStarts = array('l')
+	walked = set()
+	delta = 0
+	last = 0
+	for number, start, end in changed:
+		newStatements.extend(None for statement in script[last:number])
+		newStarts.extend(offset + delta for offset in starts[last:number])
+		parsed, parsedStarts, stop = jsparser.parseStatements(script, file, start, end)
+		if stop != end:
+			walked = None
+			break
+		walked.update(xrange(len(newStatements), len(newStatements) + len(parsed)))
+		newStatements.extend(parsed)
+		newStarts.extend(parsedStarts)
+		last = number + 1
+		delta = end - (starts[last] if last < len(starts) else len(script.sourceFile.text))
+	if walked is None:
+		parsed = jsparser.parse(inputtext)
+		newStatements = list(parsed)
+		newStarts = parsed.statementStarts
+		walked = set(range(len(parsed)))
+	else:
+		newStatements.extend(None for statement in script[last:])
+		newStarts.extend(offset + delta for offset in starts[last:])
+	script[:] = newStatements
+	script.statementStarts = newStarts
+	script.sourceFile = file
+	script.end = len(inputtext)
+	script.nodeIndex = None
+	return walked
+
 if __name__ == '__main__':
-	if len(sys.argv)==3:
-		libraryname = sys.argv[1]
-		snippetname = sys.argv[2]
-		library = file(libraryname, 'r').read()
+	if len(sys.argv)>=3:
+		librarynames = sys.argv[1:-1]
+		snippetname = sys.argv[-1]
 		snippet = file(snippetname, 'r').read()
-		output = inlineSingle(snippet, library)
-		print(output)
+		inlineFiles(snippet, librarynames, output=sys.stdout)
+		print('')
 	else:
-		print("Usage: %s libraryfilename snippetfilename"%sys.argv[0])
+		print("Usage: %s libraryfilename [libraryfilename ...] snippetfilename"%sys.argv[0])
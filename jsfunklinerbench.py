@@ -0,0 +1,598 @@
+#!/usr/bin/python
+
+"""
+Benchmarks for jsparser and jsfunkliner
+
+Run every benchmark with no arguments, or name the ones to run:
+	python jsfunklinerbench.py tokenize
+"""
+
+import jsfunkliner
+import jsparser
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+LIBRARY_FUNCTION = """
+function helper%(index)d(one, two) {
+	// adds up some numbers
+	var total = one + two * %(index)d;
+	if (total > 10) { total = total - 1; }
+	/* keep the strings in there too */
+	window.status = "helper %(index)d: " + total;
+	return total;
+}
+"""
+
+def generateLibrary(functions):
+	"""
+	Build a library text with the given number of small functions
+	"""
+	return ''.join(LIBRARY_FUNCTION % {'index': index} for index in range(functions))
+
+def bestTime(function, *args):
+	"""
+	Run the function a few times, returning the fastest time in seconds
+	"""
+	best = None
+	for repeat in range(3):
+		start = time.time()
+		function(*args)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def generateSnippet(calls):
+	"""
+	Build a snippet calling the first few functions of a generated library
+	"""
+	return ''.join('var x%(index)d = helper%(index)d(%(index)d, 2);\n' % {'index': index} for index in range(calls))
+
+def treeSize(tree):
+	"""
+	Estimate the memory used by the nodes of a parse tree, in bytes
+	"""
+	size = 0
+	seen = set()
+	pending = [tree]
+	while pending:
+		node = pending.pop()
+		if id(node) in seen:
+			continue
+		seen.add(id(node))
+		size += sys.getsizeof(node)
+		values = list(node)
+		attributes = getattr(node, '__dict__', None)
+		if attributes:
+			size += sys.getsizeof(attributes)
+			values.extend(value for name, value in attributes.items() if name != 'target')
+		for name in getattr(type(node), '__slots__', ()):
+			if name not in ('__dict__', 'target') and hasattr(node, name):
+				values.append(getattr(node, name))
+		for value in values:
+			if isinstance(value, jsparser.Node):
+				pending.append(value)
+			elif isinstance(value, list):
+				pending.extend(item for item in value if isinstance(item, jsparser.Node))
+	return size
+
+EXPRESSION_STATEMENTS = """
+total%(index)d = (one * two + three * four) / (five - six) %% seven << 2 | mask & bits ^ ~flags;
+value%(index)d = items[index + %(index)d].name || lookup(key, [1, 2, three], {size: 4, label: 'x'}) ? first.second : !third;
+count%(index)d += a && b || c == d && e !== f ? g++ : --h;
+"""
+
+def generateExpressions(statements):
+	"""
+	Build a source text of expression statements, a few at a time
+	"""
+	return ''.join(EXPRESSION_STATEMENTS % {'index': index} for index in range(statements // 3))
+
+def tokenize(source):
+	t = jsparser.Tokenizer(source, None, 1)
+	while t.get() != jsparser.END:
+		pass
+
+def bench_tokenize():
+	"""
+	Tokenize doubling library sizes, the time per byte should stay flat
+	"""
+	print("Tokenizing generated libraries")
+	print("%10s %10s %10s %10s" % ('functions', 'bytes', 'seconds', 'us/byte'))
+	for functions in [250, 500, 1000, 2000, 4000]:
+		source = generateLibrary(functions)
+		elapsed = bestTime(tokenize, source)
+		print("%10d %10d %10.3f %10.3f" % (functions, len(source), elapsed, elapsed * 1000000 / len(source)))
+
+def bench_parse():
+	"""
+	Parse a generated library, reporting the time and the size of the tree
+	"""
+	print("Parsing generated libraries")
+	print("%10s %10s %10s %12s %10s" % ('functions', 'bytes', 'seconds', 'tree bytes', 'lazy'))
+	for functions in [500, 2000]:
+		source = generateLibrary(functions)
+		elapsed = bestTime(jsparser.parse, source)
+		lazy = bestTime(jsparser.parse, source, None, 1, True)
+		print("%10d %10d %10.3f %12d %10.3f" % (functions, len(source), elapsed, treeSize(jsparser.parse(source)), lazy))
+
+def bench_expressions():
+	"""
+	Parse generated expression statements with each expression engine
+	"""
+	print("Parsing generated expressions")
+	print("%10s %10s %10s %10s" % ('statements', 'bytes', 'operator', 'pratt'))
+	for statements in [1500, 6000]:
+		source = generateExpressions(statements)
+		operator = bestTime(jsparser.parse, source, None, 1, False, False)
+		pratt = bestTime(jsparser.parse, source)
+		print("%10d %10d %10.3f %10.3f" % (statements, len(source), operator, pratt))
+
+def bench_serialize():
+	"""
+	Print a parsed library, dump it as JSON and load it back
+	"""
+	print("Serializing parse trees")
+	print("%10s %10s %10s %10s %10s" % ('functions', 'parse', 'str', 'dumps', 'loads'))
+	for functions in [500, 2000]:
+		source = generateLibrary(functions)
+		tree = jsparser.parse(source)
+		dumped = jsparser.dumps(tree)
+		times = [bestTime(jsparser.parse, source), bestTime(str, tree),
+			bestTime(jsparser.dumps, tree), bestTime(jsparser.loads, dumped)]
+		print("%10d %10.3f %10.3f %10.3f %10.3f" % tuple([functions] + times))
+
+def bench_flat():
+	"""
+	Flatten a parsed library, then find its calls, assignments and function
+	spans, against walking the tree for its calls
+	"""
+	print("Querying flattened libraries")
+	print("%10s %10s %10s %10s %10s %10s %10s" % ('functions', 'nodes', 'flatten', 'walk', 'calls', 'assigns', 'spans'))
+	for functions in [500, 2000]:
+		tree = jsparser.parse(generateLibrary(functions))
+		flat = jsparser.FlatTree(tree)
+		times = [bestTime(jsparser.FlatTree, tree),
+			bestTime(lambda: [node for node in jsparser.walk([tree]) if node.type == 'CALL']),
+			bestTime(flat.find, 'CALL'), bestTime(flat.assignments, 'window.status'),
+			bestTime(flat.functionSpans)]
+		print("%10d %10d %10.3f %10.3f %10.4f %10.4f %10.4f" % tuple([functions, len(flat)] + times))
+
+def timeReparse(source, edited, lazy):
+	"""
+	Reparse fresh trees of the source a few times, returning the fastest
+	time in seconds, not counting the first parse
+	"""
+	best = None
+	for repeat in range(3):
+		tree = jsparser.parse(source, None, 1, lazy)
+		start = time.time()
+		jsparser.reparse(tree, edited, lazy)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def bench_reparse():
+	"""
+	Parse a library with one function renamed, from scratch and from the
+	tree of the original library
+	"""
+	print("Reparsing an edited library")
+	print("%10s %10s %10s %10s %10s" % ('functions', 'parse', 'reparse', 'lazy', 'reparse'))
+	for functions in [500, 2000]:
+		source = generateLibrary(functions)
+		edited = source.replace('function helper%d(' % (functions // 2), 'function renamed(')
+		times = []
+		for lazy in (False, True):
+			times.append(bestTime(jsparser.parse, edited, None, 1, lazy))
+			times.append(timeReparse(source, edited, lazy))
+		print("%10d %10.3f %10.3f %10.3f %10.3f" % tuple([functions] + times))
+
+def crawl(library):
+	window = jsfunkliner.JSObject()
+	window['window'] = window
+	return jsfunkliner._crawlFunctions(jsfunkliner.JSEnvironment(window, window), library)
+
+def bench_crawl():
+	"""
+	Crawl a parsed library for its functions, and inline a snippet calling them
+	"""
+	print("Crawling generated libraries")
+	print("%10s %12s %10s %10s %10s" % ('functions', 'declarations', 'crawl', 'decls/s', 'inline'))
+	for functions in [500, 2000]:
+		source = generateLibrary(functions)
+		library = jsparser.parse(source)
+		snippet = generateSnippet(100)
+		crawled = bestTime(crawl, library)
+		declarations = crawl(library).declarations
+		inlined = bestTime(jsfunkliner.inlineSingle, snippet, source)
+		print("%10d %12d %10.3f %10d %10.3f" % (functions, declarations, crawled, declarations / crawled, inlined))
+
+def parseLazily(source):
+	return jsparser.parse(source, lazy=True)
+
+def crawlDemanded(library, names):
+	window = jsfunkliner.JSObject()
+	window['window'] = window
+	env = jsfunkliner.JSEnvironment(window, window)
+	jsfunkliner._crawlDemanded(env, library, names)
+	return env
+
+def bench_demand():
+	"""
+	Crawl growing libraries for a small snippet, all of them or only the
+	declarations that the snippet reaches, next to the time to parse them
+	"""
+	print("Crawling generated libraries for 10 calls")
+	print("%10s %10s %10s %10s %12s %10s" % ('functions', 'parse', 'full', 'demand', 'declarations', 'speedup'))
+	snippet = generateSnippet(10)
+	names = jsfunkliner._snippetReferences(jsparser.parse(snippet, index=True), snippet)
+	for functions in [500, 2000, 8000]:
+		source = generateLibrary(functions)
+		parsed = bestTime(parseLazily, source)
+		library = jsparser.parse(source, lazy=True)
+		full = bestTime(crawl, library)
+		demand = bestTime(crawlDemanded, library, names)
+		declarations = crawlDemanded(library, names).declarations
+		print("%10d %10.3f %10.3f %10.3f %12d %10.1f" % (functions, parsed, full, demand, declarations, full / demand))
+
+OBJECT_PROPERTY = """
+	method%(index)d: function(value) { this.value%(index)d = value; },"""
+
+def bench_declarations():
+	"""
+	Crawl a library of one object literal with many methods, for the
+	throughput of the crawl alone on a very large library
+	"""
+	print("Crawling a large object literal")
+	print("%10s %12s %10s %10s" % ('properties', 'declarations', 'crawl', 'decls/s'))
+	for properties in [10000, 40000]:
+		source = 'library = {' + ''.join(OBJECT_PROPERTY % {'index': index} for index in range(properties)) + '\n\tlast: 0\n};\n'
+		library = jsparser.parse(source)
+		crawled = bestTime(crawl, library)
+		declarations = crawl(library).declarations
+		print("%10d %12d %10.3f %10d" % (properties, declarations, crawled, declarations / crawled))
+
+DOM_CALLS = """
+document.getElementById("element%(index)d").focus();
+console.log(window.location.hash, %(index)d);
+window.alert(document.title);
+"""
+
+def replaceCalls(crawler, calls):
+	for call in calls:
+		crawler.replacecall(call, None, False)
+
+def bench_resolve():
+	"""
+	Look up the calls of a snippet that are not in the library, the way the
+	inliner does for each call it finds
+	"""
+	print("Resolving calls outside the library")
+	print("%10s %10s %10s %10s" % ('calls', 'seconds', 'us/call', 'resolved'))
+	library, env = jsfunkliner.loadLibrary(generateLibrary(500))
+	for statements in [1000, 4000]:
+		snippet = ''.join(DOM_CALLS % {'index': index} for index in range(statements // 3))
+		crawler = jsfunkliner.Crawler(snippet, library, env)
+		calls = [node for node in jsparser.walk([jsparser.parse(snippet)]) if node.type == 'CALL']
+		elapsed = bestTime(replaceCalls, crawler, calls)
+		print("%10d %10.3f %10.3f %10d" % (len(calls), elapsed, elapsed * 1000000 / len(calls), len(env.resolved)))
+
+PROTOTYPE_METHOD = """
+Thing.prototype.method%(index)d = function(value) { return value + %(index)d; };
+"""
+
+def generateInstances(methods, instances):
+	"""
+	Build a library of a constructor with a prototype of the given number of
+	methods, and a number of instances of it
+	"""
+	return 'function Thing() {}\n' + \
+		''.join(PROTOTYPE_METHOD % {'index': index} for index in range(methods)) + \
+		''.join('item%(index)d = new Thing();\n' % {'index': index} for index in range(instances))
+
+def bench_instances():
+	"""
+	Crawl a library with many instances of a large prototype, reporting the
+	time and the size of the member dicts of the objects
+	"""
+	print("Crawling prototype instances")
+	print("%10s %10s %10s %12s" % ('methods', 'instances', 'crawl', 'member bytes'))
+	for methods, instances in [(50, 500), (200, 2000)]:
+		library = jsparser.parse(generateInstances(methods, instances))
+		elapsed = bestTime(crawl, library)
+		window = jsfunkliner.JSObject()
+		window['window'] = window
+		jsfunkliner._crawlFunctions(jsfunkliner.JSEnvironment(window, window), library)
+		dicts = dict((id(window[name].members), window[name].members) for name in window.keys())
+		size = sum(sys.getsizeof(members) for members in dicts.values())
+		print("%10d %10d %10.3f %12d" % (methods, instances, elapsed, size))
+
+LONG_FUNCTION = """
+function long(one, two) {
+%(statements)s	var three = one + two;
+	return three;
+}
+"""
+
+def replaceBody(source, body, times):
+	for repeat in range(times):
+		jsfunkliner.replaceIdentifiers(source, body, {'one': '1', 'two': 'x'}, 'ret', False)
+
+def writeIdentifier(node, times):
+	for repeat in range(times):
+		jsfunkliner._crawlIdentifier(node, 'value')
+
+def expandTemplate(source, body, times):
+	template = jsfunkliner.Template(source, body, ['one', 'two'], 'ret', False)
+	for repeat in range(times):
+		template.expand({'one': '1', 'two': 'x'}, 'ret')
+
+def bench_template():
+	"""
+	Inline a function body many times, walking it for each call or
+	compiling it into a Template once and expanding that
+	"""
+	print("Expanding a function body for each call")
+	print("%10s %10s %10s %10s %10s" % ('statements', 'calls', 'walk', 'template', 'speedup'))
+	for statements, calls in [(1, 1000), (10, 500), (100, 100)]:
+		lines = ''.join('\tdocument.getElementById("element%d").innerHTML = "text" + [one, {a: two}][0] + (one ? two : -one);\n' % index for index in range(statements))
+		source = LONG_FUNCTION % {'statements': lines}
+		body = jsparser.parse(source)[0].body
+		walked = bestTime(replaceBody, source, body, calls)
+		expanded = bestTime(expandTemplate, source, body, calls)
+		print("%10d %10d %10.3f %10.3f %10.1f" % (statements, calls, walked, expanded, walked / expanded))
+
+MANY_CALLS = """
+function f(a, b) { var t = a * 2;
+	log(t);
+	return t + b; }
+function g(a) { return a + 1; }
+function h(a) { log(a); log(a); }
+"""
+
+def bench_calls():
+	"""
+	Inline statements holding more and more calls, reporting the time per
+	call: a sum of calls whose bodies go in front of the statement, an
+	array of calls that are inlined in place, and a block of call statements
+	"""
+	print("Inlining statements with many calls, microseconds per call")
+	print("%10s %10s %10s %10s" % ('calls', 'sum', 'array', 'block'))
+	inliner = jsfunkliner.Inliner(MANY_CALLS)
+	for calls in [100, 400, 1600]:
+		snippets = ['var x = ' + ' + '.join('f(%d, y)' % index for index in range(calls)) + ';\n',
+			'var x = [' + ', '.join('g(%d)' % index for index in range(calls)) + '];\n',
+			'if (y) {\n' + ''.join('h(%d);\n' % index for index in range(calls)) + '}\n']
+		times = [bestTime(inliner.inline, snippet) * 1000000 / calls for snippet in snippets]
+		print("%10d %10.1f %10.1f %10.1f" % tuple([calls] + times))
+
+def bench_dispatch():
+	"""
+	Walk a long function body replacing its parameters, and write out an
+	identifier expression, reporting the time per node walked
+	"""
+	print("Dispatching on node types")
+	print("%10s %10s %10s %10s" % ('walker', 'nodes', 'seconds', 'us/node'))
+	statements = ''.join('\tdocument.getElementById("element%d").innerHTML = "text" + [one, {a: two}][0] + (one ? two : -one);\n' % index for index in range(100))
+	source = LONG_FUNCTION % {'statements': statements}
+	body = jsparser.parse(source)[0].body
+	node = jsparser.parse('x = a.b[c + d * 2](e, f ? g : h, {k: l}) - m;')[0].expression[1]
+	for name, function, args, nodes in [
+			('replace', replaceBody, (source, body, 50), 50 * len(list(jsparser.walk([body])))),
+			('identifier', writeIdentifier, (node, 5000), 5000 * len(list(jsparser.walk([node]))))]:
+		elapsed = bestTime(function, *args)
+		print("%10s %10d %10.3f %10.3f" % (name, nodes, elapsed, elapsed * 1000000 / nodes))
+
+def bench_output():
+	"""
+	Inline a statement calling a long function many times, returning the
+	output as a string and writing it to a file
+	"""
+	print("Inlining many calls in one statement")
+	print("%10s %10s %10s %10s" % ('calls', 'bytes', 'string', 'file'))
+	statements = ''.join('\tdocument.getElementById("element%d").innerHTML = "text" + window.location.hash;\n' % index for index in range(100))
+	source = LONG_FUNCTION % {'statements': statements}
+	for calls in [200, 800]:
+		snippet = 'var x = ' + ' + '.join('long(%d, 2)' % index for index in range(calls)) + ';\n'
+		output = file(os.devnull, 'w')
+		try:
+			string = bestTime(jsfunkliner.inlineSingle, snippet, source)
+			written = bestTime(jsfunkliner.inlineSingle, snippet, source, None, None, output)
+		finally:
+			output.close()
+		print("%10d %10d %10.3f %10.3f" % (calls, len(jsfunkliner.inlineSingle(snippet, source)), string, written))
+
+def bench_cache():
+	"""
+	Inline a snippet with a cold and a warm library cache
+	"""
+	print("Inlining with a library cache")
+	print("%10s %10s %10s %10s" % ('functions', 'uncached', 'cold', 'warm'))
+	for functions in [500, 2000]:
+		source = generateLibrary(functions)
+		snippet = generateSnippet(10)
+		directory = tempfile.mkdtemp()
+		try:
+			cache = jsfunkliner.LibraryCache(directory)
+			uncached = bestTime(jsfunkliner.inlineSingle, snippet, source)
+			start = time.time()
+			jsfunkliner.inlineSingle(snippet, source, cache)
+			cold = time.time() - start
+			warm = bestTime(jsfunkliner.inlineSingle, snippet, source, cache)
+		finally:
+			shutil.rmtree(directory)
+		print("%10d %10.3f %10.3f %10.3f" % (functions, uncached, cold, warm))
+
+def inlineEach(snippets, source):
+	for snippet in snippets:
+		jsfunkliner.inlineSingle(snippet, source)
+
+def inlineSession(snippets, source):
+	jsfunkliner.Inliner(source).inlineMany(snippets)
+
+def bench_session():
+	"""
+	Inline a batch of small snippets against one library, loading the
+	library for each snippet or once in an Inliner
+	"""
+	print("Inlining batches of snippets")
+	print("%10s %10s %10s %10s %10s" % ('functions', 'snippets', 'single', 'session', 'speedup'))
+	for functions, snippets in [(500, 20), (2000, 20)]:
+		source = generateLibrary(functions)
+		batch = [generateSnippet(5).replace('helper', 'helper%d' % (index % 10)) for index in range(snippets)]
+		single = bestTime(inlineEach, batch, source)
+		session = bestTime(inlineSession, batch, source)
+		print("%10d %10d %10.3f %10.3f %10.1f" % (functions, snippets, single, session, single / session))
+
+CALL_CHAIN = """
+function level%(index)d(one, two) {
+	return level%(next)d(one, two) + 1;
+}
+"""
+
+def generateChain(depth):
+	"""
+	Build a library of functions each calling the next, depth levels deep
+	"""
+	return ''.join(CALL_CHAIN % {'index': index, 'next': index + 1} for index in range(depth)) + \
+		'function level%d(one, two) { return one + two; }\n' % depth
+
+def inlineRepeated(inline, snippet, *args):
+	while True:
+		output = inline(snippet, *args)
+		if output == snippet:
+			return output
+		snippet = output
+
+def bench_fixpoint():
+	"""
+	Inline a snippet until no calls are left, calling inlineSingle or an
+	Inliner once for each level of calls, or inlining all levels at once
+	"""
+	print("Inlining a chain of 6 calls in a growing snippet")
+	print("%10s %10s %10s %10s %10s %10s" % ('statements', 'single', 'session', 'all', 'sessionall', 'speedup'))
+	source = generateLibrary(500) + generateChain(6)
+	inliner = jsfunkliner.Inliner(source)
+	for statements in [100, 1000, 4000]:
+		snippet = generateExpressions(statements) + 'var x = level0(1, 2);\n'
+		single = bestTime(inlineRepeated, jsfunkliner.inlineSingle, snippet, source)
+		session = bestTime(inlineRepeated, inliner.inline, snippet)
+		inlined = bestTime(jsfunkliner.inlineAll, snippet, source)
+		sessionall = bestTime(inliner.inlineAll, snippet)
+		print("%10d %10.3f %10.3f %10.3f %10.3f %10.1f" % (statements, single, session, inlined, sessionall, single / inlined))
+
+def generateScattered(statements, every, call='var x%(index)d = level0(%(index)d, 2);\n'):
+	"""
+	Build a snippet of expression statements with a call to the chain, or
+	the given one, after every so many of them
+	"""
+	lines = generateExpressions(statements).splitlines(True)
+	return ''.join(line + (call % {'index': index} if index % every == every // 2 else '')
+		for index, line in enumerate(lines))
+
+def bench_scattered():
+	"""
+	Inline a snippet with calls spread all through it until no calls are
+	left, with an Inliner once for each level of calls or all at once,
+	which only parses what each level wrote
+	"""
+	print("Inlining a chain of 6 calls every 100 statements")
+	print("%10s %10s %10s %10s %10s" % ('statements', 'calls', 'session', 'sessionall', 'speedup'))
+	inliner = jsfunkliner.Inliner(generateLibrary(500) + generateChain(6))
+	for statements in [1000, 4000]:
+		snippet = generateScattered(statements, 100)
+		session = bestTime(inlineRepeated, inliner.inline, snippet)
+		sessionall = bestTime(inliner.inlineAll, snippet)
+		print("%10d %10d %10.3f %10.3f %10.1f" % (statements, statements // 100, session, sessionall, session / sessionall))
+
+CALL_TREE = """
+function branch%(index)d(one, two) {
+	branch%(next)d(one, two);
+	branch%(next)d(two, one);
+}
+"""
+
+def generateTree(depth):
+	"""
+	Build a library of functions each calling the next twice, so that
+	inlining the first one inlines 2 ** depth calls to the last
+	"""
+	return ''.join(CALL_TREE % {'index': index, 'next': index + 1} for index in range(depth)) + \
+		'function branch%d(one, two) { log(one - two); }\n' % depth
+
+def bench_expand():
+	"""
+	Inline a snippet with calls to a chain or a tree of functions spread
+	all through it until no calls are left, with an Inliner a level of
+	calls at a time or with the library functions expanded bottom up
+	"""
+	print("Inlining call chains and trees every 100 statements of 1000")
+	print("%10s %10s %10s %10s %10s" % ('library', 'depth', 'sessionall', 'expanded', 'speedup'))
+	chain = 'var x%(index)d = level0(%(index)d, 2);\n'
+	tree = 'branch0(%(index)d, 2);\n'
+	for name, generate, call, depths in [('chain', generateChain, chain, [4, 8, 12]), ('tree', generateTree, tree, [2, 4, 6])]:
+		for depth in depths:
+			source = generateLibrary(500) + generate(depth)
+			snippet = generateScattered(1000, 100, call)
+			inliner = jsfunkliner.Inliner(source)
+			expander = jsfunkliner.Inliner(source)
+			sessionall = bestTime(inliner.inlineAll, snippet)
+			expanded = bestTime(expander.inlineAll, snippet, None, 16, None, True)
+			print("%10s %10d %10.3f %10.3f %10.1f" % (name, depth, sessionall, expanded, sessionall / expanded))
+
+def reloadEdits(library, env, sources):
+	for source in sources:
+		jsfunkliner.reloadLibrary(library, env, source)
+
+def bench_reload():
+	"""
+	Edit one function in the middle of a library, loading it all again or
+	updating the loaded library and its environment
+	"""
+	print("Reloading an edited library")
+	print("%10s %10s %10s %12s %10s" % ('functions', 'load', 'reload', 'declarations', 'speedup'))
+	for functions in [500, 2000, 8000]:
+		source = generateLibrary(functions)
+		middle = 'two * %d;' % (functions // 2)
+		edited = source.replace(middle, middle.replace(';', ' + 1;'))
+		loaded = bestTime(jsfunkliner.loadLibrary, edited)
+		library, env = jsfunkliner.loadLibrary(source)
+		reloadEdits(library, env, [edited, source])	# the first reload hashes the statements
+		declarations = env.declarations
+		reloaded = bestTime(reloadEdits, library, env, [edited, source] * 5) / 10
+		declarations = (env.declarations - declarations) // 30
+		print("%10d %10.3f %10.4f %12d %10.1f" % (functions, loaded, reloaded, declarations, loaded / reloaded))
+
+def bench_files():
+	"""
+	Load a library split into several files, in one process and in a pool
+	of one process per CPU
+	"""
+	print("Loading library files")
+	print("%10s %10s %10s %10s" % ('files', 'functions', 'single', 'pool'))
+	directory = tempfile.mkdtemp()
+	try:
+		for files in [4, 16]:
+			filenames = []
+			for index in range(files):
+				filename = os.path.join(directory, 'library%d.js' % index)
+				output = file(filename, 'w')
+				output.write(generateLibrary(250).replace('helper', 'file%dhelper' % index))
+				output.close()
+				filenames.append(filename)
+			single = bestTime(jsfunkliner.loadLibraryFiles, filenames, 1)
+			pool = bestTime(jsfunkliner.loadLibraryFiles, filenames)
+			print("%10d %10d %10.3f %10.3f" % (files, files * 250, single, pool))
+	finally:
+		shutil.rmtree(directory)
+
+if __name__ == '__main__':
+	wanted = sys.argv[1:]
+	for name in sorted(globals()):
+		if name.startswith('bench_') and (not wanted or name[6:] in wanted):
+			globals()[name]()
@@ -38,6 +38,10 @@ jsdata={
 	}
 }
 error = ''
+# parsed libraries are cached here between requests, in a directory only
+# the user running the CGI can write to, or not at all, see LibraryCache
+cachedir = '/var/cache/inliner'
+maxsize = 256*1024		# the longest output that Inline All keeps expanding
 
 def printContainer(attribute):
 	label=jsdata[attribute]['label']
@@ -182,6 +186,7 @@ Limitations:
 	if jsdata['nextoutput']['data']:
 		printContainer('nextoutput')
 	print('<input type="submit" name="single" value="Inline Once"></input>')
+	print('<input type="submit" name="all" value="Inline All"></input>')
 	print("""
 <button id="leavefeedback" type="button">Send Feedback</button>
 <div id="feedbackcontainer">
@@ -213,9 +218,10 @@ for attr in ['library', 'snippet', 'output', 'nextoutput']:
 	jsdata[attr]['data'] = data.getfirst(attr, '')
 	jsdata[attr]['olddata'] = data.getfirst('old' + attr, '')
 cmd_inlinesingle = data.getfirst('single')
+cmd_inlineall = data.getfirst('all')
 cmd_feedback = data.getfirst('feedback')
 
-if cmd_inlinesingle:
+if cmd_inlinesingle or cmd_inlineall:
 	saveInputLog('input', jsdata)
 	try:
 		# if the yuser has changed the input, reset the output
@@ -230,7 +236,15 @@ if cmd_inlinesingle:
 		# find the latest snippet to do
 		snippet = jsdata['output']['data'] if jsdata['output']['data'] else jsdata['snippet']['data']
 		# inline it
-		output = jsfunkliner.inlineSingle(snippet, jsdata['library']['data'])
+		try:
+			cache = jsfunkliner.LibraryCache(cachedir)
+		except OSError:
+			cache = None
+		if cmd_inlineall:
+			# recursive functions would never stop expanding
+			output = jsfunkliner.inlineAll(snippet, jsdata['library']['data'], cache, jsdata['library']['olddata'], maxsize=maxsize)
+		else:
+			output = jsfunkliner.inlineSingle(snippet, jsdata['library']['data'], cache, jsdata['library']['olddata'])
 		# save it to the right place
 		if not jsdata['output']['data']:
 			jsdata['output']['data'] = output
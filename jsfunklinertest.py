@@ -1,8 +1,16 @@
 #!/usr/bin/python
 
 import jsfunkliner
+import jsparser
 import unittest
 import sys
+import os
+import shutil
+import tempfile
+import zlib
+import cStringIO
+import cPickle
+import gc
 
 class TestBasic(unittest.TestCase):
 	def test_idempotent(self):
@@ -831,6 +839,1097 @@ class TestPassing(unittest.TestCase):
 		output=jsfunkliner.inlineSingle(input, library)
 		self.assertEqual(expected, output)
 
+class TestLineNumbers(unittest.TestCase):
+	def test_statementlines(self):
+		input="var x = 1;\nfunction f() {\n\treturn\n\tx = 2;\n}\n/* two\nlines */ x = 3;"
+		expected=[(1, 0), (2, 0), (7, 9)]
+		output=[(node.lineno, node.column) for node in jsparser.parse(input)]
+		self.assertEqual(expected, output)
+
+	def test_afterreturn(self):
+		input="function f() {\n\treturn\n\tx = 2;\n}"
+		expected=[(3, 1), (3, 3)]
+		body=jsparser.parse(input)[0].body
+		output=[(node.lineno, node.column) for node in body[1], body[1].expression]
+		self.assertEqual(expected, output)
+
+	def test_errorposition(self):
+		input="var x = 1;\nvar y = 2 3;"
+		try:
+			jsparser.parse(input)
+			self.fail("Expected a syntax error")
+		except jsparser.SyntaxError_, e:
+			self.assertEqual((2, 10), (e.lineno, e.column))
+
+class TestLazy(unittest.TestCase):
+	def test_lazybodies(self):
+		library="function one(a) { return a + 1; }\nfunction two(b) { return b * 2; }"
+		tree=jsparser.parse(library, lazy=True)
+		self.assertEqual([False, False], [function.isParsed() for function in tree])
+		self.assertEqual('RETURN', tree[1].body[0].type)
+		self.assertEqual([False, True], [function.isParsed() for function in tree])
+
+	def test_lazybraces(self):
+		library="function one(a) { var s = '}'; /* } */ return a.replace(/[}]/g, \"}\"); }\nfunction two(b) { return b; }"
+		tree=jsparser.parse(library, lazy=True)
+		self.assertEqual(['one', 'two'], [function.name for function in tree])
+		self.assertEqual(str(jsparser.parse(library)), str(tree))
+
+	def test_lazyregexp(self):
+		library="function one(a) { if (a) /}/.test(a); while ((a)) /)/g.exec(a); return a / (2) / 3; }\nfunction add(one, two) { return one + two; }"
+		tree=jsparser.parse(library, lazy=True)
+		self.assertEqual(['one', 'add'], [function.name for function in tree])
+		self.assertEqual(str(jsparser.parse(library)), str(tree))
+		self.assertEqual("var z = (1 + 2);", jsfunkliner.inlineSingle("var z = add(1,2);", library))
+
+	def test_lazysyntaxerror(self):
+		library="function one(a) { return a +; }"
+		tree=jsparser.parse(library, lazy=True)
+		self.assertRaises(jsparser.SyntaxError_, getattr, tree[0], 'body')
+
+	def test_lazyinline(self):
+		library="function unused() { return; }\nfunction add(one, two) { return one + two; }"
+		input="var x = add(1,2);"
+		expected="var x = (1 + 2);"
+		output=jsfunkliner.inlineSingle(input, library)
+		self.assertEqual(expected, output)
+
+class TestCache(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_cachehit(self):
+		cache=jsfunkliner.LibraryCache(self.directory)
+		library="function add(one, two) { return one + two; }"
+		input="var x = add(1,2);"
+		expected="var x = (1 + 2);"
+		output=[jsfunkliner.inlineSingle(input, library, cache) for i in range(2)]
+		self.assertEqual([expected, expected], output)
+		self.assertEqual((1, 1), (cache.misses, cache.hits))
+
+	def test_cachechanged(self):
+		cache=jsfunkliner.LibraryCache(self.directory)
+		input="var x = add(1,2);"
+		jsfunkliner.inlineSingle(input, "function add(one, two) { return one + two; }", cache)
+		output=jsfunkliner.inlineSingle(input, "function add(one, two) { return one - two; }", cache)
+		self.assertEqual("var x = (1 - 2);", output)
+		self.assertEqual((2, 0), (cache.misses, cache.hits))
+
+	def test_cacheeviction(self):
+		cache=jsfunkliner.LibraryCache(self.directory, 0)
+		jsfunkliner.inlineSingle("", "function add(one, two) { return one + two; }", cache)
+		self.assertEqual([], os.listdir(self.directory))
+
+	def test_cacheedited(self):
+		cache=jsfunkliner.LibraryCache(self.directory)
+		input="var x = add(1,2);"
+		old="function add(one, two) { return one + two; }\nfunction sub(one, two) { return one - two; }"
+		new="function add(one, two) { return one * two; }\nfunction sub(one, two) { return one - two; }"
+		jsfunkliner.inlineSingle(input, old, cache)
+		output=jsfunkliner.inlineSingle(input, new, cache, old)
+		self.assertEqual("var x = (1 * 2);", output)
+		self.assertEqual((2, 1), (cache.misses, cache.hits))
+
+	def test_cachecorrupt(self):
+		cache=jsfunkliner.LibraryCache(self.directory)
+		library="function add(one, two) { return one + two; }"
+		jsfunkliner.inlineSingle("", library, cache)
+		for data in ['', 'not a cache entry', zlib.compress('not a pickle')]:
+			output=file(cache.path(library), 'wb')
+			output.write(data)
+			output.close()
+			self.assertEqual("var x = (1 + 2);", jsfunkliner.inlineSingle("var x = add(1,2);", library, cache))
+		self.assertEqual((4, 0), (cache.misses, cache.hits))
+
+	def test_cachedirectory(self):
+		directory=os.path.join(self.directory, 'cache')
+		jsfunkliner.LibraryCache(directory)
+		self.assertEqual(0700, os.stat(directory).st_mode & 0777)
+		os.chmod(directory, 0777)
+		self.assertRaises(OSError, jsfunkliner.LibraryCache, directory)
+		os.chmod(directory, 0720)
+		self.assertRaises(OSError, jsfunkliner.LibraryCache, directory)
+		os.chmod(directory, 0700)
+		link=os.path.join(self.directory, 'link')
+		os.symlink(directory, link)
+		self.assertRaises(OSError, jsfunkliner.LibraryCache, link)
+
+class TestReparse(unittest.TestCase):
+	def assertReparsed(self, old, new, lazy=False):
+		tree=jsparser.parse(old, lazy=lazy)
+		jsparser.reparse(tree, new, lazy)
+		expected=jsparser.parse(new, lazy=lazy)
+		self.assertEqual(str(expected), str(tree))
+		self.assertEqual(list(expected.statementStarts), list(tree.statementStarts))
+		self.assertEqual([f.start for f in expected.funDecls], [f.start for f in tree.funDecls])
+		self.assertEqual([v.start for v in expected.varDecls], [v.start for v in tree.varDecls])
+		self.assertEqual(new, tree.getSource())
+
+	def test_reparsestatement(self):
+		old="var a = 1;\nfunction b() { return a; }\nvar c = b();\n"
+		self.assertReparsed(old, old.replace("return a", "return a + 1\n"))
+
+	def test_reparseinsert(self):
+		old="var a = 1;\nfunction b() { return a; }\nvar c = b();\n"
+		self.assertReparsed(old, old.replace("var c", "var d = 2;\nvar c"))
+
+	def test_reparsedelete(self):
+		old="var a = 1;\nfunction b() { return a; }\nvar c = b();\n"
+		self.assertReparsed(old, "var a = 1;\nvar c = b();\n")
+
+	def test_reparsejoined(self):
+		# without the semicolon the second line continues the first statement
+		old="var a = b;\n(c || d).e();\nvar f = 1;\n"
+		self.assertReparsed(old, old.replace("b;", "b"))
+
+	def test_reparselazy(self):
+		old="function one(a) { return a + 1; }\nfunction two(b) { return b * 2; }"
+		self.assertReparsed(old, "var x = 1;\n" + old, True)
+
+	def test_reparseshifted(self):
+		old="var a = 1;\nfunction b() { return a; }\n"
+		tree=jsparser.parse(old)
+		jsparser.reparse(tree, "var a = [\n1\n];\nfunction b() { return a; }\n")
+		self.assertEqual(4, tree[1].body[0].lineno)
+		self.assertEqual('return a', tree[1].body[0].getSource())
+
+	def test_reparsesyntaxerror(self):
+		old="var a = 1;\nvar b = 2;\n"
+		tree=jsparser.parse(old)
+		expected=str(tree)
+		self.assertRaises(jsparser.SyntaxError_, jsparser.reparse, tree, "var a = 1;\nvar b = ;\n")
+		self.assertEqual(expected, str(tree))
+		self.assertEqual(old, tree.getSource())
+
+class TestDeepNesting(unittest.TestCase):
+	# deeper than the default recursion limit
+	depth=5000
+
+	def test_deepstatements(self):
+		tree=jsparser.parse('if (a) ' * self.depth + 'b();')
+		for level in range(self.depth + 1):
+			tree=tree[0] if tree.type == 'SCRIPT' else tree.thenPart
+		self.assertEqual('SEMICOLON', tree.type)
+
+	def test_deepfunctions(self):
+		library='f(function () {' * self.depth + 'x();' + '});' * self.depth
+		self.assertEqual(1, len(jsparser.parse(library)))
+		self.assertEqual(1, len(jsparser.parse(library, lazy=True)))
+
+	def test_deepliterals(self):
+		tree=jsparser.parse('x = ' + '[{a:' * self.depth + '1' + '}]' * self.depth + ';')
+		self.assertEqual('ARRAY_INIT', tree[0].expression[1].type)
+
+	def test_deepinline(self):
+		library="function add(one, two) { return one + two; }"
+		input='if (b) ' * self.depth + '{ var x = add(' + '+'.join(['b'] * self.depth) + ', 2) + c; }'
+		output=jsfunkliner.inlineSingle(input, library)
+		self.assertTrue(output.endswith('+b + 2) + c; }'))
+
+	def test_deepstr(self):
+		tree=jsparser.parse('x = ' + '(' * self.depth + 'a' + ')' * self.depth + ';')
+		self.assertEqual(self.depth, str(tree).count('type: GROUP'))
+
+class TestLibraryFiles(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def writeFiles(self, *texts):
+		filenames = []
+		for index, text in enumerate(texts):
+			filename = os.path.join(self.directory, 'library%d.js' % index)
+			output = file(filename, 'w')
+			output.write(text)
+			output.close()
+			filenames.append(filename)
+		return filenames
+
+	def test_filesinline(self):
+		libraries=["function add(one, two) { return one + two; }", "\n\nobject = function(){};\nobject.prototype={\n sub : function(one, two) {\n  return one - two;\n }\n};\ninstance = new object();"]
+		input="var x = add(1,2) + instance.sub(3, 4);"
+		expected=jsfunkliner.inlineSingle(input, '\n'.join(libraries))
+		filenames=self.writeFiles(*libraries)
+		self.assertEqual(expected, jsfunkliner.inlineFiles(input, filenames, 2))
+		self.assertEqual(expected, jsfunkliner.inlineFiles(input, filenames, 1))
+
+	def test_filesorder(self):
+		filenames=self.writeFiles("function one() { return 1; }", "function two() { return 2; }", "function three() { return 3; }")
+		trees=jsfunkliner.parseLibraryFiles(filenames, 2)
+		self.assertEqual(['one', 'two', 'three'], [tree[0].name for tree in trees])
+		self.assertEqual(filenames, [tree.filename for tree in trees])
+
+	def test_filessyntaxerror(self):
+		filenames=self.writeFiles("function one() { return 1; }", "\nvar two = 2 +;")
+		try:
+			jsfunkliner.loadLibraryFiles(filenames, 2)
+		except jsparser.SyntaxError_, e:
+			self.assertEqual((filenames[1], 2), (e.filename, e.lineno))
+		else:
+			self.fail("no syntax error")
+
+class TestPratt(unittest.TestCase):
+	def assertSameTree(self, source):
+		self.assertEqual(str(jsparser.parse(source, pratt=False)), str(jsparser.parse(source, pratt=True)))
+
+	def assertSameError(self, source):
+		messages=[]
+		for pratt in (False, True):
+			try:
+				jsparser.parse(source, pratt=pratt)
+				self.fail("parsed " + source)
+			except jsparser.SyntaxError_, e:
+				messages.append(str(e))
+		self.assertEqual(messages[0], messages[1])
+
+	def test_prattoperators(self):
+		self.assertSameTree("x = a + b * c - d / e % f << 2 | g & h ^ i;")
+		self.assertSameTree("x = !a && b || c == d != e === f;")
+		self.assertSameTree("x = typeof a == 'b' && delete c.d && void 0 instanceof e;")
+		self.assertSameTree("a = b += c -= d;\nx = -a - -b + +c - ~d;")
+		self.assertSameTree("x = a++ + ++b - c-- - --d;\ne\n++f;")
+		self.assertSameTree("x = (a, b), c, d;")
+		self.assertSameTree("if (a in b) c = /x[/]/g.test(d) ? 1 : 2;")
+
+	def test_prattconditionals(self):
+		self.assertSameTree("x = a ? b : c ? d : e;")
+		self.assertSameTree("x = a ? b ? c : d : e;")
+		self.assertSameTree("x = (a = b) ? c = d : e = f;")
+		self.assertSameTree("switch (a) { case b ? c : d: e(); case f + 1: break; }")
+
+	def test_prattmembers(self):
+		self.assertSameTree("f(a, b)(c)[d].e(g[h[i]]);")
+		self.assertSameTree("x = new A;\ny = new A();\nz = new A(b, c).d;\nw = new a.B[c](d);")
+		self.assertSameTree("x = function (a) { return a; }(1);")
+		self.assertSameTree("for (var i = (a in b) ? 1 : 2; i < j; i++) a[i] = (b in c);")
+		self.assertSameTree("for (a.b in c) d();\nfor (var e in f) g();")
+
+	def test_prattliterals(self):
+		self.assertSameTree("x = [1, , a + b, [c], ];\ny = [];\nz = [,];")
+		self.assertSameTree("x = {a: 1, 'b': c ? d : e, 3: function () {}, f: [g, h]};\ny = {};")
+		self.assertSameTree("x = {a: {b: {c: 1}}, d: (e, f)};")
+
+	def test_prattsyntaxerrors(self):
+		for source in ["x = a ? b;", "f(a;", "x = [a, b;", "x = {a 1};", "x = a +;",
+		               "x = (a;", "x = a.1;", "x = {1: 2, : 3};", "a ? b : c : d;", "x = );"]:
+			self.assertSameError(source)
+
+	def test_prattlazy(self):
+		library="function one(a) { return a ? a * 2 : [a, {b: a}]; }\nfunction two(b) { return b.c(b[1]); }"
+		tree=jsparser.parse(library, lazy=True, pratt=True)
+		self.assertEqual(str(jsparser.parse(library, pratt=False)), str(tree))
+
+	def test_prattreparse(self):
+		old="var a = 1;\nfunction b() { return a ? 1 : 2; }\nvar c = b();\n"
+		new=old.replace("? 1", "? [1, {x: 1}]")
+		tree=jsparser.parse(old, pratt=True)
+		jsparser.reparse(tree, new, pratt=True)
+		self.assertEqual(str(jsparser.parse(new, pratt=False)), str(tree))
+
+	def test_prattdeep(self):
+		depth=TestDeepNesting.depth
+		tree=jsparser.parse('x = ' + '(' * depth + 'a' + ')' * depth + ';', pratt=True)
+		self.assertEqual('GROUP', tree[0].expression[1].type)
+		tree=jsparser.parse('x = ' + '[{a:' * depth + '1' + '}]' * depth + ';', pratt=True)
+		self.assertEqual('ARRAY_INIT', tree[0].expression[1].type)
+		tree=jsparser.parse('x = ' + 'a ? b : ' * depth + 'c;', pratt=True)
+		self.assertEqual('HOOK', tree[0].expression[1].type)
+
+class TestSerialize(unittest.TestCase):
+	def assertRoundTrip(self, source, lazy=False):
+		tree=jsparser.parse(source, lazy=lazy)
+		text=jsparser.dumps(tree)
+		loaded=jsparser.loads(text)
+		self.assertEqual(text, jsparser.dumps(loaded))
+		self.assertEqual(str(tree), str(loaded))
+		self.assertEqual(source, loaded.getSource())
+		return loaded
+
+	def test_serializestatements(self):
+		self.assertRoundTrip("var a = 1, b = 'two';\nfunction c(d, e) { return d ? [e, , {f: /g/i}] : null; }\n"
+			"for (var h in a) { if (h) continue; else break; }\nswitch (a) { case 1: default: b++; }\n"
+			"try { c(); } catch (e) { throw e; } finally { a = 2.5e3; }")
+
+	def test_serializelinks(self):
+		tree=self.assertRoundTrip("label: while (a) { break label; }\nfunction b() {}")
+		self.assertTrue(tree[0].statement.body[0].target is tree[0])
+		self.assertTrue(tree.funDecls[0] is tree[1])
+		self.assertEqual([0, 34], list(tree.statementStarts))
+
+	def test_serializelazy(self):
+		source="function one(a) { return a + 1; }"
+		tree=jsparser.parse(source, lazy=True)
+		loaded=jsparser.loads(jsparser.dumps(tree))
+		self.assertFalse(loaded[0].isParsed())
+		self.assertEqual(str(jsparser.parse(source)), str(loaded))
+
+	def test_serializebytes(self):
+		self.assertRoundTrip("var a = '\\xff\xc3\xa9';\n// caf\xc3\xa9\n")
+		self.assertRoundTrip("var a = '\xff';")
+
+	def test_serializedeep(self):
+		depth=TestDeepNesting.depth
+		tree=jsparser.parse('x = ' + '[' * depth + '1' + ']' * depth + ';')
+		loaded=jsparser.loads(jsparser.dumps(tree))
+		self.assertEqual(jsparser.dumps(tree), jsparser.dumps(loaded))
+
+	def test_serializeversion(self):
+		text=jsparser.dumps(jsparser.parse("a;")).replace(jsparser.__version__, "0.0", 1)
+		self.assertRaises(ValueError, jsparser.loads, text)
+
+class TestTextSpans(unittest.TestCase):
+	def test_spansjoin(self):
+		text="function add(one, two) { return one + two; }"
+		spans=jsfunkliner.TextSpans()
+		spans.append(text, 0, 25)
+		spans.append(text, 25, 32)
+		spans.append("(1 + 2)")
+		spans.append(text, 41, 41)
+		spans.append(text, 41)
+		self.assertEqual(3, len(spans.texts))
+		self.assertEqual(len(spans.getvalue()), len(spans))
+		self.assertEqual("function add(one, two) { return (1 + 2); }", spans.getvalue())
+
+	def test_spansinsert(self):
+		text="var x = add(1, 2);"
+		spans=jsfunkliner.TextSpans()
+		spans.append(text, 0, 4)
+		index=spans.mark()
+		spans.append(text, 4, 8)
+		spans.append("retx0")
+		preput=jsfunkliner.TextSpans()
+		preput.append("var retx0 = 3;\n")
+		spans.insert(index, preput)
+		self.assertEqual("var var retx0 = 3;\nx = retx0", spans.getvalue())
+
+	def test_spanslong(self):
+		text="x" * 1000 + "y" * 1000
+		spans=jsfunkliner.TextSpans()
+		for index in range(5000):
+			spans.append(text, 999, 1001)
+		spans.append(text, 500, 1500)
+		self.assertEqual("xy" * 5000 + "x" * 500 + "y" * 500, spans.getvalue())
+
+	def test_spansoutput(self):
+		library="function add(one, two) { var three = one + two; return three; }"
+		input="var x = add(1,2) + add(3,4);"
+		output=cStringIO.StringIO()
+		self.assertEqual(None, jsfunkliner.inlineSingle(input, library, output=output))
+		self.assertEqual(jsfunkliner.inlineSingle(input, library), output.getvalue())
+
+class TestFlatTree(unittest.TestCase):
+	library="function add(one, two) { return one + two; }\nwindow.total = add(1, add(2, 3));\nfunction log() { window.total = 0; console.log(window.total); }"
+
+	def test_flatfind(self):
+		tree=jsparser.parse(self.library)
+		flat=jsparser.FlatTree(tree)
+		self.assertTrue(flat.nodes[0] is tree)
+		self.assertEqual([flat.nodes[number] for number in flat.find('CALL')],
+			[node for node in flat.nodes if node.type == 'CALL'])
+		self.assertEqual(3, len(flat.calls()))
+		self.assertEqual(['add(1, add(2, 3))', 'add(2, 3)'], [flat.source(number) for number in flat.calls('add')])
+		self.assertEqual(['window.total = 0'], [flat.source(number) for number in flat.find('ASSIGN', flat.find('FUNCTION')[1])])
+
+	def test_flatsubtrees(self):
+		flat=jsparser.FlatTree(jsparser.parse(self.library))
+		for number in range(1, len(flat)):
+			parent=flat.parents[number]
+			self.assertTrue(parent < number <= flat.lasts[parent])
+		first=flat.find('FUNCTION')[0]
+		self.assertEqual(['one + two'], [flat.source(number) for number in flat.findUnder(first, 'PLUS')])
+		self.assertEqual([], flat.findUnder(first, 'CALL'))
+
+	def test_flatqueries(self):
+		flat=jsparser.FlatTree(jsparser.parse(self.library))
+		self.assertEqual(2, len(flat.assignments('window.total')))
+		self.assertEqual([(0, 44), (self.library.index('function log'), len(self.library))], flat.functionSpans())
+
+	def test_flatlazy(self):
+		tree=jsparser.parse(self.library, lazy=True)
+		flat=jsparser.FlatTree(tree)
+		self.assertEqual(1, len(flat.assignments('window.total')))
+		self.assertFalse(tree[0].isParsed())
+
+class TestNodeIndex(unittest.TestCase):
+	library="function add(one, two) { return one + two; }\nwindow.total = add(1, add(2, 3)), add(4, 5), 6;\nfunction log() { console.log(window.total); }"
+
+	def assertIndexed(self, tree):
+		indexed=[node for nodes in tree.nodeIndex.byType.values() for node in nodes]
+		self.assertEqual(sorted(map(id, jsparser.walk([tree]))), sorted(map(id, indexed)))
+
+	def test_indextypes(self):
+		for pratt in (False, True):
+			tree=jsparser.parse(self.library, pratt=pratt, index=True)
+			self.assertIndexed(tree)
+			self.assertEqual(['add(1, add(2, 3))', 'add(2, 3)', 'add(4, 5)', 'console.log(window.total)'],
+				[node.getSource() for node in tree.nodeIndex.ofType('CALL')])
+			self.assertEqual(1, len(tree.nodeIndex.ofType('COMMA')))
+			self.assertEqual([], tree.nodeIndex.ofType('FOR'))
+
+	def test_indexnames(self):
+		tree=jsparser.parse(self.library, index=True)
+		self.assertEqual(3, len(tree.nodeIndex.named('add')))
+		self.assertEqual([self.library.index('one + two')], [node.start for node in tree.nodeIndex.named('one')])
+		self.assertEqual([], tree.nodeIndex.named('missing'))
+
+	def test_indexcontains(self):
+		tree=jsparser.parse(self.library, index=True)
+		starts=tree.statementStarts
+		self.assertFalse(tree.nodeIndex.contains('CALL', starts[0], starts[1]))
+		self.assertTrue(tree.nodeIndex.contains('CALL', starts[1], starts[2]))
+		self.assertFalse(tree.nodeIndex.contains('FOR', 0, len(self.library)))
+
+	def test_indexlazy(self):
+		tree=jsparser.parse(self.library, lazy=True, index=True)
+		self.assertEqual(3, len(tree.nodeIndex.ofType('CALL')))
+		self.assertFalse(tree[0].isParsed())
+
+	def test_indexreparse(self):
+		tree=jsparser.parse(self.library, index=True)
+		jsparser.reparse(tree, self.library.replace('6;', 'add(6, 7);'))
+		self.assertIndexed(tree)
+		self.assertEqual(5, len(tree.nodeIndex.ofType('CALL')))
+		self.assertEqual(4, len(jsparser.loads(jsparser.dumps(tree)).nodeIndex.named('add')))
+
+class TestVisitor(unittest.TestCase):
+	def test_dispatchtable(self):
+		table=jsfunkliner.dispatchTable({'PLUS MINUS': 'sum', 'CALL': 'call'}, 'other')
+		self.assertEqual(len(jsparser.typeNames), len(table))
+		self.assertEqual('sum', table[jsparser.typeCodes['MINUS']])
+		self.assertEqual('call', table[jsparser.typeCodes['CALL']])
+		self.assertEqual('other', table[jsparser.typeCodes['IF']])
+
+	def test_visitorsubclass(self):
+		class Counter(jsfunkliner.Visitor):
+			def __init__(self):
+				self.identifiers=0
+			def walk(self, node):
+				yield self.dispatch(self.handlers, node)
+				for child in node:
+					yield self.walk(child)
+			def countidentifier(self, node):
+				self.identifiers+=1
+				yield None
+			handlers=jsfunkliner.dispatchTable({'IDENTIFIER THIS': countidentifier})
+		counter=Counter()
+		jsparser.trampoline(counter.walk(jsparser.parse("a = b + this.c(d, 1);")[0].expression))
+		self.assertEqual(5, counter.identifiers)
+
+	def test_identifiers(self):
+		for source in ['a.b[c + d * 2](e, f ? g : h)', '{k:l,m:n - 1}', '(a >>> 2) || ~b === c', 'x++ - --y']:
+			node=jsparser.parse('x = ' + source + ';')[0].expression[1]
+			self.assertEqual(source.replace(' ? ', '?').replace(' : ', ':').replace(' - ', '-').replace(' + ', '+')
+				.replace(' * ', '*').replace(' >>> ', '>>>').replace(' || ', '||').replace(' === ', '==='),
+				jsfunkliner._crawlIdentifier(node, 'value'))
+
+	def test_unhandledpieces(self):
+		library="function f(a) { window.x = new Thing(a, /re/g, void a); return typeof a; }"
+		input="var y = f(z);"
+		output="var rety0 = undefined;\nwindow.x = new Thing(z, /re/g, void z); rety0 = typeof z;\nvar y = rety0;"
+		stdout=sys.stdout
+		sys.stdout=cStringIO.StringIO()
+		try:
+			self.assertEqual(output, jsfunkliner.inlineSingle(input, library))
+			self.assertEqual('', sys.stdout.getvalue())
+		finally:
+			sys.stdout=stdout
+
+	def test_unaryarguments(self):
+		library="function add(one, two) { return one + two; }"
+		stdout=sys.stdout
+		sys.stdout=cStringIO.StringIO()
+		try:
+			self.assertEqual('var z = (-1 + 2);', jsfunkliner.inlineSingle('var z = add(-1, 2);', library))
+			self.assertEqual('var z = (- -1 + typeof x);', jsfunkliner.inlineSingle('var z = add(- -1, typeof x);', library))
+			self.assertEqual('var z = ([1, , 2] + /re/g);', jsfunkliner.inlineSingle('var z = add([1,,2], /re/g);', library))
+			self.assertEqual('', sys.stdout.getvalue())
+		finally:
+			sys.stdout=stdout
+
+	def test_unhandledstatements(self):
+		library="function f(a) { while (b) { g(a); } with (a) { h(a); } }"
+		input="f(z);"
+		output="while (b) { g(z); } with (a) { h(z); };"
+		self.assertEqual(output, jsfunkliner.inlineSingle(input, library))
+
+class TestPrototypes(unittest.TestCase):
+	library="function Thing() {}\nThing.prototype.add = function(one, two) { return one + two; };\none = new Thing();\ntwo = new Thing();"
+
+	def test_sharedmembers(self):
+		library, env=jsfunkliner.loadLibrary(self.library)
+		self.assertTrue(env.get('one').members is env.get('Thing.prototype').members)
+		self.assertEqual(['add'], env.get('one').keys())
+		env.set('two.extra', jsfunkliner.JSObject())
+		self.assertEqual(['add', 'extra'], sorted(env.get('two').keys()))
+		self.assertEqual(None, env.get('Thing.prototype.extra'))
+		self.assertEqual(None, env.get('one.extra'))
+
+	def test_writeinstance(self):
+		prototype=jsfunkliner.JSObject()
+		prototype['add']=jsfunkliner.JSObject()
+		instance=jsfunkliner.JSObject(None, prototype)
+		instance['sub']=jsfunkliner.JSObject()
+		self.assertEqual(['add'], prototype.keys())
+		self.assertEqual(['add', 'sub'], sorted(instance.keys()))
+		self.assertTrue(instance['add'] is prototype['add'])
+
+	def test_writeprototype(self):
+		prototype=jsfunkliner.JSObject()
+		prototype['add']=jsfunkliner.JSObject()
+		instances=[jsfunkliner.JSObject(None, prototype) for index in range(3)]
+		prototype['sub']=jsfunkliner.JSObject()
+		self.assertEqual(['add', 'sub'], sorted(prototype.keys()))
+		for instance in instances:
+			self.assertEqual(['add'], instance.keys())
+			self.assertEqual(None, instance['sub'])
+
+	def test_extramembers(self):
+		prototype=jsfunkliner.JSObject(None, None, {'add': jsfunkliner.JSObject()})
+		instance=jsfunkliner.JSObject(None, prototype, {'sub': jsfunkliner.JSObject()})
+		self.assertFalse(instance.members is prototype.members)
+		self.assertEqual(['add'], prototype.keys())
+		self.assertEqual(['add', 'sub'], sorted(instance.keys()))
+
+	def test_inlineinstance(self):
+		input="var x = one.add(1, 2) + two.add(3, 4);"
+		output="var x = (1 + 2) + (3 + 4);"
+		self.assertEqual(output, jsfunkliner.inlineSingle(input, self.library))
+
+class TestResolve(unittest.TestCase):
+	library="function add(one, two) { return one + two; }\nwindow.tools = {};\nwindow.tools.add = add;"
+
+	def test_accesspath(self):
+		self.assertEqual(('window', 'tools', 'add'), jsfunkliner.accessPath('window.tools.add'))
+		self.assertTrue(jsfunkliner.accessPath('window.tools.add') is jsfunkliner.accessPath('window.tools.add'))
+
+	def test_accesspathlimit(self):
+		inliner=jsfunkliner.Inliner(self.library)
+		for number in range(jsfunkliner.maxAccessPaths + 10):
+			jsfunkliner.accessPath('snippet%d.name' % number)
+		self.assertTrue(len(jsfunkliner.accessPaths) <= jsfunkliner.maxAccessPaths)
+		self.assertEqual(('window', 'tools', 'add'), jsfunkliner.accessPath('window.tools.add'))
+		self.assertEqual("var x = (1 + 2);", inliner.inline("var x = window.tools.add(1, 2);"))
+
+	def test_negativecache(self):
+		library, env=jsfunkliner.loadLibrary(self.library)
+		self.assertEqual(None, env.get('console.log'))
+		self.assertTrue('console.log' in env.resolved)
+		env.set('console', jsfunkliner.JSObject())
+		env.set('console.log', jsfunkliner.JSObject(library[0]))
+		self.assertEqual(library[0], env.get('console.log').getFunction())
+
+	def test_objectwrites(self):
+		library, env=jsfunkliner.loadLibrary(self.library)
+		self.assertEqual(None, env.get('window.tools.sub'))
+		env.get('window.tools')['sub']=jsfunkliner.JSObject(library[0])
+		self.assertEqual(library[0], env.get('window.tools.sub').getFunction())
+
+	def test_scopes(self):
+		library, env=jsfunkliner.loadLibrary(self.library)
+		self.assertEqual(library[0], env.get('add').getFunction())
+		env.pushScope()
+		env.createLocal('add')
+		self.assertEqual(None, env.get('add'))
+		env.popScope()
+		self.assertEqual(library[0], env.get('add').getFunction())
+		env.pushThis(env.get('window.tools'))
+		self.assertEqual(library[0], env.get('this.add').getFunction())
+		self.assertEqual(None, env.get('this.tools'))
+		env.popThis()
+		self.assertEqual(env.get('window.tools'), env.get('this.tools'))
+
+	def test_pickledcache(self):
+		library, env=jsfunkliner.loadLibrary(self.library)
+		env.get('window.tools.add')
+		env=cPickle.loads(cPickle.dumps(env, cPickle.HIGHEST_PROTOCOL))
+		self.assertEqual({}, env.resolved)
+		self.assertEqual('add', env.get('window.tools.add').getFunction().name)
+
+	def test_unresolvablecalls(self):
+		input="document.getElementById(\"a\").focus(); x({k: function() { return 1; }}).y(add(1, 2)); var z = window.tools.add(3, 4);"
+		output="document.getElementById(\"a\").focus(); x({k: function() { return 1; }}).y(add(1, 2)); var z = (3 + 4);"
+		self.assertEqual(output, jsfunkliner.inlineSingle(input, self.library))
+
+class TestCrawl(unittest.TestCase):
+	def test_deferred(self):
+		library="function Thing() { this.helper = helper; }\none = new Thing();\nThing.prototype.add = function(a, b) { return a + b; };\nfunction helper() {}"
+		library, env=jsfunkliner.loadLibrary(library)
+		self.assertEqual(['add', 'helper'], sorted(env.get('one').keys()))
+		self.assertEqual(library[3], env.get('one.helper').getFunction())
+
+	def test_literals(self):
+		library="tools = {math: {add: function(a, b) { return a + b; }}, list: [function() { this.size = function() {}; }]};"
+		library, env=jsfunkliner.loadLibrary(library)
+		self.assertEqual('FUNCTION', env.get('tools.math.add').getFunction().type)
+		self.assertEqual('FUNCTION', env.get('tools.list.0').getFunction().type)
+		self.assertEqual([], env.get('tools.list.0.prototype').keys())
+		self.assertEqual(5, env.declarations)
+
+	def test_deepliterals(self):
+		library="x = " + "{a: " * 3000 + "function() {}" + "}" * 3000 + ";"
+		library, env=jsfunkliner.loadLibrary(library)
+		self.assertEqual(3001, env.declarations)
+		self.assertEqual('FUNCTION', env.get("x" + ".a" * 3000).getFunction().type)
+
+	def test_uninitialized(self):
+		library, env=jsfunkliner.loadLibrary("var x;\nvar y = {1: {}};\nfunction add(a, b) { return a + b; }")
+		self.assertEqual(None, env.get('x'))
+		self.assertEqual([], env.get('y.1').keys())
+		self.assertEqual('add', env.get('add').getFunction().name)
+
+	def test_collector(self):
+		self.assertTrue(gc.isenabled())
+		window=jsfunkliner.JSObject()
+		env=jsfunkliner.JSEnvironment(window, window)
+		self.assertRaises(TypeError, jsfunkliner._crawlFunctions, env, jsparser.parse("missing.x = function() {};"))
+		self.assertTrue(gc.isenabled())
+		gc.disable()
+		try:
+			jsfunkliner.loadLibrary("function add(a, b) { return a + b; }")
+			self.assertFalse(gc.isenabled())
+		finally:
+			gc.enable()
+
+class TestDemand(unittest.TestCase):
+	library="function add(one, two) { return one + two; }\nfunction unused() { return add(1, 2); }\nfunction twice(a) { return add(a, a); }\nwindow.tools = {twice: twice};\nlogger = {log: function(message) { console.log(message); }};"
+
+	def load(self, input, library=None):
+		script=jsparser.parse(input, index=True)
+		return jsfunkliner.loadDemanded(library or self.library, script, input)
+
+	def test_reached(self):
+		library, env=self.load('var x = tools.twice(3);')
+		self.assertEqual(['add', 'tools', 'twice', 'window'], sorted(env.root.keys()))
+		self.assertEqual(4, env.declarations)
+		self.assertFalse(library[1].isParsed())
+		self.assertFalse(library[4].expression[1][0][1].isParsed())
+		self.assertTrue(library[2].isParsed())
+
+	def test_instances(self):
+		library="function Thing() {}\nThing.prototype.add = function(a, b) { return a + b; };\nvar other = 1;\nthing = new Thing();"
+		library, env=self.load('thing.add(1, 2);', library)
+		self.assertEqual(['Thing', 'thing', 'window'], sorted(env.root.keys()))
+		self.assertEqual(['add'], env.get('thing').keys())
+
+	def test_constructorglobals(self):
+		library="function Setup() { function helper() { return 1; } }\nSetup();\nvar other = 1;"
+		library, env=self.load('helper();', library)
+		self.assertEqual(['Setup', 'helper', 'window'], sorted(env.root.keys()))
+
+	def test_types(self):
+		input='log = function(logger/*:logger*/, message) {logger.log(message);}'
+		library, env=self.load(input)
+		self.assertEqual(['log'], env.get('logger').keys())
+		self.assertEqual(None, env.get('add'))
+
+	def test_inline(self):
+		for input in ['var x = tools.twice(3);', 'var x = add(1, 2); logger.log(x);', 'var select="log"; logger[select]("hi");', 'missing(1);']:
+			expected=jsfunkliner.inlineSingle(input, self.library)
+			output=jsfunkliner.inlineSingle(input, self.library, demand=True)
+			self.assertEqual(expected, output)
+
+class TestReload(unittest.TestCase):
+	library="function add(one, two) { return one + two; }\nfunction Thing() {}\nThing.prototype.add = add;\none = new Thing();\ntools = {log: function(message) { console.log(message); }};"
+
+	def test_edit(self):
+		library, env=jsfunkliner.loadLibrary(self.library)
+		tools=env.get('tools')
+		library, env=jsfunkliner.reloadLibrary(library, env, self.library.replace('one + two', 'two + one'))
+		self.assertEqual(library[0], env.get('add').getFunction())
+		self.assertEqual(library[0], env.get('one.add').getFunction())
+		self.assertTrue(tools is env.get('tools'))
+		self.assertEqual('var x = (2 + 1);', jsfunkliner._inline('var x = add(1, 2);', library, env))
+
+	def assertDeclarations(self, library, text):
+		nodes=set(id(node) for node in jsparser.walk(list(library)))
+		expected=jsparser.parse(text)
+		for name in ['funDecls', 'varDecls']:
+			self.assertTrue(all(id(node) in nodes for node in getattr(library, name)))
+			self.assertEqual([node.start for node in getattr(expected, name)], [node.start for node in getattr(library, name)])
+
+	def test_unchanged(self):
+		library, env=jsfunkliner.loadLibrary(self.library)
+		objects=dict((name, env.get(name)) for name in env.root.keys())
+		library, env=jsfunkliner.reloadLibrary(library, env, self.library.replace('\n', '\n\n\t'))
+		self.assertDeclarations(library, self.library.replace('\n', '\n\n\t'))
+		digest=env.libraryDigest
+		self.assertEqual(sorted(objects), sorted(env.root.keys()))
+		for name in objects:
+			self.assertTrue(objects[name] is env.get(name))
+		library, env=jsfunkliner.reloadLibrary(library, env, self.library)
+		self.assertEqual(digest, env.libraryDigest)
+
+	def test_declarations(self):
+		text="var a = 1, b = {};\nfunction add(one, two) { var three = one; return three + two; }\nif (a) { var c = add; function sub(one) { return -one; } }\nvar d = sub;"
+		library, env=jsfunkliner.loadLibrary(text)
+		for edited in [text.replace('\n', '\n\n'), text.replace('-one', '+one'), text.replace('var a = 1, ', 'var a = 2;\nvar ')]:
+			library, env=jsfunkliner.reloadLibrary(library, env, edited)
+			self.assertDeclarations(library, edited)
+			text=edited
+
+	def test_dependents(self):
+		library, env=jsfunkliner.loadLibrary(self.library)
+		library, env=jsfunkliner.reloadLibrary(library, env, self.library.replace('Thing.prototype.add = add;', 'Thing.prototype.sum = add;'))
+		self.assertEqual(['sum'], env.get('one').keys())
+		library, env=jsfunkliner.reloadLibrary(library, env, self.library.replace('function Thing() {}', 'function Thing() { this.size = add; }'))
+		self.assertEqual(['add', 'size'], sorted(env.get('one').keys()))
+
+	def test_removed(self):
+		library, env=jsfunkliner.loadLibrary(self.library)
+		library, env=jsfunkliner.reloadLibrary(library, env, self.library.replace('function add', 'function sum'))
+		self.assertEqual(None, env.get('add'))
+		self.assertEqual(None, env.get('one.add'))
+		self.assertEqual(library[0], env.get('sum').getFunction())
+
+	def test_crawled(self):
+		edits=[self.library.replace('one = new Thing();\n', ''), 'window = {};\n' + self.library, self.library + '\nadd = tools.log;']
+		for edited in edits:
+			library, env=jsfunkliner.loadLibrary(self.library)
+			library, env=jsfunkliner.reloadLibrary(library, env, edited)
+			expected=jsfunkliner.loadLibrary(edited)[1]
+			self.assertEqual(sorted(expected.root.keys()), sorted(env.root.keys()))
+			for name in ['add', 'one', 'tools.log', 'window']:
+				self.assertEqual(expected.get(name) is None, env.get(name) is None)
+				if expected.get(name) is not None:
+					self.assertEqual(sorted(expected.get(name).keys()), sorted(env.get(name).keys()))
+
+class TestInliner(unittest.TestCase):
+	library="function add(one, two) { return one + two; }\nobject = function(){};\nobject.prototype={\n sub : function(one, two) {\n  return one - two;\n }\n};\ninstance = new object();"
+	inputs=["var x = add(1,2) + instance.sub(3, 4);", "add(x, y);", "log = function(item/*:object*/, message) {item.sub(message, 1);}", "missing(1);"]
+
+	def test_inline(self):
+		inliner=jsfunkliner.Inliner(self.library)
+		for input in self.inputs:
+			self.assertEqual(jsfunkliner.inlineSingle(input, self.library), inliner.inline(input))
+		self.assertEqual(1, len(inliner.env.this))
+		self.assertEqual(1, len(inliner.env.scopes))
+
+	def test_many(self):
+		inliner=jsfunkliner.Inliner(self.library)
+		expected=[jsfunkliner.inlineSingle(input, self.library) for input in self.inputs]
+		self.assertEqual(expected, inliner.inlineMany(self.inputs))
+		self.assertEqual(expected, inliner.inlineMany(self.inputs))
+		self.assertEqual([], inliner.inlineMany([]))
+
+	def test_output(self):
+		inliner=jsfunkliner.Inliner(self.library)
+		output=cStringIO.StringIO()
+		self.assertEqual(None, inliner.inline(self.inputs[0], output))
+		self.assertEqual(inliner.inline(self.inputs[0]), output.getvalue())
+
+	def test_files(self):
+		directory=tempfile.mkdtemp()
+		try:
+			filename=os.path.join(directory, 'library.js')
+			output=file(filename, 'w')
+			output.write(self.library)
+			output.close()
+			inliner=jsfunkliner.Inliner(filenames=[filename], processes=1)
+			self.assertEqual(jsfunkliner.inlineSingle(self.inputs[0], self.library), inliner.inline(self.inputs[0]))
+		finally:
+			shutil.rmtree(directory)
+
+	def test_failure(self):
+		inliner=jsfunkliner.Inliner(self.library)
+		walkbranch=jsfunkliner.Crawler.walkbranch
+		def failing(crawler, branch):
+			if crawler.env.scopes[-1]:
+				raise RuntimeError('failed inside a function')
+			return walkbranch(crawler, branch)
+		jsfunkliner.Crawler.walkbranch=failing
+		try:
+			self.assertRaises(RuntimeError, inliner.inline, self.inputs[2])
+		finally:
+			jsfunkliner.Crawler.walkbranch=walkbranch
+		self.assertEqual(1, len(inliner.env.this))
+		self.assertEqual([{}], inliner.env.scopes)
+		self.assertEqual(jsfunkliner.inlineSingle(self.inputs[2], self.library), inliner.inline(self.inputs[2]))
+
+class TestInlineAll(unittest.TestCase):
+	library="function one(a) { return two(a) + 1; }\nfunction two(a) { return three(a) * 2; }\nfunction three(a) { log(a); return a; }\nfunction log(message) { console.log(message); }\nfunction forever(a) { log(a); forever(a); }"
+
+	def repeated(self, input, passes):
+		for number in range(passes):
+			output=jsfunkliner.inlineSingle(input, self.library)
+			if output == input:
+				break
+			input=output
+		return input
+
+	def test_chain(self):
+		input="var x = one(1);\nvar y = 2;\nlog(y);"
+		expected=self.repeated(input, 10)
+		self.assertEqual(expected, jsfunkliner.inlineAll(input, self.library))
+		self.assertEqual(-1, expected.find('one('))
+		self.assertEqual(-1, expected.find('three('))
+		self.assertEqual(self.repeated(input, 2), jsfunkliner.inlineAll(input, self.library, passes=2))
+
+	def test_unchanged(self):
+		input="var x = missing(1);\nvar y = 2;"
+		self.assertEqual(input, jsfunkliner.inlineAll(input, self.library))
+
+	def test_limits(self):
+		input="forever(1);"
+		self.assertEqual(self.repeated(input, 5), jsfunkliner.inlineAll(input, self.library, passes=5))
+		passes=1
+		while len(self.repeated(input, passes)) <= 50:
+			passes+=1
+		self.assertEqual(self.repeated(input, passes), jsfunkliner.inlineAll(input, self.library, passes=100, maxsize=50))
+
+	def test_walked(self):
+		input="var x = one(1);\n" + "log(2);\n" * 5 + "var y = missing(2);"
+		walked=[]
+		walktop=jsfunkliner.Crawler.walktop
+		def counting(crawler, number, statement):
+			walked.append(number)
+			return walktop(crawler, number, statement)
+		jsfunkliner.Crawler.walktop=counting
+		try:
+			output=jsfunkliner.inlineAll(input, self.library)
+		finally:
+			jsfunkliner.Crawler.walktop=walktop
+		self.assertEqual(self.repeated(input, 10), output)
+		self.assertEqual(range(7), walked[:7])
+		self.assertTrue(len(walked) < 7 * 4)
+		self.assertFalse(6 in walked[7:])
+
+	def test_inliner(self):
+		input="var x = one(1);\nlog(x);"
+		inliner=jsfunkliner.Inliner(self.library)
+		self.assertEqual(jsfunkliner.inlineAll(input, self.library), inliner.inlineAll(input))
+		output=cStringIO.StringIO()
+		self.assertEqual(None, inliner.inlineAll(input, output))
+		self.assertEqual(inliner.inlineAll(input), output.getvalue())
+
+class TestTemplate(unittest.TestCase):
+	library="function add(one, two) {\n\tone = one + two;\n\tvar three = {one: one, two: two.one};\n\treturn three.one + one;\n}\nfunction short(one) { return one * this.scale; }"
+
+	def load(self):
+		library, env=jsfunkliner.loadLibrary(self.library)
+		return env, env.get('add').getFunction(), env.get('short').getFunction()
+
+	def test_expand(self):
+		env, add, short=self.load()
+		for function, replacements, retval, forceretval in [
+				(add, {'one': 'x', 'two': 'y.z'}, 'ret', False), (add, {'one': 'x'}, None, False),
+				(short, {'one': '(a + 1)', 'this': 'scaler'}, 'ret', False), (short, {'one': 2}, 'ret', True)]:
+			walker=jsfunkliner.replaceIdentifiers(self.library, function.body, dict(replacements), retval, forceretval)
+			template=jsfunkliner.Template(self.library, function.body, replacements, retval, forceretval)
+			self.assertEqual(walker.getOutput(), template.expand(replacements, retval))
+			self.assertEqual(walker.needsRetVal, template.needsRetVal)
+
+	def test_assigned(self):
+		env, add, short=self.load()
+		template=jsfunkliner.Template(self.library, add.body, ['one', 'two'], 'ret', False)
+		output=template.expand({'one': 'first', 'two': 'second'}, 'result')
+		self.assertEqual('var result = undefined;\none = one + second;\n\tvar three = {one: one, two: second.one};\n\tresult = three.one + one;\n', output)
+		self.assertEqual('var other = undefined;\n', template.expand({'one': 1, 'two': 2}, 'other')[:23])
+
+	def test_cached(self):
+		env, add, short=self.load()
+		template=jsfunkliner.functionTemplate(env, add, {'one': 'x', 'two': 'y'}, 'ret', False)
+		self.assertTrue(template is jsfunkliner.functionTemplate(env, add, {'one': 'a', 'two': 'b'}, 'other', False))
+		self.assertFalse(template is jsfunkliner.functionTemplate(env, add, {'one': 'a'}, 'ret', False))
+		self.assertFalse(template is jsfunkliner.functionTemplate(env, add, {'one': 'a', 'two': 'b'}, None, False))
+		self.assertFalse(template is jsfunkliner.functionTemplate(env, short, {'one': 'a', 'two': 'b'}, 'ret', False))
+		self.assertEqual(4, len(env.templates))
+		self.assertEqual({}, cPickle.loads(cPickle.dumps(env, cPickle.HIGHEST_PROTOCOL)).templates)
+
+	def test_inline(self):
+		input="var x = add(1, y);\nvar z = add(x, 2) + short(3);\nadd(4, 5);"
+		library, env=jsfunkliner.loadLibrary(self.library)
+		output=jsfunkliner._inline(input, library, env)
+		self.assertTrue(len(env.templates) > 0)
+		self.assertEqual(output, jsfunkliner._inline(input, library, env))
+		self.assertEqual(-1, output.find('add('))
+		self.assertNotEqual(-1, output.find('var three = {one: one, two: 2.one};'))
+
+	def test_reload(self):
+		input="var x = add(1, y);"
+		library, env=jsfunkliner.loadLibrary(self.library)
+		jsfunkliner._inline(input, library, env)
+		edited=self.library.replace('three.one + one', 'three.two - one')
+		library, env=jsfunkliner.reloadLibrary(library, env, edited)
+		self.assertEqual(jsfunkliner.inlineSingle(input, edited), jsfunkliner._inline(input, library, env))
+		self.assertNotEqual(-1, jsfunkliner._inline(input, library, env).find('three.two - one'))
+
+class TestReparseChanged(unittest.TestCase):
+	library="function one(a) { return two(a) + 1; }\nfunction two(a) { var b = a * 2;\n\treturn b; }\nfunction noisy(a, b) { noisy(b, a); }"
+
+	def shape(self, nodes):
+		return [(node.type, node.start, node.end) for node in jsparser.walk(nodes)]
+
+	def repeated(self, input, passes):
+		for number in range(passes):
+			output=jsfunkliner.inlineSingle(input, self.library)
+			if output == input:
+				break
+			input=output
+		return input
+
+	def test_parsestatements(self):
+		text="var a = 1;\nif (a) { b(); }\n/* c */ c = function() { return a; };\nd();\n"
+		tree=jsparser.parse(text)
+		statements, starts, stop=jsparser.parseStatements(tree, tree.sourceFile, tree.statementStarts[1], tree.statementStarts[3])
+		self.assertEqual(self.shape(tree[1:3]), self.shape(statements))
+		self.assertEqual(list(tree.statementStarts[1:3]), list(starts))
+		self.assertEqual(tree.statementStarts[3], stop)
+		statements, starts, stop=jsparser.parseStatements(tree, tree.sourceFile, tree.statementStarts[3], len(text))
+		self.assertEqual(self.shape(tree[3:]), self.shape(statements))
+		self.assertEqual(len(text), stop)
+		self.assertRaises(jsparser.SyntaxError_, jsparser.parseStatements, tree, jsparser.SourceFile("a = ;\n"), 0, 6)
+
+	def test_dropped(self):
+		script=jsparser.parse("a = 1;\nb();\nc = 3;\nd();\n")
+		text="a = 1;\nb(2, 3);\nb2();\nc = 3;\ne(4);\n"
+		walked=jsfunkliner._reparseChanged(script, text, [(1, 7, 22), (3, 29, 35)])
+		parsed=jsparser.parse(text)
+		self.assertEqual(set([1, 2, 4]), walked)
+		self.assertEqual(list(parsed.statementStarts), list(script.statementStarts))
+		self.assertEqual([None, None], [script[0], script[3]])
+		for number in walked:
+			self.assertEqual(self.shape([parsed[number]]), self.shape([script[number]]))
+		self.assertEqual(text, script.sourceFile.text)
+		self.assertEqual(len(text), script.end)
+
+	def test_fallback(self):
+		script=jsparser.parse("a = 1;\nb = 2;\n")
+		text="a = 1 +\nc;\nb = 2;\n"
+		walked=jsfunkliner._reparseChanged(script, text, [(0, 0, 8)])
+		parsed=jsparser.parse(text)
+		self.assertEqual(set([0, 1]), walked)
+		self.assertEqual([0, 11], list(script.statementStarts))
+		self.assertEqual(self.shape(parsed[:]), self.shape(script[:]))
+
+	def test_scattered(self):
+		input="".join("var x%d = one(%d);\n" % (number, number) + "y = %d;\n" % number * 10 for number in range(20))
+		parsed=[]
+		parseStatements=jsparser.parseStatements
+		def recording(tree, file, begin, end, *args):
+			parsed.append(end - begin)
+			return parseStatements(tree, file, begin, end, *args)
+		jsparser.parseStatements=recording
+		try:
+			output=jsfunkliner.inlineAll(input, self.library)
+		finally:
+			jsparser.parseStatements=parseStatements
+		self.assertEqual(self.repeated(input, 10), output)
+		self.assertEqual(-1, output.find('two('))
+		self.assertTrue(len(parsed) > 0)
+		self.assertTrue(sum(parsed) < len(output))
+
+	def test_broken(self):
+		input="y = noisy(0, y) + 2;\nz = 1;"
+		output=jsfunkliner.inlineAll(input, self.library, passes=1)
+		self.assertEqual(self.repeated(input, 1), output)
+		self.assertRaises(jsparser.SyntaxError_, jsparser.parse, output)
+		self.assertRaises(jsparser.SyntaxError_, jsfunkliner.inlineAll, input, self.library, passes=2)
+
+class TestManyCalls(unittest.TestCase):
+	library="function f(a, b) { var t = a * 2;\n\tlog(t);\n\treturn t + b; }\nfunction g(a) { return a + 1; }\nfunction h(a) { log(a); log(a); }"
+	calls=300
+
+	def test_expression(self):
+		input="var x = " + " + ".join("f(%d, y)" % number for number in range(self.calls)) + ";\n"
+		output=jsfunkliner.inlineSingle(input, self.library)
+		preambles=[output.find("var retx%d = undefined;\nvar t = %d * 2;\n\tlog(t);\n\tretx%d = t + y;\n" % (number, number, number)) for number in range(self.calls)]
+		self.assertEqual(0, preambles[0])
+		self.assertEqual(sorted(preambles), preambles)
+		self.assertTrue(output.endswith("var x = " + " + ".join("retx%d" % number for number in range(self.calls)) + ";\n"))
+
+	def test_array(self):
+		input="var x = [" + ", ".join("g(%d)" % number for number in range(self.calls)) + "];\n"
+		self.assertEqual("var x = [" + ", ".join("(%d + 1)" % number for number in range(self.calls)) + "];\n", jsfunkliner.inlineSingle(input, self.library))
+
+	def test_block(self):
+		input="if (y) {\n" + "".join("h(%d);\n" % number for number in range(self.calls)) + "}\n"
+		self.assertEqual("if (y) {\n" + "".join("log(%d); log(%d);\n" % (number, number) for number in range(self.calls)) + "}\n", jsfunkliner.inlineSingle(input, self.library))
+
+	def test_statements(self):
+		input="".join("var x%d = f(%d, y);\nz = g(%d);\n" % (number, number, number) for number in range(self.calls))
+		output=jsfunkliner.inlineSingle(input, self.library)
+		self.assertEqual("".join(jsfunkliner.inlineSingle(line + "\n", self.library) for line in input.splitlines()), output)
+
+	def test_spans(self):
+		spans=jsfunkliner.TextSpans()
+		expected=[]
+		text="abcdefghij" * 10
+		for number in range(self.calls):
+			spans.append(text, number % 50, number % 50 + 10)
+			index=spans.mark()
+			spans.append(";\n")
+			preput=jsfunkliner.TextSpans()
+			preput.append("%d " % number)
+			preput.append(text, 0, number % 7)
+			spans.insert(index, preput)
+			expected.append(text[number % 50:number % 50 + 10] + "%d " % number + text[:number % 7] + ";\n")
+		self.assertEqual("".join(expected), spans.getvalue())
+		self.assertEqual(len("".join(expected)), len(spans))
+
+class TestExpand(unittest.TestCase):
+	library="function top(a) { mid(a); mid(a + 1); }\nfunction mid(a) { leaf(a); leaf(a * 2); }\nfunction leaf(a) { log(a); }\nfunction ping(a) { pong(a); }\nfunction pong(a) { if (a) { ping(a - 1); } }\nfunction clash(a) { var t = a;\n\tlog(t); }\nfunction user(t) { clash(t + 1); }\nfunction masked(a, b) { a(b); this.go(b); }"
+
+	def test_hierarchy(self):
+		input="top(x);\nvar y = 1;\nmid(y);\n"
+		output="log(x); log(x*2); log(x+1); log(x+1*2);\nvar y = 1;\nlog(y); log(y*2);\n"
+		self.assertEqual(output, jsfunkliner.inlineAll(input, self.library))
+		self.assertEqual(output, jsfunkliner.inlineAll(input, self.library, expand=True))
+		self.assertEqual(output, jsfunkliner.inlineAll(input, self.library, passes=1, expand=True))
+
+	def test_once(self):
+		inliner=jsfunkliner.Inliner(self.library)
+		inliner.inlineAll("top(x);\n", expand=True)
+		self.assertEqual(['leaf', 'mid', 'top'], sorted(function.name for function, expanded in inliner.env.expanded.values()))
+		expanded=jsfunkliner._expandFunction(inliner.env, inliner.env.get('top').getFunction())
+		self.assertTrue(expanded is jsfunkliner._expandFunction(inliner.env, inliner.env.get('top').getFunction()))
+		self.assertEqual("log(z); log(z*2);\n", inliner.inlineAll("mid(z);\n", passes=1, expand=True))
+		self.assertEqual(3, len(inliner.env.expanded))
+		self.assertEqual({}, cPickle.loads(cPickle.dumps(inliner.env, cPickle.HIGHEST_PROTOCOL)).expanded)
+
+	def test_recursion(self):
+		self.assertEqual("if (3) { pong(3-1); };;\n", jsfunkliner.inlineAll("ping(3);\n", self.library, passes=1, expand=True))
+		library, env=jsfunkliner.loadLibrary(self.library)
+		jsfunkliner._expandFunction(env, env.get('ping').getFunction())
+		self.assertEqual(2, len(env.expanded))
+
+	def test_hygiene(self):
+		self.assertEqual("clash(5 + 1);\n", jsfunkliner.inlineAll("user(5);\n", self.library, passes=1, expand=True))
+		self.assertEqual(jsfunkliner.inlineAll("user(5);\n", self.library), jsfunkliner.inlineAll("user(5);\n", self.library, expand=True))
+
+	def test_returns(self):
+		library="function one(a) { return two(a) + 1; }\nfunction two(a) { var t = a * 2;\n\treturn t + three(a); }\nfunction three(a) { return a - 1; }"
+		library, env=jsfunkliner.loadLibrary(library)
+		expanded=jsfunkliner._expandFunction(env, env.get('one').getFunction())
+		self.assertEqual("function (a) { var retone0 = undefined;\nvar t = a * 2;\n\tretone0 = t + (a - 1);\nreturn retone0 + 1; }", expanded.sourceFile.text[expanded.start:expanded.end])
+		output="var x = 5;\nvar rety0 = undefined;\nvar retone0 = undefined;\nvar t = x * 2;\n\tretone0 = t + (x - 1);\nrety0 = retone0 + 1;\nvar y = rety0;\n"
+		self.assertEqual(output, jsfunkliner._inlineAll("var x = 5;\nvar y = one(x);\n", library, env, passes=1, expand=True))
+
+	def test_anonymous(self):
+		library="var obj = { m: function(x) { return x * 2; } };\nvar f = function(x) { return obj.m(x) + 1; };\nvar tools = {};\ntools.y = function(x) { var t = f(x);\n\treturn t - 1; };"
+		for input in ["obj.m(6);", "var a = f(6);", "var b = tools.y(6);"]:
+			self.assertEqual(jsfunkliner.inlineAll(input, library), jsfunkliner.inlineAll(input, library, expand=True))
+		inliner=jsfunkliner.Inliner(library)
+		self.assertEqual("var a = ((6 * 2) + 1);", inliner.inlineAll("var a = f(6);", passes=1, expand=True))
+
+	def test_masked(self):
+		library, env=jsfunkliner.loadLibrary(self.library)
+		masked=env.get('masked').getFunction()
+		self.assertTrue(masked is jsfunkliner._expandFunction(env, masked))
+		self.assertEqual("f(2); this.go(2);\n", jsfunkliner.inlineAll("masked(f, 2);\n", self.library, expand=True))
+
+	def test_reload(self):
+		library, env=jsfunkliner.loadLibrary(self.library)
+		self.assertEqual("log(x); log(x*2);\n", jsfunkliner._inlineAll("mid(x);\n", library, env, expand=True))
+		edited=self.library.replace('{ log(a); }', '{ warn(a); }')
+		library, env=jsfunkliner.reloadLibrary(library, env, edited)
+		self.assertEqual({}, env.expanded)
+		self.assertEqual("warn(x); warn(x*2);\n", jsfunkliner._inlineAll("mid(x);\n", library, env, passes=1, expand=True))
+
 if __name__ == '__main__':
 	if len(sys.argv)>1:
 		found = False
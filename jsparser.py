@@ -46,9 +46,16 @@
 __author__ = "JT Olds"
 __author_email__ = "jtolds@xnet5.com"
 __date__ = "2009-03-24"
-__all__ = ["ParseError", "parse", "tokens"]
+# Bump this whenever the parse tree changes, it keys the cached trees.
+__version__ = "1.3"
+__all__ = ["ParseError", "parse", "reparse", "dump", "dumps", "load", "loads",
+        "FlatTree", "tokens"]
 
-import re, sys, types
+import json, re, sys, types
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from operator import attrgetter, itemgetter
 
 class Object: pass
 class Error_(Exception): pass
@@ -104,9 +111,6 @@ tokens = dict(enumerate((
         "while", "with")))
 
 # Operator and punctuator mapping from token to tree node type name.
-# NB: superstring tokens (e.g., ++) must come before their substring token
-# counterparts (+ in the example), so that the opRegExp regular expression
-# synthesized from this list makes the longest possible match.
 opTypeNames = [
         ('\n',   "NEWLINE"),
         (';',    "SEMICOLON"),
@@ -169,41 +173,123 @@ for i, t in enumerate(['|', '^', '&', '<<', '>>', '>>>', '+', '-', '*', '/', '%'
     assignOps[t] = tokens[t]
     assignOps[i] = t
 
-# Build a regexp that recognizes operators and punctuators (except newline).
-opRegExpSrc = "^"
-for i, j in opTypeNames:
-    if i == "\n": continue
-    if opRegExpSrc != "^": opRegExpSrc += "|^"
-    opRegExpSrc += re.sub(r'[?|^&(){}\[\]+\-*\/\.]', lambda x: "\\%s" % x.group(0), i)
-opRegExp = re.compile(opRegExpSrc)
+# The operators and punctuators (except newline). matchInput looks up the
+# next three characters, then two, then one, so it makes the longest match.
+operators = frozenset(i for i, j in opTypeNames if i != "\n")
 
 # Convert opTypeNames to an actual dictionary now that we don't care about ordering
 opTypeNames = dict(opTypeNames)
 
 # A regexp to match floating point literals (but not integer literals).
-fpRegExp = re.compile(r'^\d+\.\d*(?:[eE][-+]?\d+)?|^\d+(?:\.\d*)?[eE][-+]?\d+|^\.\d+(?:[eE][-+]?\d+)?')
+fpRegExp = re.compile(r'\d+\.\d*(?:[eE][-+]?\d+)?|\d+(?:\.\d*)?[eE][-+]?\d+|\.\d+(?:[eE][-+]?\d+)?')
 
 # A regexp to match regexp literals.
-reRegExp = re.compile(r'^\/((?:\\.|\[(?:\\.|[^\]])*\]|[^\/])+)\/([gimy]*)')
+reRegExp = re.compile(r'\/((?:\\.|\[(?:\\.|[^\]])*\]|[^\/])+)\/([gimy]*)')
+
+# The remaining token regexps.
+intRegExp = re.compile(r'0[xX][\da-fA-F]+|0[0-7]*|\d+')
+identRegExp = re.compile(r'[$_\w]+')       # FIXME no ES3 unicode
+stringRegExp = re.compile(r'"(?:\\.|[^"])*"|\'(?:\\.|[^\'])*\'')
+# Strings without escapes or anything else eval would have to check.
+plainStringRegExp = re.compile(r'"[^"\\\n\r\0]*"|\'[^\'\\\n\r\0]*\'')
+# The whitespace and comments before a token, skipped with a single match.
+spaceRegExp = re.compile(r'(?:\s+|\/(?:\*[\s\S]*?\*\/|\/.*))*')
+sameLineSpaceRegExp = re.compile(r'(?:[ \t]+|\/(?:\*[\s\S]*?\*\/|\/.*))*')
+newlineRegExp = re.compile(r'\n')
+
+# Characters that can only start an identifier or keyword, and ones that can
+# only start an operator, so matchInput can skip the regexps that can't match.
+identifierStarts = frozenset('$_abcdefghijklmnopqrstuvwxyz'
+        'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+operatorStarts = frozenset(op[0] for op in opTypeNames
+        if op[0] not in '\n./')
+
+# Characters that can start the whitespace or a comment before a token.
+spaceStarts = frozenset(' \t\n\r\f\v/')
 
 class SyntaxError_(ParseError):
-    def __init__(self, message, filename, lineno):
+    def __init__(self, message, filename, lineno, column=None):
         ParseError.__init__(self, "Syntax error: %s\n%s:%s" %
                 (message, filename, lineno))
+        self.filename = filename
+        self.lineno = lineno
+        self.column = column
+
+class SourceFile(object):
+    """
+    Javascript source text, with an index of the offset each line starts at
+
+    Line and column numbers are looked up from the index on demand, instead
+    of being counted while scanning.
+    """
+    def __init__(self, text, filename=None, firstLine=1):
+        self.text = text
+        self.filename = filename
+        self.firstLine = firstLine
+        self.lineStarts = array('l', [0])
+        self.lineStarts.extend(m.end() for m in newlineRegExp.finditer(text))
+
+    # The line index is rebuilt rather than pickled with the text.
+    def __getstate__(self):
+        return self.text, self.filename, self.firstLine
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def replace(self, start, end, text):
+        """Replace the text from start to end, updating the line index"""
+        old = self.lineStarts
+        self.text = self.text[:start] + text + self.text[end:]
+        delta = len(text) - (end - start)
+        self.lineStarts = old[:bisect_right(old, start)]
+        self.lineStarts.extend(m.end() for m in
+                newlineRegExp.finditer(self.text, start, start + len(text)))
+        self.lineStarts.extend(offset + delta for offset in
+                old[bisect_right(old, end):])
+
+    def lineno(self, offset):
+        return self.firstLine + bisect_right(self.lineStarts, offset) - 1
+
+    def column(self, offset):
+        return offset - self.lineStarts[bisect_right(self.lineStarts, offset) - 1]
+
+    def position(self, offset):
+        """Return the (line, column) of the offset, columns counting from 0"""
+        i = bisect_right(self.lineStarts, offset) - 1
+        return self.firstLine + i, offset - self.lineStarts[i]
+
+class Token(object):
+    __slots__ = ("file", "type_", "value", "start", "end", "assignOp")
+
+    def __init__(self, file):
+        self.file = file
+
+    lineno = property(lambda self: self.file.lineno(self.start))
+    column = property(lambda self: self.file.column(self.start))
 
 class Tokenizer(object):
     def __init__(self, s, f, l):
         self.cursor = 0
-        self.source = str(s)
+        if isinstance(s, SourceFile):
+            self.file = s
+        else:
+            self.file = SourceFile(str(s), f, l)
+        self.source = self.file.text
         self.tokens = {}
         self.tokenIndex = 0
         self.lookahead = 0
         self.scanNewlines = False
         self.scanOperand = True
-        self.filename = f
-        self.lineno = l
+        self.filename = self.file.filename
+        # Offset of the last scanned token, after any whitespace before it.
+        self.scanStart = 0
+        # The nodes created from this tokenizer's tokens, if they're wanted
+        # for a NodeIndex.
+        self.created = None
 
     input_ = property(lambda self: self.source[self.cursor:])
+    lineno = property(lambda self: self.file.lineno(self.scanStart))
+    column = property(lambda self: self.file.column(self.scanStart))
     done = property(lambda self: self.peek() == END)
     token = property(lambda self: self.tokens.get(self.tokenIndex))
 
@@ -238,105 +324,122 @@ class Tokenizer(object):
         while self.lookahead:
             self.lookahead -= 1
             self.tokenIndex = (self.tokenIndex + 1) & 3
-            token = self.tokens.get(self.tokenIndex)
-            if getattr(token, "type_", None) != NEWLINE or self.scanNewlines:
-                return getattr(token, "type_", None)
-
-        while True:
-            input__ = self.input_
+            tt = self.tokens[self.tokenIndex].type_
+            if tt != NEWLINE or self.scanNewlines:
+                return tt
+
+        source = self.source
+        cursor = self.cursor
+        first = source[cursor:cursor + 1]
+        if first in spaceStarts:
             if self.scanNewlines:
-                match = re.match(r'^[ \t]+', input__)
+                cursor = sameLineSpaceRegExp.match(source, cursor).end()
             else:
-                match = re.match(r'^\s+', input__)
-            if match:
-                spaces = match.group(0)
-                self.cursor += len(spaces)
-                newlines = re.findall(r'\n', spaces)
-                if newlines:
-                    self.lineno += len(newlines)
-                input__ = self.input_
-
-            match = re.match(r'^\/(?:\*(?:.|\n)*?\*\/|\/.*)', input__)
-            if not match:
-                break
-            comment = match.group(0)
-            self.cursor += len(comment)
-            newlines = re.findall(r'\n', comment)
-            if newlines:
-                self.lineno += len(newlines)
-
-        self.tokenIndex = (self.tokenIndex + 1) & 3
-        token = self.tokens.get(self.tokenIndex)
+                cursor = spaceRegExp.match(source, cursor).end()
+            first = source[cursor:cursor + 1]
+        self.cursor = self.scanStart = cursor
+
+        index = self.tokenIndex = (self.tokenIndex + 1) & 3
+        token = self.tokens.get(index)
         if not token:
-            token = Object()
-            self.tokens[self.tokenIndex] = token
+            token = self.tokens[index] = Token(self.file)
 
-        if not input__:
+        if not first:
             token.type_ = END
             return END
 
-        def matchInput():
-            match = fpRegExp.match(input__)
+        token.start = cursor
+        # Identifiers are the most common tokens, so they're scanned here.
+        if first in identifierStarts:
+            match = identRegExp.match(source, cursor)
+            id_ = intern(match.group(0))
+            token.type_ = tt = keywords.get(id_, IDENTIFIER)
+            token.value = id_
+            self.cursor = token.end = match.end()
+            return tt
+
+        self.cursor = token.end = self.matchInput(token, source, cursor, first)
+        return token.type_
+
+    def matchInput(self, token, source, cursor, first):
+        """
+        Scan the token starting at cursor, whose first character is first,
+        into token, returning its end
+        """
+        # Only try the regexps that can match the first character.
+        if first not in operatorStarts:
+            match = fpRegExp.match(source, cursor)
             if match:
                 token.type_ = NUMBER
                 token.value = float(match.group(0))
-                return match.group(0)
+                return match.end()
 
-            match = re.match(r'^0[xX][\da-fA-F]+|^0[0-7]*|^\d+', input__)
+            match = intRegExp.match(source, cursor)
             if match:
                 token.type_ = NUMBER
-                token.value = eval(match.group(0))
-                return match.group(0)
+                # Like eval, base 0 reads hexadecimal and octal literals.
+                token.value = int(match.group(0), 0)
+                return match.end()
 
-            match = re.match(r'^[$_\w]+', input__)       # FIXME no ES3 unicode
+            match = identRegExp.match(source, cursor)
             if match:
-                id_ = match.group(0)
+                id_ = intern(match.group(0))
                 token.type_ = keywords.get(id_, IDENTIFIER)
                 token.value = id_
-                return match.group(0)
+                return match.end()
 
-            match = re.match(r'^"(?:\\.|[^"])*"|^\'(?:\\.|[^\'])*\'', input__)
+            match = plainStringRegExp.match(source, cursor)
+            if match:
+                token.type_ = STRING
+                token.value = match.group(0)[1:-1]
+                return match.end()
+
+            match = stringRegExp.match(source, cursor)
             if match:
                 token.type_ = STRING
                 token.value = eval(match.group(0))
-                return match.group(0)
+                return match.end()
 
             if self.scanOperand:
-                match = reRegExp.match(input__)
+                match = reRegExp.match(source, cursor)
                 if match:
                     token.type_ = REGEXP
                     token.value = {"regexp": match.group(1),
                                    "modifiers": match.group(2)}
-                    return match.group(0)
-
-            match = opRegExp.match(input__)
-            if match:
-                op = match.group(0)
-                if assignOps.has_key(op) and input__[len(op)] == '=':
-                    token.type_ = ASSIGN
-                    token.assignOp = globals()[opTypeNames[op]]
-                    token.value = op
-                    return match.group(0) + "="
-                token.type_ = globals()[opTypeNames[op]]
-                if self.scanOperand and (token.type_ in (PLUS, MINUS)):
-                    token.type_ += UNARY_PLUS - PLUS
-                token.assignOp = None
+                    return match.end()
+
+        op = source[cursor:cursor + 3]
+        if op not in operators:
+            op = op[:2]
+            if op not in operators:
+                op = op[:1]
+        if op in operators:
+            end = cursor + len(op)
+            if op in assignOps and source.startswith('=', end):
+                token.type_ = ASSIGN
+                token.assignOp = tokens[op]
                 token.value = op
-                return match.group(0)
-
-            if self.scanNewlines:
-                match = re.match(r'^\n', input__)
-                if match:
-                    token.type_ = NEWLINE
-                    return match.group(0)
-
-            raise self.newSyntaxError("Illegal token")
-
-        token.start = self.cursor
-        self.cursor += len(matchInput())
-        token.end = self.cursor
-        token.lineno = self.lineno
-        return getattr(token, "type_", None)
+                return end + 1
+            token.type_ = tokens[op]
+            if self.scanOperand and (token.type_ in (PLUS, MINUS)):
+                token.type_ += UNARY_PLUS - PLUS
+            token.assignOp = None
+            token.value = op
+            return end
+
+        if self.scanNewlines and source.startswith('\n', cursor):
+            token.type_ = NEWLINE
+            return cursor + 1
+
+        raise self.newSyntaxError("Illegal token")
+
+    def nextStart(self):
+        """Return the offset of the token the next get will return"""
+        self.peek()
+        for i in xrange(1, self.lookahead + 1):
+            token = self.tokens[(self.tokenIndex + i) & 3]
+            if token.type_ != NEWLINE or self.scanNewlines:
+                return token.start
 
     def unget(self):
         self.lookahead += 1
@@ -344,7 +447,7 @@ class Tokenizer(object):
         self.tokenIndex = (self.tokenIndex - 1) & 3
 
     def newSyntaxError(self, m):
-        return SyntaxError_(m, self.filename, self.lineno)
+        return SyntaxError_(m, self.filename, self.lineno, self.column)
 
 class CompilerContext(object):
     def __init__(self, inFunction):
@@ -358,15 +461,79 @@ class CompilerContext(object):
         self.hookLevel = 0
         self.ecmaStrictMode = False
         self.inForLoopInit = False
+        self.lazyFunctions = False
+        self.prattExpressions = False
+
+# The parsing functions below are generators, so that deeply nested code
+# doesn't use up the Python stack. To call another one, a function yields
+# the generator it returns and is sent back the result. Anything else a
+# function yields is its result, and it isn't resumed after that. A function
+# that ends without yielding a result returns None.
+def trampoline(generator):
+    """Run a generator of the form above, returning its result"""
+    stack = [generator]
+    push = stack.append
+    pop = stack.pop
+    send = generator.send
+    GeneratorType = types.GeneratorType
+    value = None
+    while True:
+        try:
+            value = send(value)
+        except StopIteration:
+            value = None
+        except Exception:
+            # Raise the error in the callers, until one handles it.
+            error = sys.exc_info()
+            pop()
+            while stack:
+                try:
+                    value = stack[-1].throw(*error)
+                    break
+                except StopIteration:
+                    value = None
+                    break
+                except Exception:
+                    error = sys.exc_info()
+                    pop()
+            else:
+                raise error[0], error[1], error[2]
+        if type(value) is GeneratorType:
+            push(value)
+            send = value.send
+            value = None
+        else:
+            pop()
+            if not stack:
+                return value
+            send = stack[-1].send
 
-def Script(t, x):
-    n = Statements(t, x)
+def Script(t, x, starts=None):
+    n = yield Statements(t, x, starts)
     n.type_ = SCRIPT
     n.funDecls = x.funDecls
     n.varDecls = x.varDecls
-    return n
+    yield n
+
+# The slot descriptors of each Node class, for __getstate__.
+slotDescriptors = {}
+
+# The attributes Node.__str__ leaves out.
+unprintedAttributes = frozenset(["type_", "target", "tokenStart", "sourceFile",
+        "bodyStart", "bodyDeclares", "prattExpressions", "statementStarts",
+        "nodeIndex"])
 
 class Node(list):
+    """
+    A parse tree node, with its operands or statements as list items
+
+    Nodes keep offsets into the SourceFile they were parsed from instead of a
+    reference to the tokenizer. The attributes most nodes use are slots, any
+    others go into a __dict__ that is only created when first needed.
+    """
+    __slots__ = ("type_", "value", "start", "end", "tokenStart", "sourceFile",
+            "assignOp", "expression", "name", "initializer", "params", "body",
+            "functionForm", "condition", "thenPart", "elsePart", "__dict__")
 
     def __init__(self, t, type_=None, args=[]):
         list.__init__(self)
@@ -378,18 +545,22 @@ class Node(list):
             else:
                 self.type_ = getattr(token, "type_", None)
             self.value = token.value
-            self.lineno = token.lineno
+            self.tokenStart = token.start
             self.start = token.start
             self.end = token.end
         else:
             self.type_ = type_
-            self.lineno = t.lineno
-        self.tokenizer = t
+            self.tokenStart = t.scanStart
+        self.sourceFile = t.file
+        if t.created is not None:
+            t.created.append(self)
 
         for arg in args:
             self.append(arg)
 
-    type = property(lambda self: tokenstr(self.type_))
+    type = property(lambda self: typeNames[self.type_])
+    lineno = property(lambda self: self.sourceFile.lineno(self.tokenStart))
+    column = property(lambda self: self.sourceFile.column(self.tokenStart))
 
     # Always use push to add operands to an expression, to update start and end.
     def append(self, kid, numbers=[]):
@@ -400,67 +571,153 @@ class Node(list):
                 self.end = kid.end
         return list.append(self, kid)
 
+    def attributes(self):
+        """Return the names of the attributes set on this node"""
+        names = [name for cls in type(self).__mro__
+                for name in getattr(cls, "__slots__", ())
+                if name != "__dict__" and hasattr(self, name)]
+        names.extend(getattr(self, "__dict__", ()))
+        return names
+
+    def __getstate__(self):
+        # Read the slots through their descriptors, so that pickling doesn't
+        # parse the body of a LazyFunction.
+        cls = type(self)
+        try:
+            descriptors = slotDescriptors[cls]
+        except KeyError:
+            # None for the slots no property shadows, getattr can read those.
+            descriptors = slotDescriptors[cls] = [(name, c.__dict__[name]
+                    if getattr(cls, name) is not c.__dict__[name] else None)
+                    for c in reversed(cls.__mro__)
+                    for name in c.__dict__.get("__slots__", ())
+                    if name != "__dict__"]
+        slots = {}
+        for name, descriptor in descriptors:
+            if descriptor is None:
+                value = getattr(self, name, slots)
+                if value is not slots:
+                    slots[name] = value
+            else:
+                try:
+                    slots[name] = descriptor.__get__(self)
+                except AttributeError:
+                    pass
+        return self.__dict__ or None, slots
+
     indentLevel = 0
 
     def __str__(self):
-        a = list((str(i), v) for i, v in enumerate(self))
-        for attr in dir(self):
-            if attr[0] == "_": continue
-            elif attr == "tokenizer":
-                a.append((attr, "[object Object]"))
-            elif attr in ("append", "count", "extend", "getSource", "index",
-                    "insert", "pop", "remove", "reverse", "sort", "type_",
-                    "target", "filename", "indentLevel", "type"):
-                continue
-            else:
-                a.append((attr, getattr(self, attr)))
-        if len(self): a.append(("length", len(self)))
-        a.sort(lambda a, b: cmp(a[0], b[0]))
+        # The nodes are printed from a stack of pending strings and
+        # (node, indent level) pairs, so deep trees don't recurse.
         INDENTATION = "    "
-        Node.indentLevel += 1
-        n = Node.indentLevel
-        s = "{\n%stype: %s" % ((INDENTATION * n), tokenstr(self.type_))
-        for i, value in a:
-            s += ",\n%s%s: " % ((INDENTATION * n), i)
-            if i == "value" and self.type_ == REGEXP:
-                s += "/%s/%s" % (value["regexp"], value["modifiers"])
-            elif value is None:
-                s += "null"
-            elif value is False:
-                s += "false"
-            elif value is True:
-                s += "true"
-            elif type(value) == list:
-                s += ','.join((str(x) for x in value))
-            else:
-                s += str(value)
-        Node.indentLevel -= 1
-        n = Node.indentLevel
-        s += "\n%s}" % (INDENTATION * n)
-        return s
+        parts = []
+        pending = [(self, Node.indentLevel + 1)]
+        while pending:
+            item = pending.pop()
+            if type(item) is str:
+                parts.append(item)
+                continue
+            node, n = item
+            a = [(str(i), v) for i, v in enumerate(node)]
+            a.append(("lineno", node.lineno))
+            for attr in node.attributes():
+                if attr not in unprintedAttributes:
+                    a.append((attr, getattr(node, attr)))
+            if len(node): a.append(("length", len(node)))
+            a.sort(key=itemgetter(0))
+            indent = INDENTATION * n
+            # The text up to each child node is joined into one string.
+            s = []
+            text = ["{\n%stype: %s" % (indent, typeNames[node.type_])]
+            for i, value in a:
+                text.append(",\n%s%s: " % (indent, i))
+                if i == "value" and node.type_ == REGEXP:
+                    text.append("/%s/%s" % (value["regexp"], value["modifiers"]))
+                elif value is None:
+                    text.append("null")
+                elif value is False:
+                    text.append("false")
+                elif value is True:
+                    text.append("true")
+                elif isinstance(value, Node) or type(value) == list:
+                    if isinstance(value, Node):
+                        value = [value]
+                    for j, x in enumerate(value):
+                        if j:
+                            text.append(",")
+                        if isinstance(x, Node):
+                            s.append("".join(text))
+                            s.append((x, n + 1))
+                            text = []
+                        else:
+                            text.append(str(x))
+                else:
+                    text.append(str(value))
+            text.append("\n%s}" % (INDENTATION * (n - 1)))
+            s.append("".join(text))
+            s.reverse()
+            pending.extend(s)
+        return "".join(parts)
     __repr__ = __str__
 
     def getSource(self):
         if getattr(self, "start", None) is not None:
             if getattr(self, "end", None) is not None:
-                return self.tokenizer.source[self.start:self.end]
-            return self.tokenizer.source[self.start:]
+                return self.sourceFile.text[self.start:self.end]
+            return self.sourceFile.text[self.start:]
         if getattr(self, "end", None) is not None:
-            return self.tokenizer.source[:self.end]
-        return self.tokenizer.source[:]
+            return self.sourceFile.text[:self.end]
+        return self.sourceFile.text[:]
 
-    filename = property(lambda self: self.tokenizer.filename)
+    filename = property(lambda self: self.sourceFile.filename)
 
     def __nonzero__(self): return True
 
+class LazyFunction(Node):
+    """
+    A function whose body is parsed the first time it is used
+
+    Until then only the offset of the body's { is kept, along with whether the
+    statements directly in the body could declare anything (see
+    skipFunctionBody) and which expression engine to parse it with.
+    """
+    __slots__ = ("bodyStart", "bodyDeclares", "prattExpressions")
+
+    def getBody(self):
+        try:
+            return Node.body.__get__(self)
+        except AttributeError:
+            t = Tokenizer(self.sourceFile, None, None)
+            t.cursor = self.bodyStart
+            x = CompilerContext(True)
+            x.lazyFunctions = True
+            x.prattExpressions = self.prattExpressions
+            body = trampoline(FunctionBody(t, x))
+            Node.body.__set__(self, body)
+            return body
+
+    def setBody(self, body):
+        Node.body.__set__(self, body)
+
+    body = property(getBody, setBody)
+
+    def isParsed(self):
+        """Return whether the body has been parsed yet"""
+        try:
+            Node.body.__get__(self)
+        except AttributeError:
+            return False
+        return True
+
 # Statement stack and nested statement handler.
 def nest(t, x, node, func, end=None):
     x.stmtStack.append(node)
-    n = func(t, x)
+    n = yield func(t, x)
     x.stmtStack.pop()
     n.end=t.cursor
     if end: t.mustMatch(end)
-    return n
+    yield n
 
 def tokenstr(tt):
     t = tokens[tt]
@@ -468,19 +725,27 @@ def tokenstr(tt):
         return opTypeNames[t]
     return t.upper()
 
-def Statements(t, x):
+# Node type names by type code, so Node.type is a table lookup. The names are
+# interned, so comparing them against string literals is usually an identity
+# check.
+typeNames = tuple(intern(tokenstr(tt)) for tt in
+        range(len([tt for tt in tokens if isinstance(tt, int)])))
+
+def Statements(t, x, starts=None):
     n = Node(t, BLOCK)
     x.stmtStack.append(n)
     while not t.done and t.peek() != RIGHT_CURLY:
-        n.append(Statement(t, x))
+        if starts is not None:
+            starts.append(t.nextStart())
+        n.append((yield Statement(t, x)))
     x.stmtStack.pop()
-    return n
+    yield n
 
 def Block(t, x):
     t.mustMatch(LEFT_CURLY)
-    n = Statements(t, x)
+    n = yield Statements(t, x)
     t.mustMatch(RIGHT_CURLY)
-    return n
+    yield n
 
 DECLARED_FORM = 0
 EXPRESSED_FORM = 1
@@ -496,32 +761,36 @@ def Statement(t, x):
             type_ = STATEMENT_FORM
         else:
             type_ = DECLARED_FORM
-        return FunctionDefinition(t, x, True, type_)
+        f = yield FunctionDefinition(t, x, True, type_)
+        yield f
+        return
 
     elif tt == LEFT_CURLY:
-        n = Statements(t, x)
+        n = yield Statements(t, x)
         t.mustMatch(RIGHT_CURLY)
         n.end = t.token.end
-        return n
+        yield n
+        return
 
     elif tt == IF:
         n = Node(t)
-        n.condition = ParenExpression(t, x)
+        n.condition = yield ParenExpression(t, x)
         x.stmtStack.append(n)
-        n.thenPart = Statement(t, x)
+        n.thenPart = yield Statement(t, x)
         n.end = n.thenPart.end
         if t.match(ELSE):
-            n.elsePart = Statement(t, x)
+            n.elsePart = yield Statement(t, x)
             n.end = n.elsePart.end
         else:
             n.elsePart = None
         x.stmtStack.pop()
-        return n
+        yield n
+        return
 
     elif tt == SWITCH:
         n = Node(t)
         t.mustMatch(LEFT_PAREN)
-        n.discriminant = Expression(t, x)
+        n.discriminant = yield Expression(t, x)
         t.mustMatch(RIGHT_PAREN)
         n.cases = []
         n.defaultIndex = -1
@@ -538,7 +807,7 @@ def Statement(t, x):
                 if tt == DEFAULT:
                     n.defaultIndex = len(n.cases)
                 else:
-                    n2.caseLabel = Expression(t, x, COLON)
+                    n2.caseLabel = yield Expression(t, x, COLON)
             else:
                 raise t.newSyntaxError("Invalid switch case")
             t.mustMatch(COLON)
@@ -546,10 +815,11 @@ def Statement(t, x):
             while True:
                 tt = t.peek()
                 if(tt == CASE or tt == DEFAULT or tt == RIGHT_CURLY): break
-                n2.statements.append(Statement(t, x))
+                n2.statements.append((yield Statement(t, x)))
             n.cases.append(n2)
         x.stmtStack.pop()
-        return n
+        yield n
+        return
 
     elif tt == FOR:
         n = Node(t)
@@ -561,9 +831,9 @@ def Statement(t, x):
             x.inForLoopInit = True
             if tt == VAR or tt == CONST:
                 t.get()
-                n2 = Variables(t, x)
+                n2 = yield Variables(t, x)
             else:
-                n2 = Expression(t, x)
+                n2 = yield Expression(t, x)
             x.inForLoopInit = False
 
         if n2 and t.match(IN):
@@ -579,7 +849,7 @@ def Statement(t, x):
             else:
                 n.iterator = n2
                 n.varDecl = None
-            n.object = Expression(t, x)
+            n.object = yield Expression(t, x)
         else:
             if n2:
                 n.setup = n2
@@ -589,35 +859,38 @@ def Statement(t, x):
             if t.peek() == SEMICOLON:
                 n.condition = None
             else:
-                n.condition = Expression(t, x)
+                n.condition = yield Expression(t, x)
             t.mustMatch(SEMICOLON)
             if t.peek() == RIGHT_PAREN:
                 n.update = None
             else:
-                n.update = Expression(t, x)
+                n.update = yield Expression(t, x)
         t.mustMatch(RIGHT_PAREN)
-        n.body = nest(t, x, n, Statement)
+        n.body = yield nest(t, x, n, Statement)
         n.end = t.cursor
-        return n
+        yield n
+        return
 
     elif tt == WHILE:
         n = Node(t)
         n.isLoop = True
-        n.condition = ParenExpression(t, x)
-        n.body = nest(t, x, n, Statement)
-        return n
+        n.condition = yield ParenExpression(t, x)
+        n.body = yield nest(t, x, n, Statement)
+        yield n
+        return
 
     elif tt == DO:
         n = Node(t)
         n.isLoop = True
-        n.body = nest(t, x, n, Statement, WHILE)
-        n.condition = ParenExpression(t, x)
+        n.body = yield nest(t, x, n, Statement, WHILE)
+        n.condition = yield ParenExpression(t, x)
         if not x.ecmaStrictMode:
             # <script language="JavaScript"> (without version hints) may need
             # automatic semicolon insertion without a newline after do-while.
             # See http://bugzilla.mozilla.org/show_bug.cgi?id=238945.
             t.match(SEMICOLON)
-            return n
+            yield n
+            return
 
     elif tt in (BREAK, CONTINUE):
         n = Node(t)
@@ -648,7 +921,7 @@ def Statement(t, x):
 
     elif tt == TRY:
         n = Node(t)
-        n.tryBlock = Block(t, x)
+        n.tryBlock = yield Block(t, x)
         n.catchClauses = []
         while t.match(CATCH):
             n2 = Node(t)
@@ -659,24 +932,25 @@ def Statement(t, x):
                     raise t.newSyntaxError("Illegal catch guard")
                 if n.catchClauses and not n.catchClauses[-1].guard:
                     raise t.newSyntaxError("Gaurded catch after unguarded")
-                n2.guard = Expression(t, x)
+                n2.guard = yield Expression(t, x)
             else:
                 n2.guard = None
             t.mustMatch(RIGHT_PAREN)
-            n2.block = Block(t, x)
+            n2.block = yield Block(t, x)
             n.catchClauses.append(n2)
         if t.match(FINALLY):
-            n.finallyBlock = Block(t, x)
+            n.finallyBlock = yield Block(t, x)
         if not n.catchClauses and not getattr(n, "finallyBlock", None):
             raise t.newSyntaxError("Invalid try statement")
-        return n
+        yield n
+        return
 
     elif tt in (CATCH, FINALLY):
         raise t.newSyntaxError(tokens[tt] + " without preceding try")
 
     elif tt == THROW:
         n = Node(t)
-        n.exception = Expression(t, x)
+        n.exception = yield Expression(t, x)
 
     elif tt == RETURN:
         if not x.inFunction:
@@ -684,17 +958,18 @@ def Statement(t, x):
         n = Node(t)
         tt = t.peekOnSameLine()
         if tt not in (END, NEWLINE, SEMICOLON, RIGHT_CURLY):
-            n.value = Expression(t, x)
+            n.value = yield Expression(t, x)
             n.end = n.value.end
 
     elif tt == WITH:
         n = Node(t)
-        n.object = ParenExpression(t, x)
-        n.body = nest(t, x, n, Statement)
-        return n
+        n.object = yield ParenExpression(t, x)
+        n.body = yield nest(t, x, n, Statement)
+        yield n
+        return
 
     elif tt in (VAR, CONST):
-        n = Variables(t, x)
+        n = yield Variables(t, x)
 
     elif tt == DEBUGGER:
         n = Node(t)
@@ -702,7 +977,8 @@ def Statement(t, x):
     elif tt in (NEWLINE, SEMICOLON):
         n = Node(t, SEMICOLON)
         n.expression = None
-        return n
+        yield n
+        return
 
     else:
         if tt == IDENTIFIER:
@@ -720,12 +996,13 @@ def Statement(t, x):
                 t.get()
                 n = Node(t, LABEL)
                 n.label = label
-                n.statement = nest(t, x, n, Statement)
-                return n
+                n.statement = yield nest(t, x, n, Statement)
+                yield n
+                return
 
         n = Node(t, SEMICOLON)
         t.unget()
-        n.expression = Expression(t, x)
+        n.expression = yield Expression(t, x)
         n.end = n.expression.end
 
     if t.lineno == t.token.lineno:
@@ -733,10 +1010,13 @@ def Statement(t, x):
         if tt not in (END, NEWLINE, SEMICOLON, RIGHT_CURLY):
             raise t.newSyntaxError("Missing ; before statement")
     t.match(SEMICOLON)
-    return n
+    yield n
 
 def FunctionDefinition(t, x, requireName, functionForm):
-    f = Node(t)
+    if x.lazyFunctions:
+        f = LazyFunction(t)
+    else:
+        f = Node(t)
     if f.type_ != FUNCTION:
         if f.value == "get":
             f.type_ = GETTER
@@ -758,17 +1038,94 @@ def FunctionDefinition(t, x, requireName, functionForm):
         if t.peek() != RIGHT_PAREN:
             t.mustMatch(COMMA)
 
-    t.mustMatch(LEFT_CURLY)
-    x2 = CompilerContext(True)
-    f.body = Script(t, x2)
-    t.mustMatch(RIGHT_CURLY)
-    f.body.end = t.token.end
+    if x.lazyFunctions:
+        t.mustMatch(LEFT_CURLY)
+        f.bodyStart = t.token.start
+        f.bodyDeclares = skipFunctionBody(t)
+        f.prattExpressions = x.prattExpressions
+    else:
+        f.body = yield FunctionBody(t, x)
     f.end = t.token.end
 
     f.functionForm = functionForm
     if functionForm == DECLARED_FORM:
         x.funDecls.append(f)
-    return f
+    yield f
+
+def FunctionBody(t, x):
+    t.mustMatch(LEFT_CURLY)
+    x2 = CompilerContext(True)
+    x2.lazyFunctions = x.lazyFunctions
+    x2.prattExpressions = x.prattExpressions
+    n = yield Script(t, x2)
+    t.mustMatch(RIGHT_CURLY)
+    n.end = t.token.end
+    yield n
+
+# Tokens after which a / divides instead of starting a regexp literal.
+operandEnds = set([IDENTIFIER, NUMBER, STRING, REGEXP, THIS, NULL, TRUE, FALSE,
+        RIGHT_PAREN, RIGHT_BRACKET, RIGHT_CURLY, INCREMENT, DECREMENT])
+
+# Statements whose head is in parentheses, after which a / starts a regexp
+# literal, as in if (a) /b/.test(c);
+parenthesizedHeads = set([IF, WHILE, FOR, WITH])
+
+# Tokens starting an assigned value that _crawlFunctions in jsfunkliner
+# records: functions, object and array literals and new objects.
+declaredValues = set([FUNCTION, LEFT_CURLY, LEFT_BRACKET, NEW])
+
+def skipFunctionBody(t):
+    """
+    Skip the tokens of a function body whose { was just matched, up to and
+    including its closing }
+
+    Returns whether the statements directly in the body could declare
+    something _crawlFunctions in jsfunkliner looks for when it crawls a
+    constructor: a function, or a var or an assignment whose value is a
+    function, a literal, a new object or just another identifier.
+    """
+    depth = 0
+    heads = []              # for each open bracket, whether it starts a head
+    declares = False
+    assigned = False        # the previous token was = directly in the body
+    identifierLine = None   # the value assigned so far is an identifier
+    previous = None
+    while True:
+        tt = t.get()
+        operand = tt not in operandEnds
+        if tt == END:
+            raise t.newSyntaxError("Missing } after function body")
+        if identifierLine is not None:
+            if (tt in (SEMICOLON, COMMA, RIGHT_CURLY) or
+                    t.token.lineno != identifierLine):
+                declares = True
+            identifierLine = None
+        if assigned:
+            if tt in declaredValues:
+                declares = True
+            elif tt == IDENTIFIER:
+                identifierLine = t.token.lineno
+            assigned = False
+        if tt in (LEFT_CURLY, LEFT_PAREN, LEFT_BRACKET):
+            depth += 1
+            heads.append(tt == LEFT_PAREN and previous in parenthesizedHeads)
+        elif tt in (RIGHT_CURLY, RIGHT_PAREN, RIGHT_BRACKET):
+            if not depth:
+                if tt != RIGHT_CURLY:
+                    raise t.newSyntaxError("Missing } after function body")
+                break
+            depth -= 1
+            if heads.pop():
+                operand = True      # the statement after the head
+        elif not depth:
+            if tt == FUNCTION:
+                declares = True
+            elif tt == ASSIGN:
+                assigned = True
+        t.scanOperand = operand
+        previous = tt
+    t.scanOperand = True
+    return declares
 
 def Variables(t, x):
     n = Node(t)
@@ -779,18 +1136,18 @@ def Variables(t, x):
         if t.match(ASSIGN):
             if t.token.assignOp:
                 raise t.newSyntaxError("Invalid variable initialization")
-            n2.initializer = Expression(t, x, COMMA)
+            n2.initializer = yield Expression(t, x, COMMA)
         n2.readOnly = not not (n.type_ == CONST)
         n.append(n2)
         x.varDecls.append(n2)
         if not t.match(COMMA): break
-    return n
+    yield n
 
 def ParenExpression(t, x):
     t.mustMatch(LEFT_PAREN)
-    n = Expression(t, x)
+    n = yield Expression(t, x)
     t.mustMatch(RIGHT_PAREN)
-    return n
+    yield n
 
 opPrecedence = {
     "SEMICOLON": 0,
@@ -845,7 +1202,18 @@ opArity = {
 for i in opArity.copy():
     opArity[globals()[i]] = opArity[i]
 
+# Raised to leave the loops of Expression and of an object initializer in it.
+# They are only ever caught by the Expression call that raised them.
+class BreakOutOfLoops(Exception): pass
+class BreakOutOfObjectInit(Exception): pass
+
 def Expression(t, x, stop=None):
+    """Return the generator parsing an expression with the engine x uses"""
+    if x.prattExpressions:
+        return PrattExpression(t, x, stop)
+    return OperatorExpression(t, x, stop)
+
+def OperatorExpression(t, x, stop=None):
     operators = []
     operands = []
     bl = x.bracketLevel
@@ -879,7 +1247,6 @@ def Expression(t, x, stop=None):
         operands.append(n)
         return n
 
-    class BreakOutOfLoops(Exception): pass
     try:
         while True:
             tt = t.get()
@@ -968,7 +1335,8 @@ def Expression(t, x, stop=None):
             elif tt == FUNCTION:
                 if not t.scanOperand:
                     raise BreakOutOfLoops
-                operands.append(FunctionDefinition(t, x, False, EXPRESSED_FORM))
+                operands.append((yield FunctionDefinition(t, x, False,
+                        EXPRESSED_FORM)))
                 t.scanOperand = False
 
             elif tt in (NULL, THIS, TRUE, FALSE, IDENTIFIER, NUMBER, STRING,
@@ -990,7 +1358,7 @@ def Expression(t, x, stop=None):
                             t.get()
                             n.append(None)
                             continue
-                        n.append(Expression(t, x, COMMA))
+                        n.append((yield Expression(t, x, COMMA)))
                         if not t.match(COMMA):
                             break
                     t.mustMatch(RIGHT_BRACKET)
@@ -1016,7 +1384,6 @@ def Expression(t, x, stop=None):
                 x.curlyLevel += 1
                 n = Node(t, OBJECT_INIT)
 
-                class BreakOutOfObjectInit(Exception): pass
                 try:
                     if not t.match(RIGHT_CURLY):
                         while True:
@@ -1027,8 +1394,8 @@ def Expression(t, x, stop=None):
                                 if x.ecmaStrictMode:
                                     raise t.newSyntaxError("Illegal property "
                                             "accessor")
-                                n.append(FunctionDefinition(t, x, True,
-                                        EXPRESSED_FORM))
+                                n.append((yield FunctionDefinition(t, x,
+                                        True, EXPRESSED_FORM)))
                             else:
                                 if tt in (IDENTIFIER, NUMBER, STRING):
                                     id_ = Node(t)
@@ -1041,8 +1408,8 @@ def Expression(t, x, stop=None):
                                     raise t.newSyntaxError("Invalid property "
                                             "name")
                                 t.mustMatch(COLON)
-                                n.append(Node(t, PROPERTY_INIT, [id_,
-                                        Expression(t, x, COMMA)]))
+                                value = yield Expression(t, x, COMMA)
+                                n.append(Node(t, PROPERTY_INIT, [id_, value]))
                             if not t.match(COMMA): break
                         t.mustMatch(RIGHT_CURLY)
                 except BreakOutOfObjectInit, e: pass
@@ -1128,9 +1495,386 @@ def Expression(t, x, stop=None):
     t.unget()
     while operators:
         reduce_()
-    return operands.pop()
+    yield operands.pop()
+
+# The binding powers of the operators for PrattExpression, by token code. An
+# operator on the stack is reduced when its right binding power is at least
+# the left binding power of the operator after it. They are the precedences
+# above times four, except that ASSIGN and HOOK bind to the right and a COLON
+# reduces any ASSIGN before it, as in OperatorExpression. GROUP, INDEX and
+# CALL are never reduced by precedence.
+rightBindingPowers = [-1] * len(typeNames)
+leftBindingPowers = [-1] * len(typeNames)
+for tt, precedence in opPrecedence.items():
+    if isinstance(tt, int):
+        rightBindingPowers[tt] = leftBindingPowers[tt] = precedence * 4
+rightBindingPowers[ASSIGN] = 9
+leftBindingPowers[ASSIGN] = leftBindingPowers[HOOK] = 10
+leftBindingPowers[COLON] = 9
+leftBindingPowers[INCREMENT] = leftBindingPowers[DECREMENT] = 61  # postfix
+leftBindingPowers[LEFT_PAREN] = 65                                 # calls
+
+operatorArities = [None] * len(typeNames)
+for tt, arity in opArity.items():
+    if isinstance(tt, int):
+        operatorArities[tt] = arity
+
+# Tokens that are an operand, or that start one, where one is expected.
+operandTokens = frozenset([NULL, THIS, TRUE, FALSE, IDENTIFIER, NUMBER,
+        STRING, REGEXP])
+prefixOperators = frozenset([DELETE, VOID, TYPEOF, NOT, BITWISE_NOT,
+        UNARY_PLUS, UNARY_MINUS, NEW, INCREMENT, DECREMENT])
+binaryOperators = frozenset([IN, COMMA, OR, AND, BITWISE_OR, BITWISE_XOR,
+        BITWISE_AND, EQ, NE, STRICT_EQ, STRICT_NE, LT, LE, GE, GT, INSTANCEOF,
+        LSH, RSH, URSH, PLUS, MINUS, MUL, DIV, MOD])
+
+def tokenNode(token, type_, t):
+    """Return a new Node for a token, like Node(t, type_) does"""
+    n = list.__new__(Node)
+    n.type_ = type_
+    n.value = token.value
+    n.tokenStart = n.start = token.start
+    n.end = token.end
+    n.sourceFile = t.file
+    if t.created is not None:
+        t.created.append(n)
+    return n
+
+def reduceOperator(operators, operands, end):
+    """
+    Pop the top operator and give it its operands, like reduce_ in
+    OperatorExpression, with end the end of the current token
+    """
+    n = operators.pop()
+    op = n.type_
+    arity = operatorArities[op]
+    if arity == 2 and len(operands) >= 2:
+        # The common case, with the loop below unrolled.
+        right = operands.pop()
+        left = operands.pop()
+        start = n.start
+        if left.start < start:
+            start = left.start
+        if right.start < start:
+            start = right.start
+        n.start = start
+        if end < left.end:
+            end = left.end
+        if end < right.end:
+            end = right.end
+        if n.end < end:
+            n.end = end
+        list.extend(n, (left, right))
+        operands.append(n)
+        return n
+    if arity == -2:
+        # Flatten left-associative trees.
+        left = (len(operands) >= 2 and operands[-2])
+        if left.type_ == op:
+            left.append(operands.pop())
+            return left
+        arity = 2
+    kids = operands[-arity:]
+    del operands[-arity:]
+    start = n.start
+    for kid in kids:
+        if kid.start < start:
+            start = kid.start
+        if end < kid.end:
+            end = kid.end
+        list.append(n, kid)
+    n.start = start
+    if n.end < end:
+        n.end = end
+    operands.append(n)
+    return n
+
+def PrattExpression(t, x, stop=None, operand=None):
+    """
+    Parse an expression into the same tree OperatorExpression does, looking
+    up what each token does in the tables above
+
+    Like OperatorExpression it keeps stacks of operators and operands instead
+    of recursing, so it reduces operators in the same order and at the same
+    tokens. If the first operand has already been read, it is passed in.
+    """
+    operators = []
+    if operand is None:
+        operands = []
+    else:
+        operands = [operand]
+    push = operands.append
+    get = t.get
+    tokens = t.tokens
+    file = t.file
+    created = t.created
+    bl = x.bracketLevel
+    cl = x.curlyLevel
+    pl = x.parenLevel
+    hl = x.hookLevel
+
+    while True:
+        tt = get()
+        if tt == END: break
+        if (tt == stop and x.bracketLevel == bl and x.curlyLevel == cl and
+                x.parenLevel == pl and x.hookLevel == hl):
+            break
+        token = tokens[t.tokenIndex]
+
+        if t.scanOperand:
+            if tt in operandTokens:
+                n = list.__new__(Node)
+                n.type_ = tt
+                n.value = token.value
+                n.tokenStart = n.start = token.start
+                n.end = token.end
+                n.sourceFile = file
+                if created is not None:
+                    created.append(n)
+                push(n)
+                t.scanOperand = False
+
+            elif tt in prefixOperators:
+                operators.append(tokenNode(token, tt, t))
+
+            elif tt == LEFT_PAREN:
+                operators.append(tokenNode(token, GROUP, t))
+                x.parenLevel += 1
+
+            elif tt == LEFT_BRACKET:
+                n = tokenNode(token, ARRAY_INIT, t)
+                while True:
+                    tt = t.peek()
+                    if tt == RIGHT_BRACKET: break
+                    if tt == COMMA:
+                        t.get()
+                        n.append(None)
+                        continue
+                    if tt in operandTokens:
+                        # Most elements are a single token, which needs no
+                        # expression of its own.
+                        t.get()
+                        element = tokenNode(tokens[t.tokenIndex], tt, t)
+                        t.scanOperand = False
+                        tt = t.get()
+                        t.unget()
+                        if tt == COMMA or tt == RIGHT_BRACKET:
+                            t.scanOperand = True
+                        else:
+                            element = yield PrattExpression(t, x, COMMA,
+                                    element)
+                    else:
+                        element = yield PrattExpression(t, x, COMMA)
+                    n.append(element)
+                    if not t.match(COMMA):
+                        break
+                t.mustMatch(RIGHT_BRACKET)
+                push(n)
+                t.scanOperand = False
+
+            elif tt == LEFT_CURLY:
+                # Get and set accessors aren't parsed, as in
+                # OperatorExpression.
+                x.curlyLevel += 1
+                n = tokenNode(token, OBJECT_INIT, t)
+                if not t.match(RIGHT_CURLY):
+                    while True:
+                        tt = t.get()
+                        if tt in (IDENTIFIER, NUMBER, STRING):
+                            id_ = tokenNode(tokens[t.tokenIndex], tt, t)
+                        elif tt == RIGHT_CURLY:
+                            if x.ecmaStrictMode:
+                                raise t.newSyntaxError("Illegal trailing ,")
+                            break
+                        else:
+                            raise t.newSyntaxError("Invalid property name")
+                        t.mustMatch(COLON)
+                        tt = t.get()
+                        if tt in operandTokens:
+                            # As for array elements, values that are a
+                            # single token are read here.
+                            value = tokenNode(tokens[t.tokenIndex], tt, t)
+                            t.scanOperand = False
+                            tt = t.get()
+                            t.unget()
+                            if tt == COMMA or tt == RIGHT_CURLY:
+                                t.scanOperand = True
+                            else:
+                                value = yield PrattExpression(t, x, COMMA,
+                                        value)
+                        else:
+                            t.unget()
+                            value = yield PrattExpression(t, x, COMMA)
+                        n2 = tokenNode(t.token, PROPERTY_INIT, t)
+                        n2.append(id_)
+                        n2.append(value)
+                        n.append(n2)
+                        if not t.match(COMMA):
+                            t.mustMatch(RIGHT_CURLY)
+                            break
+                push(n)
+                t.scanOperand = False
+                x.curlyLevel -= 1
+                n.end = t.token.end
+
+            elif tt == FUNCTION:
+                push((yield FunctionDefinition(t, x, False, EXPRESSED_FORM)))
+                t.scanOperand = False
+
+            else:
+                break
+
+        elif tt in binaryOperators:
+            if (tt == IN and x.inForLoopInit and not x.hookLevel and not
+                    x.bracketLevel and not x.curlyLevel and not x.parenLevel):
+                break
+            power = leftBindingPowers[tt]
+            while (operators and
+                    rightBindingPowers[operators[-1].type_] >= power):
+                reduceOperator(operators, operands, token.end)
+            n = list.__new__(Node)
+            n.type_ = tt
+            n.value = token.value
+            n.tokenStart = n.start = token.start
+            n.end = token.end
+            n.sourceFile = file
+            if created is not None:
+                created.append(n)
+            operators.append(n)
+            t.scanOperand = True
+
+        elif tt == DOT:
+            while operators and rightBindingPowers[operators[-1].type_] >= 68:
+                reduceOperator(operators, operands, token.end)
+            t.mustMatch(IDENTIFIER)
+            token = tokens[t.tokenIndex]
+            left = operands.pop()
+            n = tokenNode(token, DOT, t)
+            n.append(left)
+            n.append(tokenNode(token, IDENTIFIER, t))
+            push(n)
+
+        elif tt == LEFT_PAREN:
+            while (operators and
+                    rightBindingPowers[operators[-1].type_] >= 65):
+                reduceOperator(operators, operands, token.end)
+            if operators:
+                n = operators[-1]
+            else:
+                n = Object()
+                n.type_ = None
+            t.scanOperand = True
+            if t.match(RIGHT_PAREN):
+                if n.type_ == NEW:
+                    operators.pop()
+                    n.append(operands.pop())
+                else:
+                    token = tokens[t.tokenIndex]
+                    callee = operands.pop()
+                    n = tokenNode(token, CALL, t)
+                    n.append(callee)
+                    n.append(tokenNode(token, LIST, t))
+                push(n)
+                t.scanOperand = False
+            else:
+                if n.type_ == NEW:
+                    n.type_ = NEW_WITH_ARGS
+                else:
+                    operators.append(tokenNode(token, CALL, t))
+                x.parenLevel += 1
+
+        elif tt == RIGHT_PAREN:
+            if x.parenLevel == pl:
+                break
+            end = token.end
+            while True:
+                tt = reduceOperator(operators, operands, end).type_
+                if tt in (GROUP, CALL, NEW_WITH_ARGS):
+                    break
+            if tt != GROUP:
+                if operands:
+                    n = operands[-1]
+                    if n[1].type_ != COMMA:
+                        n2 = tokenNode(token, LIST, t)
+                        n2.append(n[1])
+                        n[1] = n2
+                    else:
+                        n[1].type_ = LIST
+                else:
+                    raise ParseError, "Unexpected amount of operands"
+            x.parenLevel -= 1
+
+        elif tt == LEFT_BRACKET:
+            operators.append(tokenNode(token, INDEX, t))
+            t.scanOperand = True
+            x.bracketLevel += 1
+
+        elif tt == RIGHT_BRACKET:
+            if x.bracketLevel == bl:
+                break
+            end = token.end
+            while reduceOperator(operators, operands, end).type_ != INDEX:
+                continue
+            x.bracketLevel -= 1
+
+        elif tt == ASSIGN or tt == HOOK or tt == COLON:
+            power = leftBindingPowers[tt]
+            while (operators and
+                    rightBindingPowers[operators[-1].type_] >= power):
+                reduceOperator(operators, operands, token.end)
+            if tt == COLON:
+                if not operators or operators[-1].type_ != HOOK:
+                    raise t.newSyntaxError("Invalid label")
+                x.hookLevel -= 1
+            else:
+                operators.append(tokenNode(token, tt, t))
+                if tt == ASSIGN:
+                    operands[-1].assignOp = token.assignOp
+                else:
+                    x.hookLevel += 1
+            t.scanOperand = True
+
+        elif tt == INCREMENT or tt == DECREMENT:
+            # Don't cross a line boundary for postfix {in,de}crement.
+            if (tokens.get((t.tokenIndex + t.lookahead - 1) & 3).lineno !=
+                    t.lineno):
+                break
+            while (operators and
+                    rightBindingPowers[operators[-1].type_] >= 61):
+                reduceOperator(operators, operands, token.end)
+            operand = operands.pop()
+            n = tokenNode(token, tt, t)
+            n.append(operand)
+            n.postfix = True
+            push(n)
+
+        elif tt == RIGHT_CURLY:
+            if x.curlyLevel != cl:
+                raise ParseError("PANIC: right curly botch")
+            break
+
+        else:
+            break
+
+    if x.hookLevel != hl:
+        raise t.newSyntaxError("Missing : after ?")
+    if x.parenLevel != pl:
+        raise t.newSyntaxError("Missing ) in parenthetical")
+    if x.bracketLevel != bl:
+        raise t.newSyntaxError("Missing ] in index expression")
+    if t.scanOperand:
+        raise t.newSyntaxError("Missing operand")
 
-def parse(source, filename=None, starting_line_number=1):
+    t.scanOperand = True
+    t.unget()
+    if operators:
+        end = t.token.end
+        while operators:
+            reduceOperator(operators, operands, end)
+    yield operands.pop()
+
+def parse(source, filename=None, starting_line_number=1, lazy=False,
+        pratt=True, index=False):
     """Parse some Javascript
 
     Args:
@@ -1138,6 +1882,12 @@ def parse(source, filename=None, starting_line_number=1):
         filename: the filename to include in messages
         starting_line_number: the line number of the first line of the
             passed in source, for output messages
+        lazy: only parse the body of each function when it is first used,
+            syntax errors inside function bodies are then raised at that time
+        pratt: parse expressions with PrattExpression, which builds the same
+            tree as Expression but is faster, or with Expression if False
+        index: index the nodes by type and name in a NodeIndex, kept as the
+            script's nodeIndex
     Returns:
         the parsed source code data structure
     Raises:
@@ -1145,11 +1895,543 @@ def parse(source, filename=None, starting_line_number=1):
     """
     t = Tokenizer(source, filename, starting_line_number)
     x = CompilerContext(False)
-    n = Script(t, x)
+    x.lazyFunctions = lazy
+    x.prattExpressions = pratt
+    if index:
+        t.created = []
+    starts = array('l')
+    n = trampoline(Script(t, x, starts))
     if not t.done:
         raise t.newSyntaxError("Syntax error")
+    # The offset of each statement's first token, for reparse.
+    n.statementStarts = starts
+    if index:
+        n.nodeIndex = NodeIndex(t.created)
     return n
 
+def reparse(tree, source, lazy=False, pratt=True):
+    """Update a parsed script to an edited version of its source
+
+    Only the statements from the one before the edited region up to the
+    first statement after it that starts where it did before are parsed
+    again. The statements after that are kept, with their offsets shifted.
+    A nodeIndex is built again.
+
+    Args:
+        tree: the script returned by parse, it is changed in place
+        source: the new Javascript source, as a string
+        lazy, pratt: as for parse
+    Returns:
+        the updated tree
+    Raises:
+        ParseError, leaving the tree as it was
+    """
+    file = tree.sourceFile
+    old = file.text
+    source = str(source)
+    if source == old:
+        return tree
+
+    # Find the edited region, from offset prefix to oldEnd in the old text
+    # and to newEnd in the new one.
+    prefix = commonLength(old, source, 1)
+    suffix = commonLength(old[prefix:], source[prefix:], -1)
+    oldEnd = len(old) - suffix
+    newEnd = len(source) - suffix
+    delta = newEnd - oldEnd
+
+    # How a statement ends can depend on the token after it, so parsing
+    # starts a statement before the one the edit is in.
+    starts = getattr(tree, "statementStarts", array('l'))
+    first = max(bisect_right(starts, prefix) - 2, 0)
+    if first:
+        begin = starts[first]
+    else:
+        begin = 0
+
+    t = Tokenizer(SourceFile(source, file.filename, file.firstLine), None, None)
+    t.cursor = t.scanStart = begin
+    x = CompilerContext(False)
+    x.lazyFunctions = lazy
+    x.prattExpressions = pratt
+    x.stmtStack.append(tree)
+    statements = []
+    newStarts = array('l')
+    resync = len(starts)
+    while not t.done and t.peek() != RIGHT_CURLY:
+        start = t.nextStart()
+        if start >= newEnd:
+            # Past the edit, the old statements can be kept from the first
+            # one that starts at this token.
+            resync = bisect_left(starts, start - delta, first)
+            if resync < len(starts) and starts[resync] == start - delta:
+                break
+            resync = len(starts)
+        newStarts.append(start)
+        statements.append(trampoline(Statement(t, x)))
+    else:
+        if not t.done:
+            raise t.newSyntaxError("Syntax error")
+
+    if resync < len(starts):
+        keptFrom = starts[resync]
+        kept = tree[resync:]
+    else:
+        keptFrom = len(old)
+        kept = []
+    tree.funDecls = ([f for f in tree.funDecls if f.start < begin] + x.funDecls +
+            [f for f in tree.funDecls if f.start >= keptFrom])
+    tree.varDecls = ([v for v in tree.varDecls if v.start < begin] + x.varDecls +
+            [v for v in tree.varDecls if v.start >= keptFrom])
+    shift(kept, delta)
+    for node in statements:
+        retarget(node, file)
+    tree[first:] = statements + kept
+    tree.statementStarts = starts[:first] + newStarts + array('l',
+            (offset + delta for offset in starts[resync:]))
+    file.replace(prefix, oldEnd, source[prefix:newEnd])
+    if getattr(tree, "nodeIndex", None) is not None:
+        tree.nodeIndex = NodeIndex(walk([tree]))
+    return tree
+
+def parseStatements(tree, file, begin, end, lazy=False, pratt=True):
+    """Parse the statements of a script's source from one offset to another
+
+    The statements are parsed as if they were at the top level of the script
+    tree, from the first token at or after begin up to the last one that
+    starts before end, but the tree isn't changed. Their offsets are offsets
+    in the whole source.
+
+    Args:
+        tree: the script the statements are in
+        file: the SourceFile of the whole source
+        begin, end: offsets in the source
+        lazy, pratt: as for parse
+    Returns:
+        the statements, an array of the offsets of their first tokens, and
+        the offset of the first token after them, or the length of the
+        source if there is none
+    Raises:
+        ParseError
+    """
+    t = Tokenizer(file, None, None)
+    t.cursor = t.scanStart = begin
+    x = CompilerContext(False)
+    x.lazyFunctions = lazy
+    x.prattExpressions = pratt
+    x.stmtStack.append(tree)
+    statements = []
+    starts = array('l')
+    while not t.done and t.peek() != RIGHT_CURLY:
+        start = t.nextStart()
+        if start >= end:
+            return statements, starts, start
+        starts.append(start)
+        statements.append(trampoline(Statement(t, x)))
+    if not t.done:
+        raise t.newSyntaxError("Syntax error")
+    return statements, starts, len(file.text)
+
+def commonLength(a, b, direction):
+    """
+    Return the length of the common prefix of two strings, or of the common
+    suffix if direction is -1, comparing them a block at a time
+    """
+    size = min(len(a), len(b))
+    if direction < 0:
+        a, b = a[len(a) - size:][::-1], b[len(b) - size:][::-1]
+    length = 0
+    block = 4096
+    while length < size:
+        if a[length:length + block] == b[length:length + block]:
+            length += block
+        elif block > 1:
+            block //= 16
+        else:
+            break
+    return min(length, size)
+
+# The slots of a Node that can hold other nodes, besides body.
+childSlots = ("value", "expression", "initializer", "condition", "thenPart",
+        "elsePart")
+
+def walk(nodes):
+    """
+    Yield the given nodes and all the nodes under them, once each, without
+    parsing the body of a LazyFunction
+    """
+    seen = set()
+    pending = list(nodes)
+    while pending:
+        node = pending.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        yield node
+        values = [getattr(node, name, None) for name in childSlots]
+        if type(node) is not LazyFunction or node.isParsed():
+            values.append(getattr(node, "body", None))
+        if getattr(node, "__dict__", None):
+            values.extend(value for name, value in node.__dict__.iteritems()
+                    if name != "target")
+        values.extend(node)
+        for value in values:
+            if isinstance(value, Node):
+                pending.append(value)
+            elif type(value) is list:
+                pending.extend(item for item in value if isinstance(item, Node))
+
+def shift(nodes, delta):
+    """Add delta to the offsets in the given nodes and the nodes under them"""
+    for node in walk(nodes):
+        node.tokenStart += delta
+        if getattr(node, "start", None) is not None:
+            node.start += delta
+        if getattr(node, "end", None) is not None:
+            node.end += delta
+        if type(node) is LazyFunction:
+            node.bodyStart += delta
+
+def retarget(node, file):
+    """Point the node and the nodes under it at another SourceFile"""
+    for n in walk([node]):
+        n.sourceFile = file
+
+# Type codes by node type name, for load.
+typeCodes = dict((name, tt) for tt, name in enumerate(typeNames))
+
+jsonEncode = json.JSONEncoder(separators=(",", ":")).encode
+latin1Encode = json.JSONEncoder(encoding="latin-1", separators=(",", ":")).encode
+
+def encodeLine(value):
+    """
+    Encode a line of dump output, reading the byte strings in it as UTF-8,
+    or as Latin-1 if they aren't valid UTF-8, so that any bytes come back
+    unchanged. Lines read as Latin-1 are marked with "latin1": true.
+    """
+    try:
+        return jsonEncode(value) + "\n"
+    except UnicodeDecodeError:
+        value["latin1"] = True
+        return latin1Encode(value) + "\n"
+
+def dump(tree, output):
+    """Write a parse tree to a file as JSON lines
+
+    The first line holds the source text, every other line is a node:
+        {"type": "CALL", "kids": [2, 3], "attributes": {...}, "links": {...}}
+    Nodes are numbered in the order they are written, starting from the
+    tree at 0. kids are the numbers of the node's list items, links the
+    numbers of the nodes (or lists of nodes) in its attributes, and
+    attributes its other attributes. A node is written once however many
+    nodes refer to it, and the body of an unparsed LazyFunction is left
+    unparsed. A nodeIndex isn't written, it is built again by load.
+    """
+    file = tree.sourceFile
+    output.write(encodeLine({"version": __version__, "filename": file.filename,
+            "firstLine": file.firstLine, "source": file.text}))
+    numbers = {id(tree): 0}
+    pending = deque([tree])
+
+    def number(node):
+        try:
+            return numbers[id(node)]
+        except KeyError:
+            numbers[id(node)] = len(numbers)
+            pending.append(node)
+            return numbers[id(node)]
+
+    while pending:
+        node = pending.popleft()
+        attributes = {}
+        links = {}
+        record = {"type": typeNames[node.type_], "attributes": attributes,
+                "links": links,
+                "kids": [kid if kid is None else number(kid) for kid in node]}
+        if type(node) is LazyFunction:
+            record["lazy"] = True
+        values, slots = node.__getstate__()
+        if values:
+            slots.update(values)
+        del slots["type_"], slots["sourceFile"]
+        if slots.pop("nodeIndex", None):
+            record["indexed"] = True
+        for name, value in slots.iteritems():
+            if isinstance(value, Node):
+                links[name] = number(value)
+            elif type(value) is list and value and isinstance(value[0], Node):
+                links[name] = [number(item) for item in value]
+            elif type(value) is array:
+                attributes[name] = value.tolist()
+            else:
+                attributes[name] = value
+        output.write(encodeLine(record))
+
+def dumps(tree):
+    """Return a parse tree as JSON lines, see dump"""
+    output = Object()
+    output.parts = []
+    output.write = output.parts.append
+    dump(tree, output)
+    return "".join(output.parts)
+
+def encodeStrings(value, encoding):
+    """Turn the unicode strings json.loads returns back into byte strings"""
+    if type(value) is unicode:
+        return value.encode(encoding)
+    if type(value) is list:
+        return [encodeStrings(item, encoding) for item in value]
+    if type(value) is dict:
+        return dict((str(key), encodeStrings(item, encoding))
+                for key, item in value.iteritems())
+    return value
+
+def lineEncoding(value):
+    """Return the encoding the strings of a decoded dump line were read with"""
+    if value.get("latin1"):
+        return "latin-1"
+    return "utf-8"
+
+def load(input):
+    """Read a parse tree written by dump from a file, or any iterable of its
+    lines, returning its root node
+
+    Raises:
+        ValueError if the input isn't a tree dumped by this version
+    """
+    lines = iter(input)
+    header = json.loads(next(lines))
+    header = encodeStrings(header, lineEncoding(header))
+    if header.get("version") != __version__:
+        raise ValueError("Tree dumped by jsparser %s, not %s" %
+                (header.get("version"), __version__))
+    file = SourceFile(header["source"], header["filename"], header["firstLine"])
+
+    nodes = []
+    records = []
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if record.get("lazy"):
+            node = list.__new__(LazyFunction)
+        else:
+            node = list.__new__(Node)
+        node.type_ = typeCodes[record["type"]]
+        node.sourceFile = file
+        encoding = lineEncoding(record)
+        # Only the attributes can hold strings that are used as they are.
+        for name, value in record["attributes"].iteritems():
+            if type(value) is unicode:
+                value = value.encode(encoding)
+            elif type(value) is list or type(value) is dict:
+                value = encodeStrings(value, encoding)
+            if name == "statementStarts":
+                value = array('l', value)
+            setattr(node, name, value)
+        nodes.append(node)
+        records.append(record)
+
+    # Links can point at nodes written after the one they're on, so they're
+    # resolved once every node exists.
+    for node, record in zip(nodes, records):
+        list.extend(node, [kid if kid is None else nodes[kid]
+                for kid in record["kids"]])
+        for name, value in record["links"].iteritems():
+            if type(value) is list:
+                value = [nodes[item] for item in value]
+            else:
+                value = nodes[value]
+            setattr(node, name, value)
+    if not nodes:
+        raise ValueError("No nodes in the dumped tree")
+    for node, record in zip(nodes, records):
+        if record.get("indexed"):
+            node.nodeIndex = NodeIndex(walk([node]))
+    return nodes[0]
+
+def loads(text):
+    """Read a parse tree from the text returned by dumps"""
+    return load(text.split("\n"))
+
+# The attributes that refer to nodes elsewhere in the tree, rather than to
+# nodes under the one they're on.
+referenceAttributes = frozenset(["target", "funDecls", "varDecls"])
+
+class FlatTree(object):
+    """
+    A parse tree flattened into parallel arrays, with the nodes numbered in
+    preorder
+
+    types holds the type code of each node, starts and ends their offsets
+    (-1 where unset), parents the number of their parent (-1 for the root)
+    and lasts the number of the last node under them, so the nodes under
+    node i are numbered i + 1 to lasts[i]. nodes maps the numbers back to
+    the nodes. The arrays support the buffer interface, so numpy.frombuffer
+    can wrap them without copying. The body of an unparsed LazyFunction is
+    not flattened.
+    """
+    def __init__(self, tree):
+        self.sourceFile = tree.sourceFile
+        self.nodes = nodes = []
+        types = array('B')
+        self.starts = starts = array('l')
+        self.ends = ends = array('l')
+        self.parents = parents = array('l')
+        seen = set()
+        pending = [(tree, -1)]
+        while pending:
+            node, parent = pending.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            number = len(nodes)
+            nodes.append(node)
+            types.append(node.type_)
+            start = getattr(node, "start", None)
+            starts.append(-1 if start is None else start)
+            end = getattr(node, "end", None)
+            ends.append(-1 if end is None else end)
+            parents.append(parent)
+
+            # Pushed in reverse, so the list items come first, in order.
+            values = list(node)
+            values.extend(getattr(node, name, None) for name in childSlots)
+            if type(node) is not LazyFunction or node.isParsed():
+                values.append(getattr(node, "body", None))
+            if getattr(node, "__dict__", None):
+                values.extend(value for name, value in node.__dict__.iteritems()
+                        if name not in referenceAttributes)
+            for value in reversed(values):
+                if isinstance(value, Node):
+                    pending.append((value, number))
+                elif type(value) is list:
+                    pending.extend((item, number) for item in reversed(value)
+                            if isinstance(item, Node))
+
+        # A subtree is numbered contiguously, so its last node is the
+        # biggest number under it.
+        self.lasts = lasts = array('l', xrange(len(nodes)))
+        for number in xrange(len(nodes) - 1, 0, -1):
+            parent = parents[number]
+            if lasts[parent] < lasts[number]:
+                lasts[parent] = lasts[number]
+        self.types = types
+        # The type codes as a string, so find can search them with str.find.
+        self.typeString = types.tostring()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def find(self, type_, first=0, last=None):
+        """
+        Return the numbers of the nodes of a type, given by name or code,
+        from first to last, which default to the whole tree
+        """
+        if isinstance(type_, str):
+            type_ = typeCodes[type_]
+        if last is None:
+            last = len(self.nodes) - 1
+        code = chr(type_)
+        find = self.typeString.find
+        found = []
+        index = find(code, first, last + 1)
+        while index >= 0:
+            found.append(index)
+            index = find(code, index + 1, last + 1)
+        return found
+
+    def findUnder(self, number, type_):
+        """Return the numbers of the nodes of a type under a node"""
+        return self.find(type_, number + 1, self.lasts[number])
+
+    def source(self, number):
+        """Return the source text of a node"""
+        return self.sourceFile.text[self.starts[number]:self.ends[number]]
+
+    def calls(self, name=None):
+        """
+        Return the numbers of the CALL nodes, only those calling name if it
+        is given, as the source text of the callee
+        """
+        found = self.find(CALL)
+        if name is None:
+            return found
+        nodes = self.nodes
+        text = self.sourceFile.text
+        return [number for number in found
+                if text[nodes[number][0].start:nodes[number][0].end] == name]
+
+    def assignments(self, name):
+        """
+        Return the numbers of the ASSIGN nodes assigning to name, as the
+        source text of the left hand side
+        """
+        nodes = self.nodes
+        text = self.sourceFile.text
+        return [number for number in self.find(ASSIGN)
+                if text[nodes[number][0].start:nodes[number][0].end] == name]
+
+    def functionSpans(self):
+        """Return the (start, end) offsets of every FUNCTION node"""
+        starts = self.starts
+        ends = self.ends
+        return [(starts[number], ends[number]) for number in self.find(FUNCTION)]
+
+class NodeIndex(object):
+    """
+    The nodes of a script by type, and its IDENTIFIER nodes by name
+
+    byType maps type names to lists of nodes, byName identifier names to
+    lists of IDENTIFIER nodes, both sorted by the offset of the nodes' first
+    token. starts maps type names to arrays of those offsets. The nodes in
+    the body of an unparsed LazyFunction are left out.
+    """
+    def __init__(self, nodes):
+        byType = {}
+        for node in nodes:
+            try:
+                byType[node.type_].append(node)
+            except KeyError:
+                byType[node.type_] = [node]
+        # A COMMA whose operands went to the COMMA before it is left without
+        # any, and isn't in the tree.
+        if COMMA in byType:
+            byType[COMMA] = [node for node in byType[COMMA] if len(node)]
+        key = attrgetter("tokenStart")
+        self.byType = {}
+        self.starts = {}
+        for type_, found in byType.iteritems():
+            found.sort(key=key)
+            self.byType[typeNames[type_]] = found
+            self.starts[typeNames[type_]] = array('l', map(key, found))
+        self.byName = {}
+        for node in self.byType.get("IDENTIFIER", ()):
+            try:
+                self.byName[node.value].append(node)
+            except KeyError:
+                self.byName[node.value] = [node]
+
+    def ofType(self, type_):
+        """Return the nodes of a type"""
+        return self.byType.get(type_, [])
+
+    def named(self, name):
+        """Return the IDENTIFIER nodes with a name"""
+        return self.byName.get(name, [])
+
+    def contains(self, type_, start, end):
+        """Return whether the first token of a node of a type is from start
+        up to end"""
+        starts = self.starts.get(type_)
+        if not starts:
+            return False
+        index = bisect_left(starts, start)
+        return index < len(starts) and starts[index] < end
+
 if __name__ == "__main__":
-    print str(parse(file(sys.argv[1]).read(),sys.argv[1]))
+    if sys.argv[1] == "--json":
+        dump(parse(file(sys.argv[2]).read(), sys.argv[2]), sys.stdout)
+    else:
+        print str(parse(file(sys.argv[1]).read(),sys.argv[1]))
 